@@ -0,0 +1,212 @@
+""" Author: Dominik Beese
+>>> Cache Manager
+<<<
+"""
+
+from os import stat, walk, link, remove, replace, makedirs, sep
+from os.path import join, abspath, exists, dirname, expanduser, relpath
+from shutil import copyfile
+from hashlib import md5, sha256
+from time import time
+import json
+
+STORE_DIR = join(expanduser('~'), '.translationtoolkit', 'store')
+
+# files modified less than this many seconds ago are not cached,
+# since a change within the timestamp resolution would go unnoticed
+RACY_SECONDS = 2
+
+# manifests are saved next to the file they describe (e.g. patches.zip.manifest.json)
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+class Cache:
+	""" Caches values computed from files for the whole session.
+		An entry is invalidated as soon as the size, modification time
+		or inode of its file changes.
+	"""
+	entries = dict()
+	
+	def signature(file):
+		""" Returns the signature of the given [file] or None if it does not exist. """
+		try: info = stat(file)
+		except OSError: return None
+		return (info.st_size, info.st_mtime_ns, info.st_ino)
+	
+	def get(namespace, file, compute):
+		""" Returns the cached value of the given [file] in the given [namespace].
+			If there is no valid entry the value is computed by calling [compute] with the [file].
+		"""
+		key = (namespace, abspath(file))
+		signature = Cache.signature(file)
+		entry = Cache.entries.get(key)
+		if signature is not None and entry is not None and entry[0] == signature: return entry[1]
+		value = compute(file)
+		if signature is not None and time() - signature[1] / 1e9 >= RACY_SECONDS:
+			Cache.entries[key] = (signature, value)
+		else: Cache.entries.pop(key, None)
+		return value
+	
+	def put(namespace, file, value):
+		""" Stores the given [value] for the given [file] in the given [namespace]. """
+		signature = Cache.signature(file)
+		if signature is None or time() - signature[1] / 1e9 < RACY_SECONDS: return
+		Cache.entries[(namespace, abspath(file))] = (signature, value)
+	
+	def clear(namespace = None):
+		""" Removes all entries of the given [namespace] or all entries if no [namespace] is given. """
+		if namespace is None: Cache.entries.clear()
+		else: Cache.entries = {k: v for k, v in Cache.entries.items() if k[0] != namespace}
+
+
+class Store:
+	""" A content-addressed store for original game files shared by all workspaces.
+		Every file is stored once by its MD5 digest and linked into the workspaces as a hardlink,
+		so the files must never be modified in place.
+	"""
+	directory = STORE_DIR
+	index = None
+	dirty = False
+	
+	def objectPath(digest):
+		""" Returns the path of the object with the given hex [digest]. """
+		return join(Store.directory, digest[:2], digest[2:])
+	
+	def loadIndex():
+		if Store.index is not None: return
+		try:
+			with open(join(Store.directory, 'index.json'), 'r') as file: Store.index = json.load(file)
+		except: Store.index = dict()
+	
+	def saveIndex():
+		""" Writes the index of the store to disk if it changed. """
+		if not Store.dirty: return
+		makedirs(Store.directory, exist_ok=True)
+		index_file = join(Store.directory, 'index.json')
+		with open(index_file + '.temp', 'w') as file: json.dump(Store.index, file)
+		replace(index_file + '.temp', index_file)
+		Store.dirty = False
+	
+	def digest(file):
+		""" Returns the MD5 digest of the given [file] if it is linked to an object of the store, None otherwise. """
+		try: info = stat(file)
+		except OSError: return None
+		if info.st_nlink < 2: return None
+		Store.loadIndex()
+		entry = Store.index.get('%d:%d' % (info.st_dev, info.st_ino))
+		if entry is None or entry[1:] != [info.st_size, info.st_mtime_ns]: return None
+		return bytes.fromhex(entry[0])
+	
+	def add(file, digest):
+		""" Adds the given [file] with the given MD5 [digest] to the store and returns the path of the object. """
+		object_file = Store.objectPath(digest.hex())
+		if not exists(object_file):
+			makedirs(dirname(object_file), exist_ok=True)
+			copyfile(file, object_file + '.temp')
+			replace(object_file + '.temp', object_file)
+			info = stat(object_file)
+			Store.loadIndex()
+			Store.index['%d:%d' % (info.st_dev, info.st_ino)] = [digest.hex(), info.st_size, info.st_mtime_ns]
+			Store.dirty = True
+		return object_file
+	
+	def materialize(file, dest_file, digest):
+		""" Adds the given [file] with the given MD5 [digest] to the store and links the object to [dest_file].
+			Falls back to copying if the destination does not support hardlinks.
+			Returns true if the file was linked.
+		"""
+		object_file = Store.add(file, digest)
+		if exists(dest_file): remove(dest_file)
+		try:
+			link(object_file, dest_file)
+			linked = True
+		except OSError:
+			copyfile(object_file, dest_file)
+			linked = False
+		Cache.put('md5', dest_file, digest)
+		return linked
+	
+	def stats():
+		""" Returns the number of objects, their total size, the number of references from workspaces
+			and the number of bytes saved compared to separate copies.
+		"""
+		ctr = dict()
+		for dp, dn, fn in walk(Store.directory):
+			for f in fn:
+				if dp == Store.directory: continue # skip index
+				info = stat(join(dp, f))
+				ctr['objects'] = ctr.get('objects', 0) + 1
+				ctr['size'] = ctr.get('size', 0) + info.st_size
+				ctr['references'] = ctr.get('references', 0) + info.st_nlink - 1
+				ctr['saved'] = ctr.get('saved', 0) + info.st_size * max(0, info.st_nlink - 2)
+		return ctr
+	
+	def collectGarbage():
+		""" Removes all objects that are not linked to any workspace
+			and returns the number of removed objects and bytes.
+		"""
+		Store.loadIndex()
+		ctr = dict()
+		for dp, dn, fn in walk(Store.directory):
+			for f in fn:
+				if dp == Store.directory: continue # skip index
+				object_file = join(dp, f)
+				info = stat(object_file)
+				if info.st_nlink > 1: continue
+				remove(object_file)
+				Store.index.pop('%d:%d' % (info.st_dev, info.st_ino), None)
+				Store.dirty = True
+				ctr['objects'] = ctr.get('objects', 0) + 1
+				ctr['size'] = ctr.get('size', 0) + info.st_size
+		Store.saveIndex()
+		return ctr
+
+
+############
+## Hashes ##
+############
+
+def hash(file):
+	""" Calculates the MD5 hash of the given file.
+		The hash is cached until the file changes and taken from the store for linked files.
+	"""
+	def md5File(file):
+		digest = Store.digest(file)
+		if digest is not None: return digest
+		hasher = md5()
+		with open(file, 'rb') as f: hasher.update(f.read())
+		return hasher.digest()
+	return Cache.get('md5', file, md5File)
+
+def hashSHA256(file):
+	""" Calculates the SHA-256 hash of the given file as a hex string. """
+	hasher = sha256()
+	with open(file, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''): hasher.update(chunk)
+	return hasher.hexdigest()
+
+def treeFingerprint(folder, previous = None):
+	""" Returns the fingerprint of all files in the given [folder]
+		as a dict of relative path -> [size, mtime_ns, digest].
+		Digests of files whose size and modification time match the [previous] fingerprint are reused.
+	"""
+	previous = previous or dict()
+	fingerprint = dict()
+	for dp, dn, fn in walk(folder):
+		for f in fn:
+			file = join(dp, f)
+			key = '/'.join(relpath(file, folder).split(sep))
+			info = stat(file)
+			entry = previous.get(key)
+			if entry is not None and entry[:2] == [info.st_size, info.st_mtime_ns]: digest = entry[2]
+			else: digest = hash(file).hex()
+			# do not reuse digests of files that could still change unnoticed
+			racy = time() - info.st_mtime_ns / 1e9 < RACY_SECONDS
+			fingerprint[key] = [info.st_size, None if racy else info.st_mtime_ns, digest]
+	return fingerprint
+
+def fileSignature(file):
+	""" Returns the size and modification time of the given [file] or None if it does not exist. """
+	try: info = stat(file)
+	except OSError: return None
+	return [info.st_size, info.st_mtime_ns]
@@ -0,0 +1,595 @@
+""" Author: Dominik Beese
+>>> Container Manager
+<<<
+"""
+
+from os import makedirs, replace, remove, stat, listdir
+from os.path import join, normpath, sep, dirname, splitext, isfile, isdir, exists
+from mmap import mmap, ACCESS_READ
+from struct import Struct, unpack
+from hashlib import sha256
+from time import time
+import json
+
+from CacheManager import RACY_SECONDS, MANIFEST_SUFFIX
+
+# 0: nothing, 1: normal, 2: all
+VERBOSE = 1
+
+
+###########
+## RomFS ##
+###########
+
+IVFC_HEADER = Struct('<4sIIQQIIQQIIQQIIII') # magic, version, master hash size, 3 levels (offset, size, block size, reserved), reserved, info size
+IVFC_HEADER_SIZE = 0x60
+IVFC_MAGIC_NUMBER = 0x10000
+BLOCK_SIZE_LOG2 = 12
+BLOCK_SIZE = 1 << BLOCK_SIZE_LOG2
+LEVEL3_HEADER = Struct('<10I') # header size, dir hash, dir meta, file hash, file meta (offset, size each), file data offset
+DIR_ENTRY = Struct('<6I') # parent, sibling, child, file, hash sibling, name size
+FILE_ENTRY = Struct('<2IQQ2I') # parent, sibling, data offset, data size, hash sibling, name size
+INVALID = 0xFFFFFFFF
+FILE_ALIGNMENT = 0x10
+
+# extracted folders of a CIA folder and the images they are extracted from
+ROMFS_IMAGES = {'ExtractedRomFS': 'DecryptedRomFS.bin', 'ExtractedManual': 'DecryptedManual.bin', 'ExtractedDownloadPlay': 'DecryptedDownloadPlay.bin'}
+
+def align(value, alignment):
+	return (value + alignment - 1) // alignment * alignment
+
+def codeUnits(name):
+	""" Returns the UTF-16 code units of the given [name], which determine the order of the entries.
+		Comparing the encoded bytes is not the same, since they are little-endian.
+	"""
+	data = name.encode('utf-16-le')
+	return unpack('<%dH' % (len(data) // 2), data)
+
+class RomFS:
+	""" Reads a decrypted RomFS image (e.g. DecryptedRomFS.bin) without extracting it.
+		The image is memory-mapped and files are returned as zero-copy memoryviews,
+		which must be released before the image is closed.
+		Supports images with an IVFC hash tree and plain level 3 images.
+	"""
+	
+	def __init__(self, filename):
+		self.file = open(filename, 'rb')
+		try:
+			self.map = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+			self.data = memoryview(self.map)
+			# locate level 3
+			self.offset = 0
+			if self.map[:4] == b'IVFC':
+				header = IVFC_HEADER.unpack_from(self.map, 0)
+				master_hash_size, level3_block_size = header[2], header[13]
+				self.offset = align(IVFC_HEADER_SIZE + master_hash_size, 1 << level3_block_size)
+			level3 = LEVEL3_HEADER.unpack_from(self.map, self.offset)
+			if level3[0] != LEVEL3_HEADER.size: raise ValueError('Not a RomFS image: %s' % filename)
+			self.dir_meta = self.offset + level3[3]
+			self.file_meta = self.offset + level3[7]
+			self.file_data = self.offset + level3[9]
+			self.entries = None
+		except:
+			self.close()
+			raise
+	
+	def __enter__(self): return self
+	def __exit__(self, *args): self.close()
+	
+	def close(self):
+		if hasattr(self, 'data'): self.data.release()
+		if hasattr(self, 'map'): self.map.close()
+		self.file.close()
+	
+	def name(self, offset, size):
+		return bytes(self.map[offset:offset+size]).decode('utf-16-le')
+	
+	def files(self):
+		""" Returns a dict of all files as path (separated by /) -> (offset, size) in the image. """
+		if self.entries is not None: return self.entries
+		self.entries = dict()
+		stack = [(0, '')]
+		while stack:
+			dir_offset, path = stack.pop()
+			_, _, child, file, _, _ = DIR_ENTRY.unpack_from(self.map, self.dir_meta + dir_offset)
+			# files of the directory
+			while file != INVALID:
+				_, sibling, data_offset, data_size, _, name_size = FILE_ENTRY.unpack_from(self.map, self.file_meta + file)
+				name = self.name(self.file_meta + file + FILE_ENTRY.size, name_size)
+				self.entries[path + name] = (self.file_data + data_offset, data_size)
+				file = sibling
+			# subdirectories
+			while child != INVALID:
+				_, sibling, _, _, _, name_size = DIR_ENTRY.unpack_from(self.map, self.dir_meta + child)
+				stack.append((child, path + self.name(self.dir_meta + child + DIR_ENTRY.size, name_size) + '/'))
+				child = sibling
+		return self.entries
+	
+	def select(self, folders = None, types = None):
+		""" Returns the paths of all files in the given [folders] (paths separated by /)
+			with the given file [types] (e.g. ['.bcres']). All files are returned if nothing is given.
+		"""
+		prefixes = tuple(folder.strip('/') + '/' if folder.strip('/') else '' for folder in folders) if folders is not None else ('',)
+		return sorted(path for path in self.files() if path.startswith(prefixes) and (types is None or splitext(path)[1] in types))
+	
+	def read(self, path):
+		""" Returns the data of the file with the given [path] as a zero-copy memoryview. """
+		offset, size = self.files()[path]
+		return self.data[offset:offset+size]
+	
+	def extract(self, dest_dir, folders = None, types = None):
+		""" Extracts the files of the given [folders] with the given file [types]
+			to the given [dest_dir] and returns the number of extracted files.
+		"""
+		ctr = 0
+		for path in self.select(folders, types):
+			dest_file = join(dest_dir, *path.split('/'))
+			if VERBOSE >= 2: print(' *', path)
+			makedirs(dirname(dest_file), exist_ok=True)
+			with self.read(path) as data, open(dest_file + '.temp', 'wb') as file: file.write(data)
+			replace(dest_file + '.temp', dest_file)
+			ctr += 1
+		return ctr
+
+def pathHash(parent, name):
+	""" Returns the hash of the entry with the given [name] in the directory at the [parent] offset. """
+	hash = parent ^ 123456789
+	for i in range(0, len(name), 2):
+		hash = ((hash >> 5) | (hash << 27)) & 0xFFFFFFFF
+		hash ^= name[i] | name[i+1] << 8
+	return hash
+
+def bucketCount(entries):
+	""" Returns the number of buckets of a hash table for the given number of [entries]. """
+	if entries < 3: return 3
+	if entries < 19: return entries | 1
+	while any(entries % p == 0 for p in [2, 3, 5, 7, 11, 13, 17]): entries += 1
+	return entries
+
+class RomFSLayout:
+	""" The level 3 layout of a RomFS image built from a folder.
+		Directories and files are sorted by name. The files of a directory are followed by
+		its subdirectories, all subdirectories of a directory are listed before their contents.
+	"""
+	
+	def __init__(self, romfs_dir):
+		self.files = list() # path, file, size, data offset
+		dirs = list() # name, parent, files, subdirectories
+		file_parents = list()
+		def visit(index, directory, path):
+			names = sorted(listdir(directory), key=codeUnits)
+			for name in [n for n in names if isfile(join(directory, n))]:
+				dirs[index][2].append(len(self.files))
+				file_parents.append(index)
+				self.files.append([path + name, join(directory, name), stat(join(directory, name)).st_size, 0])
+			children = [n for n in names if isdir(join(directory, n))]
+			for name in children:
+				dirs[index][3].append(len(dirs))
+				dirs.append([name, index, list(), list()])
+			for child, name in zip(dirs[index][3], children): visit(child, join(directory, name), path + name + '/')
+		dirs.append(['', 0, list(), list()])
+		visit(0, romfs_dir, '')
+		encode = lambda name: name.encode('utf-16-le')
+		file_names = [encode(file[0].split('/')[-1]) for file in self.files]
+		dir_names = [encode(dir[0]) for dir in dirs]
+		
+		# offsets of the metadata entries
+		dir_offsets, offset = list(), 0
+		for name in dir_names:
+			dir_offsets.append(offset)
+			offset += DIR_ENTRY.size + align(len(name), 4)
+		file_offsets, offset = list(), 0
+		for name in file_names:
+			file_offsets.append(offset)
+			offset += FILE_ENTRY.size + align(len(name), 4)
+		
+		# offsets of the file data
+		offset = 0
+		for file in self.files:
+			offset = align(offset, FILE_ALIGNMENT)
+			file[3] = offset
+			offset += file[2]
+		data_size = offset
+		
+		# hash tables, every bucket points to its last entry
+		dir_buckets = [INVALID] * bucketCount(len(dirs))
+		dir_collisions = list()
+		for i, dir in enumerate(dirs):
+			bucket = pathHash(dir_offsets[dir[1]], dir_names[i]) % len(dir_buckets)
+			dir_collisions.append(dir_buckets[bucket])
+			dir_buckets[bucket] = dir_offsets[i]
+		file_buckets = [INVALID] * bucketCount(len(self.files))
+		file_collisions = list()
+		for i in range(len(self.files)):
+			bucket = pathHash(dir_offsets[file_parents[i]], file_names[i]) % len(file_buckets)
+			file_collisions.append(file_buckets[bucket])
+			file_buckets[bucket] = file_offsets[i]
+		
+		# siblings
+		dir_siblings = [INVALID] * len(dirs)
+		file_siblings = [INVALID] * len(self.files)
+		for dir in dirs:
+			for a, b in zip(dir[3], dir[3][1:]): dir_siblings[a] = dir_offsets[b]
+			for a, b in zip(dir[2], dir[2][1:]): file_siblings[a] = file_offsets[b]
+		
+		# metadata tables
+		def pad(name): return name + bytes(align(len(name), 4) - len(name))
+		dir_meta = bytearray()
+		for i, dir in enumerate(dirs):
+			child = dir_offsets[dir[3][0]] if dir[3] else INVALID
+			file = file_offsets[dir[2][0]] if dir[2] else INVALID
+			dir_meta += DIR_ENTRY.pack(dir_offsets[dir[1]], dir_siblings[i], child, file, dir_collisions[i], len(dir_names[i])) + pad(dir_names[i])
+		file_meta = bytearray()
+		for i, file in enumerate(self.files):
+			file_meta += FILE_ENTRY.pack(dir_offsets[file_parents[i]], file_siblings[i], file[3], file[2], file_collisions[i], len(file_names[i])) + pad(file_names[i])
+		
+		# level 3 header and tables
+		dir_hash = b''.join(b.to_bytes(4, 'little') for b in dir_buckets)
+		file_hash = b''.join(b.to_bytes(4, 'little') for b in file_buckets)
+		offsets = [LEVEL3_HEADER.size]
+		for table in [dir_hash, dir_meta, file_hash, file_meta]: offsets.append(offsets[-1] + len(table))
+		self.data_offset = align(offsets[-1], FILE_ALIGNMENT)
+		header = LEVEL3_HEADER.pack(LEVEL3_HEADER.size, offsets[0], len(dir_hash), offsets[1], len(dir_meta), offsets[2], len(file_hash), offsets[3], len(file_meta), self.data_offset)
+		self.tables = header + dir_hash + dir_meta + file_hash + file_meta + bytes(self.data_offset - offsets[-1])
+		self.size = self.data_offset + data_size
+		
+		# ivfc levels: level 2 hashes level 3, level 1 hashes level 2, the master hash hashes level 1
+		blocks = lambda size: (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+		self.level_sizes = [0, 0, self.size]
+		self.level_sizes[1] = blocks(self.level_sizes[2]) * 0x20
+		self.level_sizes[0] = blocks(self.level_sizes[1]) * 0x20
+		self.master_hash_size = blocks(self.level_sizes[0]) * 0x20
+		# physical order: header, master hash, level 3, level 1, level 2
+		self.level3_offset = align(IVFC_HEADER_SIZE + self.master_hash_size, BLOCK_SIZE)
+		self.level1_offset = self.level3_offset + align(self.level_sizes[2], BLOCK_SIZE)
+		self.level2_offset = self.level1_offset + align(self.level_sizes[0], BLOCK_SIZE)
+		self.image_size = self.level2_offset + align(self.level_sizes[1], BLOCK_SIZE)
+	
+	def ivfcHeader(self):
+		level1 = 0
+		level2 = align(level1 + self.level_sizes[0], BLOCK_SIZE)
+		level3 = align(level2 + self.level_sizes[1], BLOCK_SIZE)
+		return IVFC_HEADER.pack(b'IVFC', IVFC_MAGIC_NUMBER, self.master_hash_size,
+			level1, self.level_sizes[0], BLOCK_SIZE_LOG2, 0,
+			level2, self.level_sizes[1], BLOCK_SIZE_LOG2, 0,
+			level3, self.level_sizes[2], BLOCK_SIZE_LOG2, 0,
+			0, IVFC_HEADER.size)
+
+def hashBlocks(data):
+	""" Returns the SHA-256 hashes of all blocks of the given [data], the last block is padded with zeros. """
+	hashes = bytearray()
+	for offset in range(0, len(data), BLOCK_SIZE):
+		block = data[offset:offset+BLOCK_SIZE]
+		hashes += sha256(bytes(block) + bytes(BLOCK_SIZE - len(block))).digest()
+	return hashes
+
+def fileSignatures(layout):
+	""" Returns the size and modification time of all files of the given [layout].
+		Files that could still change unnoticed get no modification time.
+	"""
+	signatures = dict()
+	for path, file, size, offset in layout.files:
+		info = stat(file)
+		signatures[path] = [info.st_size, info.st_mtime_ns if time() - info.st_mtime_ns / 1e9 >= RACY_SECONDS else None]
+	return signatures
+
+def buildRomFS(romfs_dir, image_file, incremental = False):
+	""" Builds a RomFS image with an IVFC hash tree from the given [romfs_dir].
+		If [incremental] is true and the files of the folder only changed in content but still
+		fit into their aligned space, the previous [image_file] is updated in place: only the
+		changed file data, the metadata and the affected hash blocks are written.
+		Returns true if the image was updated incrementally.
+	"""
+	layout = RomFSLayout(romfs_dir)
+	signatures = fileSignatures(layout)
+	manifest_file = image_file + MANIFEST_SUFFIX
+	
+	# load the manifest of the previous image
+	manifest = None
+	if incremental and exists(image_file):
+		try:
+			with open(manifest_file, 'r') as file: manifest = json.load(file)
+			info = stat(image_file)
+			if manifest['image'] != [info.st_size, info.st_mtime_ns]: manifest = None
+		except: manifest = None
+	
+	if manifest is not None and updateRomFS(layout, signatures, manifest, image_file): updated = True
+	else:
+		if exists(manifest_file): remove(manifest_file)
+		writeRomFS(layout, image_file)
+		updated = False
+	
+	# remember the files of the image
+	info = stat(image_file)
+	manifest = {'image': [info.st_size, info.st_mtime_ns], 'tables': sha256(layout.tables).hexdigest(),
+		'files': {path: signatures[path] + [size, offset] for path, file, size, offset in layout.files}}
+	with open(manifest_file + '.temp', 'w') as file: json.dump(manifest, file)
+	replace(manifest_file + '.temp', manifest_file)
+	return updated
+
+def writeRomFS(layout, image_file):
+	""" Writes the complete image of the given [layout] to the given [image_file]. """
+	level2 = bytearray()
+	with open(image_file + '.temp', 'wb') as file:
+		file.truncate(layout.image_size)
+		file.seek(layout.level3_offset)
+		# level 3, hashed block by block while writing
+		buffer = bytearray(layout.tables)
+		position = layout.data_offset
+		for path, source_file, size, offset in layout.files:
+			buffer += bytes(layout.data_offset + offset - position)
+			with open(source_file, 'rb') as source:
+				while True:
+					chunk = source.read(1 << 20)
+					if not chunk: break
+					buffer += chunk
+					if len(buffer) >= 1 << 20:
+						cut = len(buffer) // BLOCK_SIZE * BLOCK_SIZE
+						level2 += hashBlocks(buffer[:cut])
+						file.write(buffer[:cut])
+						del buffer[:cut]
+			position = layout.data_offset + offset + size
+		level2 += hashBlocks(buffer)
+		file.write(buffer)
+		# hash levels and header
+		level1 = hashBlocks(level2)
+		file.seek(layout.level1_offset)
+		file.write(level1)
+		file.seek(layout.level2_offset)
+		file.write(level2)
+		file.seek(0)
+		file.write(layout.ivfcHeader())
+		file.seek(IVFC_HEADER_SIZE)
+		file.write(hashBlocks(level1))
+	replace(image_file + '.temp', image_file)
+
+def updateRomFS(layout, signatures, manifest, image_file):
+	""" Updates the given [image_file] built from the same files with the same aligned sizes in place.
+		Returns false if the layout changed and the image has to be rebuilt.
+	"""
+	# the layout must be the same except for the file sizes within their aligned space
+	previous = manifest['files']
+	if [path for path, file, size, offset in layout.files] != list(previous): return False
+	if any(previous[path][3] != offset for path, file, size, offset in layout.files): return False
+	old_size = layout.data_offset + max([previous[path][3] + previous[path][2] for path in previous] + [0])
+	if (old_size + BLOCK_SIZE - 1) // BLOCK_SIZE != (layout.size + BLOCK_SIZE - 1) // BLOCK_SIZE: return False
+	changed = [(path, file, size, offset) for path, file, size, offset in layout.files if previous[path][:2] != signatures[path] or signatures[path][1] is None]
+	
+	# the image is invalid until it is updated completely
+	remove(image_file + MANIFEST_SUFFIX)
+	with open(image_file, 'r+b') as file:
+		# write the changed files, the tables and the padding after the files
+		dirty = set(range(0, (len(layout.tables) + BLOCK_SIZE - 1) // BLOCK_SIZE))
+		file.seek(layout.level3_offset)
+		file.write(layout.tables)
+		for path, source_file, size, offset in changed:
+			with open(source_file, 'rb') as source: data = source.read()
+			data += bytes(max(previous[path][2], size) - size) # clear the rest of the old data
+			file.seek(layout.level3_offset + layout.data_offset + offset)
+			file.write(data)
+			start = layout.data_offset + offset
+			dirty.update(range(start // BLOCK_SIZE, (start + len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE))
+		
+		# update the hashes of the dirty blocks from level 3 up to the master hash
+		def rehash(level_offset, level_size, blocks, hash_offset):
+			dirty = set()
+			for block in sorted(blocks):
+				if block * BLOCK_SIZE >= level_size: continue
+				file.seek(level_offset + block * BLOCK_SIZE)
+				data = file.read(min(BLOCK_SIZE, level_size - block * BLOCK_SIZE))
+				file.seek(hash_offset + block * 0x20)
+				file.write(sha256(data + bytes(BLOCK_SIZE - len(data))).digest())
+				dirty.add(block * 0x20 // BLOCK_SIZE)
+			return dirty
+		dirty = rehash(layout.level3_offset, layout.size, dirty, layout.level2_offset)
+		dirty = rehash(layout.level2_offset, layout.level_sizes[1], dirty, layout.level1_offset)
+		rehash(layout.level1_offset, layout.level_sizes[0], dirty, IVFC_HEADER_SIZE)
+		file.seek(0)
+		file.write(layout.ivfcHeader())
+	return True
+
+def openImage(cia_dir, parent):
+	""" Returns the RomFS image of the given [cia_dir] containing the given [parent] folder
+		(e.g. ExtractedRomFS/data/Battle) and the path of the folder in the image,
+		or None if the folder is not part of an image.
+	"""
+	section, *path = normpath(parent).split(sep)
+	image_file = join(cia_dir, ROMFS_IMAGES.get(section, ''))
+	if section not in ROMFS_IMAGES or not isfile(image_file): return None
+	return RomFS(image_file), '/'.join(path)
+
+
+###########
+## ExeFS ##
+###########
+
+MEDIA_UNIT = 0x200
+EXEFS_HEADER_SIZE = 0x200
+EXEFS_ENTRY = Struct('<8sII') # name, offset, size
+EXEFS_ENTRIES = 10
+EXEFS_HASHES = 0xC0 # hashes are stored in reverse order
+
+def exefsEntries(header):
+	""" Returns the names, offsets and sizes of all sections in the given ExeFS [header]. """
+	entries = list()
+	for i in range(EXEFS_ENTRIES):
+		name, offset, size = EXEFS_ENTRY.unpack_from(header, i * EXEFS_ENTRY.size)
+		name = name.rstrip(b'\0').decode('ascii')
+		if name: entries.append((name, offset, size))
+	return entries
+
+def exefsFile(exefs_dir, name):
+	""" Returns the file of the section with the given [name] in the given [exefs_dir].
+		The files are named after the sections (e.g. code.bin for .code), other extensions
+		are accepted as well (e.g. banner.bnr), so folders extracted by 3dstool can be used.
+	"""
+	base = name.lstrip('.')
+	if isfile(join(exefs_dir, base + '.bin')): return join(exefs_dir, base + '.bin')
+	return next((join(exefs_dir, f) for f in sorted(listdir(exefs_dir)) if f.split('.')[0] == base and isfile(join(exefs_dir, f))), None)
+
+def copyRange(src, dest, offset, size):
+	""" Copies [size] bytes at the given [offset] of the [src] file object to the [dest] file object. """
+	src.seek(offset)
+	while size > 0:
+		chunk = src.read(min(size, 1 << 20))
+		if not chunk: raise ValueError('Unexpected end of file')
+		dest.write(chunk)
+		size -= len(chunk)
+
+def extractExeFS(exefs_file, exefs_dir, header_file = None):
+	""" Extracts all sections of the given [exefs_file] to the given [exefs_dir]
+		and saves the header to the given [header_file].
+	"""
+	makedirs(exefs_dir, exist_ok=True)
+	with open(exefs_file, 'rb') as src:
+		header = src.read(EXEFS_HEADER_SIZE)
+		if header_file:
+			with open(header_file, 'wb') as file: file.write(header)
+		for name, offset, size in exefsEntries(header):
+			with open(join(exefs_dir, name.lstrip('.') + '.bin'), 'wb') as dest: copyRange(src, dest, EXEFS_HEADER_SIZE + offset, size)
+
+def buildExeFS(exefs_dir, header_file, exefs_file):
+	""" Builds an ExeFS from the files in the given [exefs_dir] using the sections of the given [header_file].
+		Offsets, sizes and hashes are updated, every section is aligned to media units.
+	"""
+	with open(header_file, 'rb') as file: header = bytearray(file.read(EXEFS_HEADER_SIZE))
+	entries = exefsEntries(header)
+	header[:EXEFS_ENTRIES * EXEFS_ENTRY.size] = bytes(EXEFS_ENTRIES * EXEFS_ENTRY.size)
+	header[EXEFS_HASHES:] = bytes(EXEFS_HEADER_SIZE - EXEFS_HASHES)
+	with open(exefs_file + '.temp', 'wb') as dest:
+		dest.write(header)
+		offset = 0
+		for i, (name, _, _) in enumerate(entries):
+			section_file = exefsFile(exefs_dir, name)
+			if section_file is None: raise ValueError('Missing ExeFS section: %s' % name)
+			with open(section_file, 'rb') as file: data = file.read()
+			EXEFS_ENTRY.pack_into(header, i * EXEFS_ENTRY.size, name.encode('ascii'), offset, len(data))
+			hash_offset = EXEFS_HASHES + (EXEFS_ENTRIES - 1 - i) * 0x20
+			header[hash_offset:hash_offset+0x20] = sha256(data).digest()
+			dest.write(data + bytes(align(len(data), MEDIA_UNIT) - len(data)))
+			offset += align(len(data), MEDIA_UNIT)
+		dest.seek(0)
+		dest.write(header)
+	replace(exefs_file + '.temp', exefs_file)
+
+
+##########
+## NCCH ##
+##########
+
+NCCH_HEADER_SIZE = 0x200
+NCCH_MAGIC = 0x100
+NCCH_CONTENT_SIZE = 0x104
+NCCH_EXHEADER_HASH = 0x160
+NCCH_EXHEADER_SIZE = 0x180
+NCCH_LOGO_HASH = 0x130
+NCCH_EXEFS_HASH = 0x1C0
+NCCH_ROMFS_HASH = 0x1E0
+EXHEADER_SIZE = 0x800 # extended header and access descriptor
+EXHEADER_HASHED_SIZE = 0x400
+ROMFS_ALIGNMENT = 0x1000
+# offsets of the region fields (offset, size and for exefs and romfs the size of the hashed region) in media units
+NCCH_REGIONS = {'plain': 0x190, 'logo': 0x198, 'exefs': 0x1A0, 'romfs': 0x1B0}
+
+def ncchRegions(header):
+	""" Returns the offsets and sizes in bytes of all regions of the given NCCH [header]. """
+	if header[NCCH_MAGIC:NCCH_MAGIC+4] != b'NCCH': raise ValueError('Not an NCCH partition')
+	regions = dict()
+	if int.from_bytes(header[NCCH_EXHEADER_SIZE:NCCH_EXHEADER_SIZE+4], 'little'): regions['exheader'] = (NCCH_HEADER_SIZE, EXHEADER_SIZE)
+	for region, field in NCCH_REGIONS.items():
+		offset, size = Struct('<II').unpack_from(header, field)
+		if size: regions[region] = (offset * MEDIA_UNIT, size * MEDIA_UNIT)
+	return regions
+
+def extractNCCH(ncch_file, header = None, exheader = None, logo = None, plain = None, exefs = None, romfs = None):
+	""" Extracts the regions of the given decrypted [ncch_file] (CXI or CFA) to the given files.
+		Regions without a file and missing regions are skipped.
+	"""
+	outputs = {'exheader': exheader, 'logo': logo, 'plain': plain, 'exefs': exefs, 'romfs': romfs}
+	with open(ncch_file, 'rb') as src:
+		ncch_header = src.read(NCCH_HEADER_SIZE)
+		if header:
+			with open(header, 'wb') as file: file.write(ncch_header)
+		for region, (offset, size) in ncchRegions(ncch_header).items():
+			if not outputs.get(region): continue
+			with open(outputs[region], 'wb') as dest: copyRange(src, dest, offset, size)
+
+def buildNCCH(ncch_file, header, exheader = None, logo = None, plain = None, exefs = None, romfs = None):
+	""" Builds a decrypted NCCH partition (CXI or CFA) from the given region files.
+		The header is taken from the given [header] file, the offsets, sizes and hashes are updated.
+		The flags and the signature are kept.
+	"""
+	with open(header, 'rb') as file: ncch_header = bytearray(file.read(NCCH_HEADER_SIZE))
+	for field in [NCCH_EXHEADER_HASH, NCCH_LOGO_HASH, NCCH_EXEFS_HASH, NCCH_ROMFS_HASH]: ncch_header[field:field+0x20] = bytes(0x20)
+	for region, field in NCCH_REGIONS.items():
+		size = 12 if region in ['exefs', 'romfs'] else 8
+		ncch_header[field:field+size] = bytes(size)
+	
+	def writeRegion(dest, file, alignment, hashed_size = None):
+		""" Writes the given [file] aligned to [alignment] and returns its offset and size in media units
+			and the hash of its first [hashed_size] bytes.
+		"""
+		offset = align(dest.tell(), alignment)
+		dest.write(bytes(offset - dest.tell()))
+		hash = sha256()
+		with open(file, 'rb') as src:
+			remaining = hashed_size
+			while True:
+				chunk = src.read(1 << 20)
+				if not chunk: break
+				if remaining is None: hash.update(chunk)
+				elif remaining > 0:
+					hash.update(chunk[:remaining])
+					remaining -= len(chunk[:remaining])
+				dest.write(chunk)
+		size = dest.tell() - offset
+		dest.write(bytes(align(size, MEDIA_UNIT) - size))
+		if remaining is None: hash.update(bytes(align(size, MEDIA_UNIT) - size))
+		return offset // MEDIA_UNIT, align(size, MEDIA_UNIT) // MEDIA_UNIT, hash.digest()
+	
+	with open(ncch_file + '.temp', 'wb') as dest:
+		dest.write(ncch_header)
+		if exheader:
+			_, _, hash = writeRegion(dest, exheader, MEDIA_UNIT, EXHEADER_HASHED_SIZE)
+			ncch_header[NCCH_EXHEADER_HASH:NCCH_EXHEADER_HASH+0x20] = hash
+			ncch_header[NCCH_EXHEADER_SIZE:NCCH_EXHEADER_SIZE+4] = EXHEADER_HASHED_SIZE.to_bytes(4, 'little')
+		else: ncch_header[NCCH_EXHEADER_SIZE:NCCH_EXHEADER_SIZE+4] = bytes(4)
+		if logo:
+			offset, size, hash = writeRegion(dest, logo, MEDIA_UNIT)
+			Struct('<II').pack_into(ncch_header, NCCH_REGIONS['logo'], offset, size)
+			ncch_header[NCCH_LOGO_HASH:NCCH_LOGO_HASH+0x20] = hash
+		if plain:
+			offset, size, _ = writeRegion(dest, plain, MEDIA_UNIT)
+			Struct('<II').pack_into(ncch_header, NCCH_REGIONS['plain'], offset, size)
+		if exefs:
+			hashed_size = EXEFS_HEADER_SIZE // MEDIA_UNIT
+			offset, size, hash = writeRegion(dest, exefs, MEDIA_UNIT, hashed_size * MEDIA_UNIT)
+			Struct('<III').pack_into(ncch_header, NCCH_REGIONS['exefs'], offset, size, hashed_size)
+			ncch_header[NCCH_EXEFS_HASH:NCCH_EXEFS_HASH+0x20] = hash
+		if romfs:
+			# the hashed region of the romfs contains the ivfc header and the master hash
+			with open(romfs, 'rb') as file: ivfc = file.read(IVFC_HEADER.size)
+			hashed_size = align(IVFC_HEADER_SIZE + IVFC_HEADER.unpack(ivfc)[2], MEDIA_UNIT) // MEDIA_UNIT
+			offset, size, hash = writeRegion(dest, romfs, ROMFS_ALIGNMENT, hashed_size * MEDIA_UNIT)
+			Struct('<III').pack_into(ncch_header, NCCH_REGIONS['romfs'], offset, size, hashed_size)
+			ncch_header[NCCH_ROMFS_HASH:NCCH_ROMFS_HASH+0x20] = hash
+		ncch_header[NCCH_CONTENT_SIZE:NCCH_CONTENT_SIZE+4] = (dest.tell() // MEDIA_UNIT).to_bytes(4, 'little')
+		dest.seek(0)
+		dest.write(ncch_header)
+	replace(ncch_file + '.temp', ncch_file)
+
+
+if __name__ == '__main__':
+	import sys
+	if len(sys.argv) == 4 and sys.argv[1] == '-c':
+		start = time()
+		updated = buildRomFS(sys.argv[2], sys.argv[3], incremental=True)
+		print('%s %s in %.2fs.' % ('Updated' if updated else 'Built', sys.argv[3], time() - start))
+	elif len(sys.argv) >= 3 and sys.argv[1] != '-c':
+		with RomFS(sys.argv[1]) as romfs:
+			ctr = romfs.extract(sys.argv[2], folders=sys.argv[3:] or None)
+		print('Extracted %d files.' % ctr)
+	else:
+		print('Usage:')
+		print('  * py -3 ContainerManager.py <RomFS> <OutputFolder> [<Folder> ...]')
+		print('  * py -3 ContainerManager.py -c <RomFSFolder> <RomFS>')
@@ -3,17 +3,31 @@
 <<<
 """
 
-from os import makedirs, listdir, remove, rename
+from os import makedirs, listdir, remove, rename, replace
 from os.path import join, isfile, isdir, splitext, abspath
-from subprocess import run, PIPE, STDOUT
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import json
+
+from CacheManager import hash, treeFingerprint, fileSignature
+from ContainerManager import buildRomFS, extractExeFS, buildExeFS, extractNCCH, buildNCCH
+from ProcessManager import runTool, ToolError
+
+REBUILD_MANIFEST = 'tt-rebuild.json'
+NCCH_OPTIONS = {'exheader': 'exh', 'exefs': 'exefs', 'romfs': 'romfs', 'logo': 'logo', 'plain': 'plain'} # section -> 3dstool option
 
 
 #############
 ## Extract ##
 #############
 
-def extractGame(game_file, game_dir, dstool, ctrtool):
-	""" Extracts the given [game_file] to the given [game_dir]. Supports .cia and .3ds files. """
+def extractGame(game_file, game_dir, dstool, ctrtool, native = False, extract_romfs = True):
+	""" Extracts the given [game_file] to the given [game_dir]. Supports .cia and .3ds files.
+		Independent steps run at the same time, the finished steps are yielded in order.
+		If [native] is true, the partitions and the ExeFS are extracted without 3dstool.
+		If [extract_romfs] is false, the RomFS images are kept without extracting them,
+		since the original files are read from the images directly and RP extracts them when needed.
+	"""
 	try:
 		mode = splitext(game_file)[1][1:].lower()
 		
@@ -21,75 +35,95 @@ def extractGame(game_file, game_dir, dstool, ctrtool):
 		print('Extracting Step 1/7')
 		makedirs(game_dir, exist_ok=True)
 		if mode == 'cia':
-			proc = run('"%s" -x --content="%s" "%s"' % (abspath(ctrtool), abspath(join(game_dir, 'Decrypted')), abspath(game_file)), shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			runTool([abspath(ctrtool), '-x', '--content=%s' % abspath(join(game_dir, 'Decrypted')), abspath(game_file)])
 			partitions = list()
 			for decrypted_file in [f for f in listdir(game_dir) if f.startswith('Decrypted')]:
 				id = int(decrypted_file[10:14])
 				rename(join(game_dir, decrypted_file), join(game_dir, 'DecryptedPartition%d.bin' % id))
 				partitions.append(id)
 		elif mode == '3ds':
-			proc = run('"%s" -xtf 3ds "%s" --header HeaderNCCH.bin -0 DecryptedPartition0.bin -1 DecryptedPartition1.bin -2 DecryptedPartition2.bin -6 DecryptedPartition6.bin -7 DecryptedPartition7.bin' % (abspath(dstool), abspath(game_file)), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			runTool([abspath(dstool), '-xtf', '3ds', abspath(game_file), '--header', 'HeaderNCCH.bin', '-0', 'DecryptedPartition0.bin', '-1', 'DecryptedPartition1.bin', '-2', 'DecryptedPartition2.bin', '-6', 'DecryptedPartition6.bin', '-7', 'DecryptedPartition7.bin'], cwd=game_dir)
 			partitions = [int(f[18]) for f in listdir(game_dir) if f.startswith('DecryptedPartition')]
 		yield 1
 		
-		# step 2: DecryptedPartitionX.bin -> HeaderNCCHX.bin, DecryptedXXX.bin, ...
-		print('Extracting Step 2/7')
-		if 0 in partitions:
-			print(' ', 'Partition0')
-			proc = run('"%s" -xtf cxi DecryptedPartition0.bin --header HeaderNCCH0.bin --exh DecryptedExHeader.bin --exefs DecryptedExeFS.bin --romfs DecryptedRomFS.bin --logo LogoLZ.bin --plain PlainRGN.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		if 1 in partitions:
-			print(' ', 'Partition1')
-			proc = run('"%s" -xtf cfa DecryptedPartition1.bin --header HeaderNCCH1.bin --romfs DecryptedManual.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		if 2 in partitions:
-			print(' ', 'Partition2')
-			proc = run('"%s" -xtf cfa DecryptedPartition2.bin --header HeaderNCCH2.bin --romfs DecryptedDownloadPlay.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		for id in partitions: remove(join(game_dir, 'DecryptedPartition%d.bin' % id))
-		yield 2
+		# remove partitions that are not extracted
+		for id in [id for id in partitions if id not in [0, 1, 2]]: remove(join(game_dir, 'DecryptedPartition%d.bin' % id))
 		
-		# step 3: DecryptedExeFS.bin -> ExtractedExeFS
-		print('Extracting Step 3/7')
-		if isfile(join(game_dir, 'DecryptedExeFS.bin')):
-			proc = run('"%s" -xtf exefs DecryptedExeFS.bin --exefs-dir ExtractedExeFS --header HeaderExeFS.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-			exefs_dir = join(game_dir, 'ExtractedExeFS')
-			if isfile(join(exefs_dir, 'banner.bnr')): rename(join(exefs_dir, 'banner.bnr'), join(exefs_dir, 'banner.bin'))
-			if isfile(join(exefs_dir, 'icon.icn')):   rename(join(exefs_dir, 'icon.icn'),   join(exefs_dir, 'icon.bin'))
-		yield 3
+		# the remaining steps only depend on their inputs, so independent steps run at the same time:
+		# partition0 -> exefs -> banner, partition0 -> romfs, partition1 -> manual, partition2 -> download play
+		def extractPartition(id, regions):
+			print(' ', 'Partition%d' % id)
+			if native: extractNCCH(join(game_dir, 'DecryptedPartition%d.bin' % id), **{k: join(game_dir, v) for k, v in regions.items()})
+			else:
+				arguments = ['--header', regions['header']] + [a for k, v in regions.items() if k != 'header' for a in ['--%s' % NCCH_OPTIONS[k], v]]
+				runTool([abspath(dstool), '-xtf', 'cxi' if id == 0 else 'cfa', 'DecryptedPartition%d.bin' % id] + arguments, cwd=game_dir)
+			remove(join(game_dir, 'DecryptedPartition%d.bin' % id)) # no longer needed
 		
-		# step 4: banner.bin -> ExtractedBanner
-		print('Extracting Step 4/7')
-		if isfile(join(game_dir, 'ExtractedExeFS', 'banner.bin')):
-			proc = run('"%s" -xtf banner "%s" --banner-dir ExtractedBanner' % (abspath(dstool), abspath(join(game_dir, 'ExtractedExeFS', 'banner.bin'))), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-			banner_dir = join(game_dir, 'ExtractedBanner')
-			if isfile(join(banner_dir, 'banner0.bcmdl')): rename(join(banner_dir, 'banner0.bcmdl'), join(banner_dir, 'banner.cgfx'))
-		yield 4
+		def step2():
+			# step 2: DecryptedPartitionX.bin -> HeaderNCCHX.bin, DecryptedXXX.bin, ...
+			print('Extracting Step 2/7')
+			for future in [partition0, partition1, partition2]: future.result()
 		
-		# step 5: DecryptedRomFS.bin -> ExtractedRomFS
-		print('Extracting Step 5/7')
-		if isfile(join(game_dir, 'DecryptedRomFS.bin')):
-			proc = run('"%s" -xtf romfs DecryptedRomFS.bin --romfs-dir ExtractedRomFS' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		yield 5
+		def step3():
+			# step 3: DecryptedExeFS.bin -> ExtractedExeFS
+			partition0.result()
+			print('Extracting Step 3/7')
+			if isfile(join(game_dir, 'DecryptedExeFS.bin')) and native:
+				extractExeFS(join(game_dir, 'DecryptedExeFS.bin'), join(game_dir, 'ExtractedExeFS'), join(game_dir, 'HeaderExeFS.bin'))
+			elif isfile(join(game_dir, 'DecryptedExeFS.bin')):
+				runTool([abspath(dstool), '-xtf', 'exefs', 'DecryptedExeFS.bin', '--exefs-dir', 'ExtractedExeFS', '--header', 'HeaderExeFS.bin'], cwd=game_dir)
+				exefs_dir = join(game_dir, 'ExtractedExeFS')
+				if isfile(join(exefs_dir, 'banner.bnr')): rename(join(exefs_dir, 'banner.bnr'), join(exefs_dir, 'banner.bin'))
+				if isfile(join(exefs_dir, 'icon.icn')):   rename(join(exefs_dir, 'icon.icn'),   join(exefs_dir, 'icon.bin'))
 		
-		# step 6: DecryptedManual.bin -> ExtractedManual
-		print('Extracting Step 6/7')
-		if isfile(join(game_dir, 'DecryptedManual.bin')):
-			proc = run('"%s" -xtf romfs DecryptedManual.bin --romfs-dir ExtractedManual' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: print('Warning: Extracting DecryptedManual.bin Failed')
-		yield 6
+		def step4():
+			# step 4: banner.bin -> ExtractedBanner
+			steps[3].result()
+			print('Extracting Step 4/7')
+			if isfile(join(game_dir, 'ExtractedExeFS', 'banner.bin')):
+				runTool([abspath(dstool), '-xtf', 'banner', abspath(join(game_dir, 'ExtractedExeFS', 'banner.bin')), '--banner-dir', 'ExtractedBanner'], cwd=game_dir)
+				banner_dir = join(game_dir, 'ExtractedBanner')
+				if isfile(join(banner_dir, 'banner0.bcmdl')): rename(join(banner_dir, 'banner0.bcmdl'), join(banner_dir, 'banner.cgfx'))
+		
+		def step5():
+			# step 5: DecryptedRomFS.bin -> ExtractedRomFS
+			partition0.result()
+			print('Extracting Step 5/7')
+			if isfile(join(game_dir, 'DecryptedRomFS.bin')) and extract_romfs:
+				runTool([abspath(dstool), '-xtf', 'romfs', 'DecryptedRomFS.bin', '--romfs-dir', 'ExtractedRomFS'], cwd=game_dir)
 		
-		# step 7: DecryptedDownloadPlay.bin -> ExtractedDownloadPlay
-		print('Extracting Step 7/7')
-		if isfile(join(game_dir, 'DecryptedDownloadPlay.bin')):
-			proc = run('"%s" -xtf romfs DecryptedDownloadPlay.bin --romfs-dir ExtractedDownloadPlay' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: print('Warning: Extracting DecryptedDownloadPlay.bin Failed')
-		yield 7
+		def step6():
+			# step 6: DecryptedManual.bin -> ExtractedManual
+			partition1.result()
+			print('Extracting Step 6/7')
+			if isfile(join(game_dir, 'DecryptedManual.bin')) and extract_romfs:
+				try: runTool([abspath(dstool), '-xtf', 'romfs', 'DecryptedManual.bin', '--romfs-dir', 'ExtractedManual'], cwd=game_dir)
+				except ToolError: print('Warning: Extracting DecryptedManual.bin Failed')
+		
+		def step7():
+			# step 7: DecryptedDownloadPlay.bin -> ExtractedDownloadPlay
+			partition2.result()
+			print('Extracting Step 7/7')
+			if isfile(join(game_dir, 'DecryptedDownloadPlay.bin')) and extract_romfs:
+				try: runTool([abspath(dstool), '-xtf', 'romfs', 'DecryptedDownloadPlay.bin', '--romfs-dir', 'ExtractedDownloadPlay'], cwd=game_dir)
+				except ToolError: print('Warning: Extracting DecryptedDownloadPlay.bin Failed')
+		
+		# every step waits for the steps it depends on, so there must be a worker for every step
+		with ThreadPoolExecutor(max_workers=9) as executor:
+			def submitPartition(id, regions):
+				if id not in partitions: return executor.submit(lambda: None)
+				return executor.submit(extractPartition, id, regions)
+			partition0 = submitPartition(0, {'header': 'HeaderNCCH0.bin', 'exheader': 'DecryptedExHeader.bin', 'exefs': 'DecryptedExeFS.bin', 'romfs': 'DecryptedRomFS.bin', 'logo': 'LogoLZ.bin', 'plain': 'PlainRGN.bin'})
+			partition1 = submitPartition(1, {'header': 'HeaderNCCH1.bin', 'romfs': 'DecryptedManual.bin'})
+			partition2 = submitPartition(2, {'header': 'HeaderNCCH2.bin', 'romfs': 'DecryptedDownloadPlay.bin'})
+			steps = dict()
+			for step, function in [(2, step2), (3, step3), (4, step4), (5, step5), (6, step6), (7, step7)]:
+				steps[step] = executor.submit(function)
+			
+			# report the steps in order as they finish
+			for step, future in steps.items():
+				future.result()
+				yield step
 		
 		# success
 		print('Extracted to', game_dir)
@@ -108,46 +142,100 @@ def extractGame(game_file, game_dir, dstool, ctrtool):
 ## Rebuild ##
 #############
 
-def rebuildGame(game_dir, game_file, version, dstool, makerom):
+def rebuildGame(game_dir, game_file, version, dstool, makerom, native = False):
 	""" Rebuilds the given [game_dir] to the given [game_file]. Supports .cia and .3ds files.
 		Sets the version of the cia file to [version].
+		Stages whose inputs did not change since the last rebuild reuse their previous outputs.
+		If [native] is true, the RomFS images, the ExeFS and the partitions are built without 3dstool
+		and the RomFS images are updated incrementally if possible.
 	"""
 	try:
 		def getFile(possibilities): return next((f for f in possibilities if isfile(join(game_dir, f))), None)
 		mode = splitext(game_file)[1][1:].lower()
 		
+		# load fingerprints of the last rebuild
+		build_file = join(game_dir, REBUILD_MANIFEST)
+		try:
+			with open(build_file, 'r') as file: build = json.load(file)
+		except: build = dict()
+		def toolDigest(tool): return hash(tool).hex() if tool and isfile(tool) else None
+		tools = {'3dstool': toolDigest(dstool), 'makerom': toolDigest(makerom), 'native': native}
+		timings = dict()
+		
+		def inputs(name, folder = None, files = [], **values):
+			""" Returns the inputs of the stage [name]: the fingerprint of the [folder],
+				the signatures of the given [files] and the given [values].
+			"""
+			tree = treeFingerprint(join(game_dir, folder), build.get(name, dict()).get('tree')) if folder else dict()
+			return dict(values, tree=tree, files={f: fileSignature(join(game_dir, f)) for f in files if f})
+		
+		def upToDate(name, stage_inputs, outputs):
+			""" Returns true if the given [stage_inputs] match the last build of [name] and its [outputs] are unchanged. """
+			entry = build.get(name)
+			if entry is None or entry['tools'] != tools: return False
+			for key, value in stage_inputs.items():
+				if key == 'tree':
+					if {k: v[2] for k, v in entry['tree'].items()} != {k: v[2] for k, v in value.items()}: return False
+				elif entry.get(key) != value: return False
+			for f in outputs:
+				signature = fileSignature(join(game_dir, f))
+				if signature is None or signature != entry['outputs'].get(f): return False
+			return True
+		
+		def stage(name, function, stage_inputs, outputs):
+			""" Calls [function] to build the [outputs] of the stage [name] unless its inputs are unchanged. """
+			if upToDate(name, stage_inputs, outputs):
+				print(' ', 'Skip %s, unchanged' % name)
+				timings[name] = None
+				return
+			build.pop(name, None)
+			start = perf_counter()
+			function()
+			timings[name] = perf_counter() - start
+			build[name] = dict(stage_inputs, tools=tools, outputs={f: fileSignature(join(game_dir, f)) for f in outputs})
+			with open(build_file + '.temp', 'w') as file: json.dump(build, file)
+			replace(build_file + '.temp', build_file)
+		
+		def buildImage(romfs_dir, image_file):
+			if native:
+				buildRomFS(join(game_dir, romfs_dir), join(game_dir, image_file), incremental=True)
+				return
+			runTool([abspath(dstool), '-ctf', 'romfs', image_file, '--romfs-dir', romfs_dir], cwd=game_dir)
+		
 		# step 1: ExtractedRomFS -> CustomRomFS.bin
 		print('Rebuilding Step 1/6')
 		if isdir(join(game_dir, 'ExtractedRomFS')):
-			proc = run('"%s" -ctf romfs CustomRomFS.bin --romfs-dir ExtractedRomFS' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			stage('RomFS', lambda: buildImage('ExtractedRomFS', 'CustomRomFS.bin'), inputs('RomFS', 'ExtractedRomFS'), ['CustomRomFS.bin'])
 		yield 1
 		
 		# step 2: ExtractedManual -> CustomManual.bin
 		print('Rebuilding Step 2/6')
 		if isdir(join(game_dir, 'ExtractedManual')):
-			proc = run('"%s" -ctf romfs CustomManual.bin --romfs-dir ExtractedManual' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			stage('Manual', lambda: buildImage('ExtractedManual', 'CustomManual.bin'), inputs('Manual', 'ExtractedManual'), ['CustomManual.bin'])
 		yield 2
 		
 		# step 3: ExtractedDownloadPlay -> CustomDownloadPlay.bin
 		print('Rebuilding Step 3/6')
 		if isdir(join(game_dir, 'ExtractedDownloadPlay')):
-			proc = run('"%s" -ctf romfs CustomDownloadPlay.bin --romfs-dir ExtractedDownloadPlay' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			stage('DownloadPlay', lambda: buildImage('ExtractedDownloadPlay', 'CustomDownloadPlay.bin'), inputs('DownloadPlay', 'ExtractedDownloadPlay'), ['CustomDownloadPlay.bin'])
 		yield 3
 		
 		# step 4: ExtractedExeFS -> CustomExeFS.bin
 		print('Rebuilding Step 4/6')
 		headerExe = getFile(['CustomHeaderExeFS.bin',  'HeaderExeFS.bin'])
 		exefs_dir = join(game_dir, 'ExtractedExeFS')
-		if isdir(exefs_dir) and headerExe:
+		def buildExeFSImage():
+			if native:
+				buildExeFS(exefs_dir, join(game_dir, headerExe), join(game_dir, 'CustomExeFS.bin'))
+				return
 			if isfile(join(exefs_dir, 'banner.bin')): rename(join(exefs_dir, 'banner.bin'), join(exefs_dir, 'banner.bnr'))
 			if isfile(join(exefs_dir, 'icon.bin')):   rename(join(exefs_dir, 'icon.bin'),   join(exefs_dir, 'icon.icn'))
-			proc = run('"%s" -ctf exefs CustomExeFS.bin --exefs-dir ExtractedExeFS --header %s' % (abspath(dstool), headerExe), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-			if isfile(join(exefs_dir, 'banner.bnr')): rename(join(exefs_dir, 'banner.bnr'), join(exefs_dir, 'banner.bin'))
-			if isfile(join(exefs_dir, 'icon.icn')):   rename(join(exefs_dir, 'icon.icn'),   join(exefs_dir, 'icon.bin'))
+			try: runTool([abspath(dstool), '-ctf', 'exefs', 'CustomExeFS.bin', '--exefs-dir', 'ExtractedExeFS', '--header', headerExe], cwd=game_dir)
+			finally:
+				if isfile(join(exefs_dir, 'banner.bnr')): rename(join(exefs_dir, 'banner.bnr'), join(exefs_dir, 'banner.bin'))
+				if isfile(join(exefs_dir, 'icon.icn')):   rename(join(exefs_dir, 'icon.icn'),   join(exefs_dir, 'icon.bin'))
+		if isdir(exefs_dir) and headerExe:
+			stage('ExeFS', buildExeFSImage, inputs('ExeFS', 'ExtractedExeFS', [headerExe]), ['CustomExeFS.bin'])
 		yield 4
 		
 		# step 5: CustomHeaderNCCHX.bin, CustomDecryptedXXX.bin, ... -> CustomPartitionX.bin
@@ -162,41 +250,49 @@ def rebuildGame(game_dir, game_file, version, dstool, makerom):
 		dlplay   = getFile(['CustomDownloadPlay.bin', 'DecryptedDownloadPlay.bin'])
 		logoLZ   = getFile(['CustomLogoLZ.bin',       'LogoLZ.bin'])
 		plainRGN = getFile(['CustomPlainRGN.bin',     'PlainRGN.bin'])
-		if all([headerN0, exHeader, exeFS, romFS]):
-			print(' ', 'Partition0')
-			arguments = ['--header %s' % headerN0, '--exh %s' % exHeader, '--exefs %s' % exeFS, '--romfs %s' % romFS]
-			if logoLZ:   arguments.append('--logo %s' % logoLZ)
-			if plainRGN: arguments.append('--plain %s' % plainRGN)
-			proc = run('"%s" -ctf cxi CustomPartition0.bin %s' % (abspath(dstool), ' '.join(arguments)), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		if all([headerN1, manual]):
-			print(' ', 'Partition1')
-			proc = run('"%s" -ctf cfa CustomPartition1.bin --header %s --romfs %s' % (abspath(dstool), headerN1, manual), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		if all([headerN2, dlplay]):
-			print(' ', 'Partition2')
-			proc = run('"%s" -ctf cfa CustomPartition2.bin --header %s --romfs %s' % (abspath(dstool), headerN2, dlplay), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+		def buildPartition(id, header, sections):
+			print(' ', 'Partition%d' % id)
+			sections = {k: v for k, v in sections.items() if v}
+			if native:
+				buildNCCH(join(game_dir, 'CustomPartition%d.bin' % id), join(game_dir, header), **{k: join(game_dir, v) for k, v in sections.items()})
+				return
+			arguments = ['--header', header] + [a for k, v in sections.items() for a in ['--%s' % NCCH_OPTIONS[k], v]]
+			runTool([abspath(dstool), '-ctf', 'cxi' if id == 0 else 'cfa', 'CustomPartition%d.bin' % id] + arguments, cwd=game_dir)
+		partitions = [
+			(0, headerN0, {'exheader': exHeader, 'exefs': exeFS, 'romfs': romFS, 'logo': logoLZ, 'plain': plainRGN}, [headerN0, exHeader, exeFS, romFS]),
+			(1, headerN1, {'romfs': manual}, [headerN1, manual]),
+			(2, headerN2, {'romfs': dlplay}, [headerN2, dlplay]),
+		]
+		for id, header, sections, required in partitions:
+			name, partition_file = 'Partition%d' % id, 'CustomPartition%d.bin' % id
+			if not all(required):
+				# remove partitions left over from an earlier rebuild
+				if isfile(join(game_dir, partition_file)): remove(join(game_dir, partition_file))
+				build.pop(name, None)
+				continue
+			stage(name, lambda: buildPartition(id, header, sections), inputs(name, files=[header] + list(sections.values())), [partition_file])
 		yield 5
 		
 		# step 6: CustomPartitionX.bin -> cia / 3ds
 		print('Rebuilding Step 6/6')
+		partition_files = sorted(f for f in listdir(game_dir) if f.startswith('CustomPartition'))
 		if mode == 'cia':
 			def int2version(v): return 'v%d.%d.%d' % (v // 2**10, v % 2**10 // 2**4, v % 2**10 % 2**4)
-			print(' ', 'CIA', int2version(version))
-			contents = ['-content "%s":%s:%s' % (abspath(join(game_dir, f)), f[15], f[15]) for f in listdir(game_dir) if f.startswith('CustomPartition')]
-			proc = run('"%s" -f cia %s -ver %d -o "%s" -target p -ignoresign' % (abspath(makerom), ' '.join(contents), version, abspath(game_file)), shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			def buildCIA():
+				print(' ', 'CIA', int2version(version))
+				contents = [a for f in partition_files for a in ['-content', '%s:%s:%s' % (abspath(join(game_dir, f)), f[15], f[15])]]
+				runTool([abspath(makerom), '-f', 'cia'] + contents + ['-ver', version, '-o', abspath(game_file), '-target', 'p', '-ignoresign'])
+			stage('CIA', buildCIA, inputs('CIA', files=partition_files, version=version), [abspath(game_file)])
 		elif mode == '3ds':
-			contents = ['--header "%s"' % abspath(join(game_dir, 'HeaderNCCH.bin'))]
-			contents += ['-%s "%s"' % (f[15], abspath(join(game_dir, f))) for f in listdir(game_dir) if f.startswith('CustomPartition')]
-			proc = run('"%s" -ctf 3ds "%s" --header HeaderNCCH.bin %s' % (abspath(dstool), abspath(game_file), ' '.join(contents)), shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		for file in [f for f in listdir(game_dir) if f.startswith('CustomPartition')]: remove(join(game_dir, file))
+			def build3DS():
+				contents = [a for f in partition_files for a in ['-%s' % f[15], abspath(join(game_dir, f))]]
+				runTool([abspath(dstool), '-ctf', '3ds', abspath(game_file), '--header', abspath(join(game_dir, 'HeaderNCCH.bin'))] + contents)
+			stage('3DS', build3DS, inputs('3DS', files=['HeaderNCCH.bin'] + partition_files), [abspath(game_file)])
 		yield 6
 		
 		# success
 		print('Rebuilt', game_file)
+		for name, duration in timings.items(): print(' *', '%s: %s' % (name, 'skipped' if duration is None else '%.2fs' % duration))
 		print()
 		return True
 		
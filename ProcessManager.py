@@ -0,0 +1,106 @@
+""" Author: Dominik Beese
+>>> Process Manager
+<<<
+"""
+
+from os import cpu_count, replace, name as os_name
+from os.path import basename, splitext
+from subprocess import Popen, DEVNULL, STDOUT
+from tempfile import TemporaryFile
+from threading import BoundedSemaphore, Lock, Timer
+from time import perf_counter, time
+import json
+
+# seconds after which a tool is killed
+TIMEOUT = 3600
+
+# the number of tools running at the same time
+SLOTS = BoundedSemaphore(cpu_count() or 1)
+
+
+class ToolError(Exception):
+	""" Raised when a tool fails or times out. The message contains the output of the tool. """
+	pass
+
+
+class Ledger:
+	""" Records every tool call of the session with its arguments,
+		wall and CPU time and exit status.
+	"""
+	entries = list()
+	lock = Lock()
+	
+	def add(entry):
+		with Ledger.lock: Ledger.entries.append(entry)
+	
+	def summary():
+		""" Returns a dict of tool -> [calls, wall time, CPU time, failed calls]. """
+		summary = dict()
+		with Ledger.lock:
+			for entry in Ledger.entries:
+				calls, wall, cpu, failed = summary.get(entry['tool'], [0, 0, 0, 0])
+				summary[entry['tool']] = [calls + 1, wall + entry['wall'], cpu + (entry['cpu'] or 0), failed + (entry['status'] != 0)]
+		return summary
+	
+	def dump(filename = None):
+		""" Prints the time spent in every tool and writes all calls to [filename] if given. """
+		for tool, (calls, wall, cpu, failed) in sorted(Ledger.summary().items(), key=lambda x: -x[1][1]):
+			print(' *', '%s: %d calls, %.2fs wall, %.2fs CPU%s' % (tool, calls, wall, cpu, ', %d failed' % failed if failed else ''))
+		if filename:
+			with Ledger.lock:
+				with open(filename + '.temp', 'w') as file: json.dump(Ledger.entries, file, indent=1)
+			replace(filename + '.temp', filename)
+	
+	def clear():
+		with Ledger.lock: Ledger.entries.clear()
+
+
+def waitProcess(proc):
+	""" Waits for the given [proc] and returns its exit code and its CPU time in seconds or None if unknown. """
+	try: from os import wait4
+	except ImportError: wait4 = None
+	if wait4 is not None:
+		from os import WIFSIGNALED, WTERMSIG, WEXITSTATUS
+		_, status, usage = wait4(proc.pid, 0)
+		proc.returncode = -WTERMSIG(status) if WIFSIGNALED(status) else WEXITSTATUS(status)
+		return proc.returncode, usage.ru_utime + usage.ru_stime
+	proc.wait()
+	if os_name == 'nt':
+		try:
+			from ctypes import windll, byref, c_ulonglong
+			creation, exit, kernel, user = c_ulonglong(), c_ulonglong(), c_ulonglong(), c_ulonglong()
+			if windll.kernel32.GetProcessTimes(int(proc._handle), byref(creation), byref(exit), byref(kernel), byref(user)):
+				return proc.returncode, (kernel.value + user.value) / 1e7 # 100 ns units
+		except Exception: pass
+	return proc.returncode, None
+
+def runTool(args, cwd = None, timeout = TIMEOUT, check = True):
+	""" Runs the tool given by the argument list [args] in the working directory [cwd]
+		and returns its output, i.e. stdout and stderr, as a string.
+		At most one tool per CPU runs at the same time, the tool is killed after [timeout] seconds.
+		Raises a ToolError containing the output if the tool fails and [check] is true
+		or if the tool times out. Every call is recorded in the Ledger.
+	"""
+	args = [str(arg) for arg in args]
+	tool = splitext(basename(args[0]))[0]
+	with SLOTS:
+		with TemporaryFile() as output:
+			start, counter = time(), perf_counter()
+			proc = Popen(args, cwd=cwd, stdin=DEVNULL, stdout=output, stderr=STDOUT)
+			killed = list()
+			def kill():
+				killed.append(True)
+				proc.kill()
+			timer = Timer(timeout, kill) if timeout else None
+			if timer: timer.start()
+			try: returncode, cpu = waitProcess(proc)
+			finally:
+				if timer: timer.cancel()
+			wall = perf_counter() - counter
+			timed_out = bool(killed)
+			output.seek(0)
+			text = output.read().decode('UTF-8', errors='replace')
+	Ledger.add({'tool': tool, 'args': args[1:], 'cwd': cwd, 'start': start, 'wall': wall, 'cpu': cpu, 'status': 'timeout' if timed_out else returncode})
+	if timed_out: raise ToolError('%s timed out after %ds\n%s' % (tool, timeout, text))
+	if check and returncode != 0: raise ToolError('%s failed with exit status %d\n%s' % (tool, returncode, text))
+	return text
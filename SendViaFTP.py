@@ -3,14 +3,39 @@
 <<<
 """
 
-from ftplib import FTP
+from ftplib import FTP, all_errors, error_perm, error_reply, error_proto
 from os import walk, sep
-from os.path import normpath, basename, join, getmtime
-from time import strptime, localtime
+from os.path import normpath, basename, join, getmtime, getsize, relpath
+from time import strptime, localtime, perf_counter, sleep
+from threading import Thread, Lock
+from queue import Queue, Empty
 
 # 0: nothing, 1: minimal, 2: all
 VERBOSE = 1
 
+# the number of connections used to send files at the same time
+CONNECTIONS = 3
+
+# files of at least this many bytes are preferably sent on dedicated connections
+LARGE_FILE = 1 << 20
+
+# transient errors are retried this many times with a new connection, permanent errors fail the file
+RETRIES = 3
+PERMANENT_ERRORS = (error_perm, error_reply, error_proto)
+TRANSIENT_ERRORS = all_errors
+
+def connect(ip, port, user, passwd, verbose = False):
+	""" Returns a new FTP connection to [ip]:[port], logged in as [user] if given. """
+	ftp = FTP(timeout = 5)
+	if verbose: print('Connect to \'%s:%d\'' % (ip, port))
+	tmp = ftp.connect(host = ip, port = port)
+	if verbose: print('>>', tmp)
+	if user:
+		if verbose: print('Login as \'%s\'' % user)
+		tmp = ftp.login(user = user, passwd = passwd)
+		if verbose: print('>>', tmp)
+	return ftp
+
 def createAndEnterPath(ftp, path):
 	for directory in path:
 		if directory not in [dir for dir, _ in ftp.mlsd()]:
@@ -18,21 +43,87 @@ def createAndEnterPath(ftp, path):
 			ftp.mkd(directory)
 		ftp.cwd(directory)
 
-def sendFiles(source_dir, title_id, ip, port, user, passwd, force_override = False):
+def sendQueued(queues, ip, port, user, passwd, ctr, lock, workers):
+	""" Sends the files of the given [queues], a list of queues of (src_filename, dest_filename, size)
+		in their order of preference, over a single connection.
+		On transient errors the connection is reopened and the file is sent again.
+		If the connection cannot be opened, the file is left to the other [workers].
+	"""
+	def nextEntry():
+		for queue in queues:
+			try: return queue, queue.get_nowait()
+			except Empty: pass
+		return None, None
+	
+	ftp = None
+	try:
+		while True:
+			queue, entry = nextEntry()
+			if entry is None:
+				# stop only under the lock, so no file can be left to this worker afterwards
+				with lock:
+					queue, entry = nextEntry()
+					if entry is None:
+						workers[0] -= 1
+						return
+			src_filename, dest_filename, size = entry
+			msg_prefix = ' * %s:' % basename(src_filename)
+			for attempt in range(RETRIES + 1):
+				try:
+					if ftp is None: ftp = connect(ip, port, user, passwd)
+					with open(src_filename, 'rb') as file: ftp.storbinary('STOR %s' % dest_filename, file)
+					with lock:
+						if VERBOSE >= 1: print(msg_prefix, 'send')
+						ctr['send'] = ctr.get('send', 0) + 1
+						ctr['bytes'] = ctr.get('bytes', 0) + size
+					break
+				except PERMANENT_ERRORS as e:
+					# the connection is in an unknown state after an unexpected reply
+					if ftp is not None and not isinstance(e, error_perm):
+						ftp.close()
+						ftp = None
+					with lock:
+						print(msg_prefix, 'Error:', str(e))
+						ctr['failed'] = ctr.get('failed', 0) + 1
+					break
+				except TRANSIENT_ERRORS as e:
+					connected = ftp is not None
+					if ftp is not None: ftp.close()
+					ftp = None
+					if attempt < RETRIES:
+						with lock:
+							if VERBOSE >= 2: print(msg_prefix, 'retry (%s)' % str(e))
+							ctr['retry'] = ctr.get('retry', 0) + 1
+						sleep(attempt + 1)
+						continue
+					with lock:
+						if not connected and workers[0] > 1:
+							workers[0] -= 1
+							queue.put(entry)
+							return
+						print(msg_prefix, 'Error:', str(e))
+						ctr['failed'] = ctr.get('failed', 0) + 1
+	finally:
+		if ftp is not None:
+			try: ftp.quit()
+			except Exception: ftp.close()
+
+def sendFiles(source_dir, title_id, ip, port, user, passwd, force_override = False, connections = CONNECTIONS):
+	""" Sends the ExeFS and RomFS files of the given [source_dir] to the 3DS
+		using the given number of [connections] at the same time.
+		Small files are sent first, large files on dedicated connections.
+	"""
 	try:
-		with FTP(timeout = 5) as ftp:
-			# connect and login
-			if VERBOSE >= 1: print('Connect to \'%s:%d\'' % (ip, port))
-			tmp = ftp.connect(host = ip, port = port)
-			if VERBOSE >= 1: print('>>', tmp)
-			if user:
-				if VERBOSE >= 1: print('Login as \'%s\'' % user)
-				tmp = ftp.login(user = user, passwd = passwd)
-				if VERBOSE >= 1: print('>>', tmp)
+		try: connections = int(connections)
+		except (TypeError, ValueError): raise ValueError('Invalid number of connections: %r' % (connections,))
+		if connections < 1: raise ValueError('Invalid number of connections: %d' % connections)
+		
+		with connect(ip, port, user, passwd, verbose = VERBOSE >= 1) as ftp:
 			print()
 			
 			# for exefs and romfs
 			ctr = dict()
+			small_files, large_files = list(), list()
 			for src_fs, name_fs, dest_fs in [('ExtractedExeFS', 'ExeFS', None), ('ExtractedRomFS', 'RomFS', 'romfs')]:
 				
 				# enter basepath
@@ -48,12 +139,13 @@ def sendFiles(source_dir, title_id, ip, port, user, passwd, force_override = Fal
 				# for all source files
 				for src_filename in [join(dp, f) for dp, _, fn in walk(join(source_dir, src_fs)) for f in fn]:
 					# calculate path and filename
-					dest_path, dest_filename = (tuple(normpath(src_filename).split(sep)[2:-1]), basename(src_filename))
+					dest_path = tuple(normpath(relpath(src_filename, join(source_dir, src_fs))).split(sep)[:-1])
+					dest_filename = basename(src_filename)
 					msg_prefix = ' * %s:' % dest_filename
 					
-					# enter path if different
+					# create path if different
 					if PATH != basepath + dest_path:
-						if VERBOSE >= 1: print('/'.join(dest_path) if dest_path else name_fs)
+						if VERBOSE >= 2: print('/'.join(dest_path) if dest_path else name_fs)
 						ftp.cwd('/' + '/'.join(basepath))
 						createAndEnterPath(ftp, dest_path)
 						PATH = basepath + dest_path
@@ -69,22 +161,43 @@ def sendFiles(source_dir, title_id, ip, port, user, passwd, force_override = Fal
 								ctr['keep'] = ctr.get('keep', 0) + 1
 								continue
 					
-					# send file
-					with open(src_filename, 'rb') as file:
-						if VERBOSE >= 1: print(msg_prefix, 'send')
-						ctr['send'] = ctr.get('send', 0) + 1
-						ftp.storbinary('STOR %s' % dest_filename, file)
+					# queue file
+					size = getsize(src_filename)
+					entry = (src_filename, '/' + '/'.join(PATH + (dest_filename,)), size)
+					(large_files if size >= LARGE_FILE else small_files).append(entry)
 			
 			# quit connection
 			print()
 			print('Disconnect')
 			print('>>', ftp.quit())
-			
-			# summary
-			print()
-			if VERBOSE >= 1: print('Sent %d files.' % ctr.get('send', 0))
-			if VERBOSE >= 2: print('Kept %d files.' % ctr.get('keep', 0))
-			
+		
+		# send small files first, large files on dedicated connections
+		small_queue, large_queue = Queue(), Queue()
+		for entry in sorted(small_files, key=lambda x: x[2]): small_queue.put(entry)
+		for entry in sorted(large_files, key=lambda x: x[2]): large_queue.put(entry)
+		connections = max(1, min(connections, len(small_files) + len(large_files)))
+		dedicated = min(len(large_files), connections // 2) if connections > 1 else 0
+		if VERBOSE >= 1 and small_files + large_files: print('Send %d files using %d connections' % (len(small_files) + len(large_files), connections))
+		lock = Lock()
+		workers = [connections]
+		start = perf_counter()
+		threads = list()
+		for i in range(connections):
+			queues = [large_queue, small_queue] if i < dedicated else [small_queue, large_queue]
+			threads.append(Thread(target=sendQueued, args=(queues, ip, port, user, passwd, ctr, lock, workers), daemon=True))
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		duration = perf_counter() - start
+		
+		# summary
+		print()
+		if VERBOSE >= 1:
+			print('Sent %d files.' % ctr.get('send', 0))
+			if ctr.get('send'): print('Sent %.2f MB in %.2fs (%.2f MB/s).' % (ctr['bytes'] / 1e6, duration, ctr['bytes'] / 1e6 / max(duration, 1e-6)))
+			if ctr.get('retry'): print('Retried %d times.' % ctr['retry'])
+		if VERBOSE >= 2: print('Kept %d files.' % ctr.get('keep', 0))
+		if ctr.get('failed'): print('Error: Failed to send %d files.' % ctr['failed'])
+	
 	except Exception as e:
 		print()
 		print('Error:', str(e))
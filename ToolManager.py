@@ -3,26 +3,43 @@
 <<<
 """
 
-from os import remove, rename, chmod, stat
-from os.path import join, exists, basename, dirname, splitext, abspath
+from os import remove, rename, replace, chmod, stat, makedirs, link
+from os.path import join, exists, basename, dirname, splitext, abspath, expanduser
 from stat import S_IXUSR, S_IXGRP, S_IXOTH
-from subprocess import run, PIPE, STDOUT
-from zipfile import ZipFile
-from tarfile import open as TarFile
-from io import BytesIO
-from urllib.request import urlopen
+from shutil import copy2, rmtree
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, get_ident
+import json
 import re
-import ssl
 
-def checkTool(tool, target_version, args = ''):
+from CacheManager import hashSHA256
+from ProcessManager import runTool
+
+TOOL_DIR = join(expanduser('~'), '.translationtoolkit', 'tools')
+
+def checkTool(tool, target_version, args = '', cache = None):
 	""" Checks the version of the given [tool] by calling it using
 		the given [args] and returns true if the version matches
 		the [target_version], false otherwise.
+		If a [cache] dict is given, the detected version is stored in it
+		together with the size and modification time of the executable
+		and the tool is only called again if the executable changed.
 	"""
-	proc = run(' '.join(('"%s"' % abspath(tool), args)), shell=True, stdout=PIPE, stderr=STDOUT, stdin=PIPE)
-	output = proc.stdout.decode('UTF-8', errors='replace')
+	path = abspath(tool)
+	if not exists(path): return False
+	info = stat(path)
+	signature = [info.st_size, info.st_mtime_ns]
+	
+	# use cached version if the executable is unchanged
+	if cache is not None and cache.get(path, [None])[:2] == signature:
+		return cache[path][2] == target_version
+	
+	# a corrupt or non-executable file is provided again
+	try: output = runTool([path] + args.split(), timeout=60, check=False)
+	except OSError: return False
 	match = re.search(r'\d+(\.\d+)+\w*', output)
 	version = match.group() if match else None
+	if cache is not None: cache[path] = signature + [version]
 	return version == target_version
 
 def downloadTool(download_url, filename):
@@ -30,6 +47,12 @@ def downloadTool(download_url, filename):
 		puts it in the current directory and renames it to [filename].
 		If the download is a zip or tar file it uses the first executable found in the archive.
 	"""
+	from zipfile import ZipFile
+	from tarfile import open as TarFile
+	from io import BytesIO
+	from urllib.request import urlopen
+	import ssl
+	
 	# get type and download data
 	print('Downloading', basename(download_url))
 	print(' ', 'from', download_url)
@@ -79,3 +102,91 @@ def downloadTool(download_url, filename):
 	# success
 	print('Downloaded', filename)
 	print()
+
+
+###########
+## Cache ##
+###########
+
+class ToolCache:
+	""" A cache of downloaded tools shared by all workspaces.
+		Every tool is stored once per version and platform together with its SHA-256 checksum
+		and linked into the workspaces as a hardlink, so the files must never be modified in place.
+	"""
+	directory = TOOL_DIR
+	index = None
+	lock = Lock()
+	
+	def key(tool, version, platform): return '%s/%s/%s' % (tool, version, platform)
+	
+	def loadIndex():
+		if ToolCache.index is not None: return
+		try:
+			with open(join(ToolCache.directory, 'index.json'), 'r') as file: ToolCache.index = json.load(file)
+		except: ToolCache.index = dict()
+	
+	def saveIndex():
+		makedirs(ToolCache.directory, exist_ok=True)
+		index_file = join(ToolCache.directory, 'index.json')
+		with open(index_file + '.temp', 'w') as file: json.dump(ToolCache.index, file, indent=1)
+		replace(index_file + '.temp', index_file)
+	
+	def get(tool, version, platform):
+		""" Returns the cached executable of the given [tool] or None if it is not cached
+			or does not match its recorded checksum.
+		"""
+		with ToolCache.lock:
+			ToolCache.loadIndex()
+			entry = ToolCache.index.get(ToolCache.key(tool, version, platform))
+		if entry is None: return None
+		cached_file = join(ToolCache.directory, tool, version, platform, entry['exe'])
+		if not exists(cached_file) or hashSHA256(cached_file) != entry['sha256']: return None
+		return cached_file
+	
+	def add(tool, version, platform, download_url, exe):
+		""" Downloads the given [tool] from the given [download_url] to the cache
+			and returns the path of the cached executable [exe].
+		"""
+		cached_dir = join(ToolCache.directory, tool, version, platform)
+		temp_dir = '%s.%d.temp' % (cached_dir, get_ident())
+		try:
+			makedirs(temp_dir, exist_ok=True)
+			downloadTool(download_url, join(temp_dir, exe))
+			checksum = hashSHA256(join(temp_dir, exe))
+			makedirs(cached_dir, exist_ok=True)
+			replace(join(temp_dir, exe), join(cached_dir, exe))
+		finally: rmtree(temp_dir, ignore_errors=True)
+		with ToolCache.lock:
+			ToolCache.loadIndex()
+			ToolCache.index[ToolCache.key(tool, version, platform)] = {'exe': exe, 'url': download_url, 'sha256': checksum}
+			ToolCache.saveIndex()
+		return join(cached_dir, exe)
+
+def linkTool(cached_file, filename):
+	""" Links the given [cached_file] to [filename].
+		Falls back to copying if the destination does not support hardlinks.
+	"""
+	if dirname(filename): makedirs(dirname(filename), exist_ok=True)
+	if exists(filename): remove(filename)
+	try: link(cached_file, filename)
+	except OSError: copy2(cached_file, filename)
+
+def provideTools(tools, workers = 4):
+	""" Provides the given [tools], a list of (tool, version, platform, download_url, filename),
+		by linking them from the tool cache. Tools that are not cached are downloaded at the same time.
+		If a download fails and the file already exists, the old file is kept.
+	"""
+	def provide(tool, version, platform, download_url, filename):
+		cached_file = ToolCache.get(tool, version, platform)
+		if cached_file is None: cached_file = ToolCache.add(tool, version, platform, download_url, basename(filename))
+		else: print('Using cached', basename(filename), version)
+		linkTool(cached_file, filename)
+	
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [(filename, executor.submit(provide, tool, version, platform, download_url, filename)) for tool, version, platform, download_url, filename in tools]
+	for filename, future in futures:
+		try: future.result()
+		except Exception as e:
+			if not exists(filename): raise e
+			print('Error:', str(e))
+			print('Keep old', basename(filename))
@@ -15,16 +15,18 @@
 """
 
 from os import listdir, walk, sep, remove, rename, makedirs
-from os.path import join, exists, isdir, splitext, dirname, basename, normpath, abspath
+from os.path import join, exists, isdir, isfile, splitext, dirname, basename, normpath, abspath
 from shutil import copyfile
 from hashlib import md5
+from zlib import crc32
 import re
 from zipfile import ZipFile
 from gzip import GzipFile
 import json
 from BinJEditor.JTools import parseDecodingTable, parseBinJ, createBinJ, parseE, createE, parseDatJ, createDatJ, createTabJ, parseDatE, createDatE, parseTabE, createTabE, parseSpt, createSpt, invertDict
 from tempfile import gettempdir as tempdir
-from subprocess import run
+from CacheManager import Cache, Store, hash
+from ProcessManager import runTool, ToolError
 
 PARAMS_FILE = '.ttparams'
 
@@ -38,9 +40,12 @@ VERBOSE = 2
 
 class Params:
 	prms = None
+	signature = None
 	
 	def loadParams(force_reload = False):
-		if not force_reload and Params.prms is not None: return
+		signature = Cache.signature(PARAMS_FILE)
+		if not force_reload and Params.prms is not None and Params.signature == signature: return
+		Params.signature = signature
 		try:
 			with open(PARAMS_FILE, 'r') as file:
 				Params.prms = json.load(file)
@@ -141,11 +146,16 @@ class Params:
 ## Helper ##
 ############
 
-def hash(file):
-	""" Calculates the MD5 hash of the given file. """
-	hasher = md5()
-	with open(file, 'rb') as f: hasher.update(f.read())
-	return hasher.digest()
+def hashCRC(file):
+	""" Calculates the CRC32 checksum of the given file as used by zip archives.
+		The checksum is cached until the file changes.
+	"""
+	def crcFile(file):
+		crc = 0
+		with open(file, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), b''): crc = crc32(chunk, crc)
+		return crc
+	return Cache.get('crc32', file, crcFile)
 
 def hashZip(zipfile):
 	hasher = md5()
@@ -155,6 +165,26 @@ def hashZip(zipfile):
 			hasher.update(zip.read(filename))
 	return hasher.digest()
 
+def parseFile(file, mode):
+	""" Parses the given .binJ or .e [file] depending on the given [mode]
+		and returns the data and extra values.
+		The result is cached until the file or the separator token changes.
+	"""
+	def parse(file):
+		if mode == 'binJ':
+			with open(file, 'rb') as f: bin = f.read()
+			return parseBinJ(bin, Params.SEP())
+		elif mode == 'e':
+			with GzipFile(file, 'r') as f: bin = f.read()
+			return parseE(bin, Params.SEP())
+	return Cache.get(('parse', mode, Params.SEP()), file, parse)
+
+def workspaceFolders():
+	""" Returns the folders in the current workspace.
+		The list is cached until the workspace directory changes.
+	"""
+	return Cache.get('workspace', '.', lambda dir: [d for d in listdir(dir) if isdir(join(dir, d))])
+
 def extpath(path):
 	return normpath(path).split(sep)[1:]
 
@@ -173,6 +203,63 @@ def joinFolder(folder, language, version = None):
 	if language: name += '_' + language
 	return name
 
+class Originals:
+	sources = dict() # version -> cia folder
+	images = dict() # (cia folder, section) -> RomFS image or None
+	
+	def setSource(version, cia_dir):
+		""" Registers the given [cia_dir] as the source of the original files of the given [version]. """
+		if cia_dir: Originals.sources[version] = cia_dir
+	
+	def openImage(cia_dir, parent):
+		""" Returns the RomFS image of the given [cia_dir] containing the given [parent] folder
+			and the path of the folder in the image, or None if the folder is not part of an image.
+			Every image is opened once and kept open until closeImages is called.
+		"""
+		from ContainerManager import openImage
+		section, *path = normpath(parent).split(sep)
+		key = (cia_dir, section)
+		if key not in Originals.images:
+			image = openImage(cia_dir, section)
+			Originals.images[key] = image[0] if image is not None else None
+		image = Originals.images[key]
+		if image is None: return None
+		return image, '/'.join(path)
+	
+	def closeImages():
+		""" Closes all images opened by openImage. """
+		for image in Originals.images.values():
+			if image is not None: image.close()
+		Originals.images.clear()
+
+def fetchOriginal(orig_file):
+	""" Returns true if the given original file exists.
+		If it is missing, it is copied from the registered cia folder of its version first,
+		or read from its RomFS image if the folder was not extracted.
+	"""
+	if exists(orig_file): return True
+	parts = normpath(orig_file).split(sep)
+	info = splitFolder(parts[0])
+	cia_dir = Originals.sources.get(info.get('version'))
+	parent = Params.parentFolders().get(info['folder'])
+	if cia_dir is None or parent is None: return False
+	source_file = join(cia_dir, parent, *parts[1:])
+	if not isfile(source_file):
+		# read the file from the RomFS image if the folder was not extracted
+		image = Originals.openImage(cia_dir, parent)
+		if image is None: return False
+		image, prefix = image
+		path = '/'.join(([prefix] if prefix else []) + parts[1:])
+		if path not in image.files(): return False
+		if VERBOSE >= 2: print(' +', 'Fetch original file:', join(*parts[1:]))
+		makedirs(dirname(orig_file), exist_ok=True)
+		with image.read(path) as data, open(orig_file, 'wb') as file: file.write(data)
+		return True
+	if VERBOSE >= 2: print(' +', 'Fetch original file:', join(*parts[1:]))
+	makedirs(dirname(orig_file), exist_ok=True)
+	copyfile(source_file, orig_file)
+	return True
+
 def loopFiles(folders, original_language = None):
 	""" Loops over the files in the folders with the given names that
 		match the given file types.
@@ -181,7 +268,7 @@ def loopFiles(folders, original_language = None):
 		corresponding original folder.
 	"""
 	if original_language:
-		directories = [splitFolder(dir) for dir in listdir('.') if isdir(dir)]
+		directories = [splitFolder(dir) for dir in workspaceFolders()]
 		# iterate over all defined folders
 		for folder, types in folders.items():
 			versions = {dir.get('version') for dir in directories if dir['folder'] == folder and dir.get('lang') == original_language}
@@ -202,7 +289,7 @@ def loopFiles(folders, original_language = None):
 	else:
 		for folder, types in folders.items():
 			# iterate over all languages found
-			for edit_folder in [dir for dir in listdir('.') if isdir(dir) and splitFolder(dir)['folder'] == folder]:
+			for edit_folder in [dir for dir in workspaceFolders() if splitFolder(dir)['folder'] == folder]:
 				if VERBOSE >= 1: print(edit_folder, end=' ', flush=True)
 				
 				# iterate over all files with a valid file extension
@@ -217,13 +304,16 @@ def loopFiles(folders, original_language = None):
 ###########
 
 def applyPatches(xdelta, original_language = 'JA', force_override = False):
-	ctr  = applyPatPatches(original_language, force_override)
-	ctr2 = applyXDeltaPatches(xdelta, original_language, force_override)
+	try:
+		ctr  = applyPatPatches(original_language, force_override)
+		ctr2 = applyXDeltaPatches(xdelta, original_language, force_override)
+	finally: Originals.closeImages()
 	for k, v in ctr2.items(): ctr[k] = ctr.get(k, 0) + v
 	print()
 	if VERBOSE >= 1 and ctr.get('create', 0) > 0 or VERBOSE >= 3: print('Created %d files.' % ctr.get('create', 0))
 	if VERBOSE >= 1: print('Updated %d files.' % ctr.get('update', 0))
 	if VERBOSE >= 3: print('Kept %d files.' % ctr.get('keep',   0))
+	if ctr.get('failed'): print('Error: Failed to apply %d patches.' % ctr['failed'])
 
 def applyPatPatches(original_language, force_override):
 	""" Creates .binJ files from .patJ patches and the original .binJ file.
@@ -235,12 +325,7 @@ def applyPatPatches(original_language, force_override):
 	def applyPatToFile(orig_file, patch_file, output_file, mode):
 		# read original file
 		try:
-			if mode == 'binJ':
-				with open(orig_file, 'rb') as file: bin = file.read()
-				orig_data, extra = parseBinJ(bin, Params.SEP())
-			elif mode == 'e':
-				with GzipFile(orig_file, 'r') as file: bin = file.read()
-				orig_data, extra = parseE(bin, Params.SEP())
+			orig_data, extra = parseFile(orig_file, mode)
 		except:
 			print(' !', 'Error: Parsing %s file failed:' % mode, join(*extpath(orig_file)))
 			return
@@ -327,7 +412,7 @@ def applyPatPatches(original_language, force_override):
 		
 		# find corresponding original file
 		orig_file = join(orig_folder, *simplename[:-1], splitext(simplename[-1])[0] + ext_orig)
-		if not exists(orig_file):
+		if not fetchOriginal(orig_file):
 			if VERBOSE >= 2: print(' !', 'Warning: Original file not found:', join(*extpath(orig_file)))
 			continue
 		
@@ -380,11 +465,23 @@ def applyPatPatches(original_language, force_override):
 				rename(temp_output_save_file, output_save_file)
 	return ctr
 
+def printToolError(message, error):
+	""" Prints the given [message] and the output of the tool contained in the ToolError [error] as a warning. """
+	print(' !', 'Warning:', message)
+	for line in str(error).strip().splitlines(): print(' !', '  ', line)
+
 def applyXDeltaPatches(xdelta, original_language, force_override):
 	""" Creates .* files from .*.xdelta patches and the original .* files. """
 	
-	def applyXDelta(orig_file, patch_file, output_file):
-		run([abspath(xdelta), '-f', '-d', '-s', orig_file, patch_file, output_file])
+	def applyXDelta(orig_file, patch_file, output_file, simplename):
+		""" Returns true if the patch was applied, otherwise prints the output of xdelta and returns false. """
+		try: runTool([abspath(xdelta), '-f', '-d', '-s', orig_file, patch_file, output_file])
+		except ToolError as e:
+			if exists(output_file): remove(output_file)
+			printToolError('Failed to apply patch: %s' % join(*simplename), e)
+			ctr['failed'] = ctr.get('failed', 0) + 1
+			return False
+		return True
 	
 	ctr = dict()
 	folders = dict(zip(Params.xdeltaFolders().keys(), ['.xdelta']*len(Params.xdeltaFolders())))
@@ -395,7 +492,7 @@ def applyXDeltaPatches(xdelta, original_language, force_override):
 		
 		# find corresponding original file
 		orig_file = join(orig_folder, *simplename)
-		if not exists(orig_file):
+		if not fetchOriginal(orig_file):
 			print(' !', 'Warning: Original file not found:', join(*simplename))
 			continue
 		
@@ -406,7 +503,7 @@ def applyXDeltaPatches(xdelta, original_language, force_override):
 		if exists(output_file):
 			# create temporary output file
 			temp_output_file = output_file + '.temp'
-			applyXDelta(orig_file, patch_file, temp_output_file)
+			if not applyXDelta(orig_file, patch_file, temp_output_file, simplename): continue
 			# compare output files
 			if not force_override and hash(output_file) == hash(temp_output_file):
 				# equal -> keep old output file
@@ -421,9 +518,9 @@ def applyXDeltaPatches(xdelta, original_language, force_override):
 				rename(temp_output_file, output_file)
 		else:
 			# create new output file
+			if not applyXDelta(orig_file, patch_file, output_file, simplename): continue
 			if VERBOSE >= 2: print(msg_prefix, 'create')
 			ctr['create'] = ctr.get('create', 0) + 1
-			applyXDelta(orig_file, patch_file, output_file)
 	return ctr
 
 
@@ -432,8 +529,10 @@ def applyXDeltaPatches(xdelta, original_language, force_override):
 ############
 
 def createPatches(xdelta, original_language = 'JA', force_override = False):
-	ctr  = createPatPatches(original_language, force_override)
-	ctr2 = createXDeltaPatches(xdelta, original_language, force_override)
+	try:
+		ctr  = createPatPatches(original_language, force_override)
+		ctr2 = createXDeltaPatches(xdelta, original_language, force_override)
+	finally: Originals.closeImages()
 	for k, v in ctr2.items(): ctr[k] = ctr.get(k, 0) + v
 	print()
 	if VERBOSE >= 1 and ctr.get('create', 0) > 0 or VERBOSE >= 3: print('Created %d patches.' % ctr.get('create', 0))
@@ -441,6 +540,7 @@ def createPatches(xdelta, original_language = 'JA', force_override = False):
 	if VERBOSE >= 1 and ctr.get('delete', 0) > 0 or VERBOSE >= 3: print('Deleted %d patches.' % ctr.get('delete', 0))
 	if VERBOSE >= 3: print('Kept %d patches.' % ctr.get('keep',   0))
 	if VERBOSE >= 3: print('Skipped %d files.' % ctr.get('skip',   0))
+	if ctr.get('failed'): print('Error: Failed to create %d patches.' % ctr['failed'])
 
 def createPatPatches(original_language, force_override):
 	""" Creates .patJ patches from .savJ files or pairs of .binJ files.
@@ -460,12 +560,7 @@ def createPatPatches(original_language, force_override):
 	def createPatFromOrigAndEdit(orig_file, edit_file, patch_file, mode):
 		def readFile(file):
 			try:
-				if mode == 'binJ':
-					with open(file, 'rb') as file: bin = file.read()
-					return parseBinJ(bin, Params.SEP())
-				elif mode == 'e':
-					with GzipFile(file, 'r') as file: bin = file.read()
-					return parseE(bin, Params.SEP())
+				return parseFile(file, mode)
 			except:
 				print(' !', 'Error: Parsing %s file failed:' % mode, join(*extpath(file)))
 				return None, None
@@ -502,7 +597,7 @@ def createPatPatches(original_language, force_override):
 	
 	def collectFiles(folder, ext_orig, ext_save):
 		# find directories matching the given folder
-		directories = [splitFolder(dir) for dir in listdir('.') if isdir(dir)]
+		directories = [splitFolder(dir) for dir in workspaceFolders()]
 		versions = {dir.get('version') for dir in directories if dir['folder'] == folder and dir.get('lang') == original_language}
 		if not versions: return
 		
@@ -538,7 +633,7 @@ def createPatPatches(original_language, force_override):
 			if type == ext_orig:
 				# define orig file
 				orig_file = join(orig_folder, shortname + type)
-				if not exists(orig_file):
+				if not fetchOriginal(orig_file):
 					if VERBOSE >= 2: print(' !', 'Warning: Original file not found:', shortname + type)
 					return
 				
@@ -589,8 +684,15 @@ def createPatPatches(original_language, force_override):
 def createXDeltaPatches(xdelta, original_language, force_override):
 	""" Creates .*.xdelta patches from pairs of .* files. """
 	
-	def createXDelta(orig_file, edit_file, patch_file):
-		run([abspath(xdelta), '-f', '-s', orig_file, edit_file, patch_file])
+	def createXDelta(orig_file, edit_file, patch_file, simplename):
+		""" Returns true if the patch was created, otherwise prints the output of xdelta and returns false. """
+		try: runTool([abspath(xdelta), '-f', '-s', orig_file, edit_file, patch_file])
+		except ToolError as e:
+			if exists(patch_file): remove(patch_file)
+			printToolError('Failed to create patch: %s' % join(*simplename[:-1], simplename[-1]+'.xdelta'), e)
+			ctr['failed'] = ctr.get('failed', 0) + 1
+			return False
+		return True
 	
 	ctr = dict()
 	for _, edit_file, orig_folder in loopFiles(Params.xdeltaFolders(), original_language):
@@ -599,7 +701,7 @@ def createXDeltaPatches(xdelta, original_language, force_override):
 		
 		# find corresponding original file
 		orig_file = join(orig_folder, *simplename)
-		if not exists(orig_file):
+		if not fetchOriginal(orig_file):
 			if VERBOSE >= 2: print(' !', 'Warning: Original file not found:', join(*simplename))
 			continue
 		
@@ -622,7 +724,7 @@ def createXDeltaPatches(xdelta, original_language, force_override):
 		if exists(patch_file):
 			# create temporary patch
 			temp_patch_file = patch_file + '.temp'
-			createXDelta(orig_file, edit_file, temp_patch_file)
+			if not createXDelta(orig_file, edit_file, temp_patch_file, simplename): continue
 			# compare patches
 			if not force_override and hash(patch_file) == hash(temp_patch_file):
 				# equal -> keep old patch
@@ -637,9 +739,9 @@ def createXDeltaPatches(xdelta, original_language, force_override):
 				rename(temp_patch_file, patch_file)
 		else:
 			# create new patch
+			if not createXDelta(orig_file, edit_file, patch_file, simplename): continue
 			if VERBOSE >= 2: print(msg_prefix, 'create')
 			ctr['create'] = ctr.get('create', 0) + 1
-			createXDelta(orig_file, edit_file, patch_file)
 	return ctr
 
 
@@ -711,16 +813,14 @@ def distributeBinJAndEFiles(languages, versions, original_language, destination_
 		# binJ -> read orig data and extra
 		elif ext == '.binJ':
 			try:
-				with open(filename, 'rb') as file: bin = file.read()
-				return parseBinJ(bin, Params.SEP())
+				return parseFile(filename, 'binJ')
 			except:
 				print(' !', 'Error: Parsing .binJ file failed.')
 				return None, None
 		# e -> read orig data and extra
 		elif ext == '.e':
 			try:
-				with GzipFile(filename, 'r') as file: bin = file.read()
-				return parseE(bin, Params.SEP())
+				return parseFile(filename, 'e')
 			except:
 				print(' !', 'Error: Parsing .e file failed.')
 				return None, None
@@ -923,7 +1023,7 @@ def createSaves(table_file, original_language = 'JA', force_override = False):
 		
 		# find corresponding original file
 		orig_file = join(orig_folder, *simplename[:-1], splitext(simplename[-1])[0] + ext_orig)
-		if not exists(orig_file):
+		if not fetchOriginal(orig_file):
 			if VERBOSE >= 2: print(' !', 'Warning: Original file not found:', join(*extpath(orig_file)))
 			continue
 		
@@ -949,12 +1049,7 @@ def createSaves(table_file, original_language = 'JA', force_override = False):
 		
 		# read original file
 		try:
-			if mode == 'binJ':
-				with open(orig_file, 'rb') as file: bin = file.read()
-				orig_data, extra = parseBinJ(bin, Params.SEP())
-			elif mode == 'e':
-				with GzipFile(orig_file, 'r') as file: bin = file.read()
-				orig_data, extra = parseE(bin, Params.SEP())
+			orig_data, extra = parseFile(orig_file, mode)
 		except:
 			print(' !', 'Error: Parsing %s file failed:' % mode, join(*extpath(orig_file)))
 			return
@@ -1045,6 +1140,7 @@ def createSaves(table_file, original_language = 'JA', force_override = False):
 			remove(header_filename)
 			remove(scripts_filename)
 			remove(links_filename)
+	Originals.closeImages()
 	
 	print()
 	if VERBOSE >= 1 and ctr.get('create', 0) > 0 or VERBOSE >= 3: print('Created %d files.' % ctr.get('create', 0))
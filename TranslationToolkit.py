@@ -3,34 +3,26 @@
 <<<
 """
 
-from os import system, listdir, getenv, name as os_name
+from os import system, listdir, getenv, replace, fsync, stat, name as os_name
 from os.path import join, splitext, exists, isfile, isdir
-from shutil import rmtree
-from tempfile import mkdtemp
 import json
-import webbrowser
-from urllib.request import urlopen
 import platform
-import ssl
-import re
-
-from TranslationPatcher import applyPatches, createPatches, distribute, createSaves
-from SendViaFTP import sendFiles as sendFilesViaFTP
-from SendToCitra import sendFiles as sendFilesToCitra
-from FileReplacer import replaceFiles
-from WorkspaceManager import downloadAndExtractPatches, extractPatches, doUpdateActions, copyOriginalFiles
-from WorkspaceManager import copyPatchedFiles, prepareReleasePatches, createReleasePatches
-from ToolManager import checkTool, downloadTool
-from GameManager import extractGame, rebuildGame
+from threading import Thread
+from time import time
+
+# the scripts import their modules when they are called to keep the startup fast
 
 CONFIG_FILE = 'tt-config.json'
+LEDGER_FILE = 'tt-ledger.json'
 
 VERSION = 'v2.7.3'
 REPOSITORY = r'Ich73/TranslationToolkit'
+UPDATE_URL = r'https://api.github.com/repos/%s/releases/latest' % REPOSITORY
 
 TOOLS = {
 	'xdelta': {
 		'version': '3.1.0',
+		'args': '-V',
 		'win64': {'url': r'https://github.com/jmacd/xdelta-gpl/releases/download/v3.1.0/xdelta3-3.1.0-x86_64.exe.zip', 'exe': 'xdelta.exe'},
 		'win32': {'url': r'https://github.com/jmacd/xdelta-gpl/releases/download/v3.1.0/xdelta3-3.1.0-i686.exe.zip', 'exe': 'xdelta.exe'},
 		'linux64': {'url': r'https://github.com/Ich73/xdelta-LinuxBuilds/releases/download/v3.1.0/xdelta3-linux_x86_64.zip', 'exe': 'xdelta'},
@@ -67,56 +59,139 @@ if '64' in platform.machine(): opSys += '64'
 else: opSys += '32'
 
 # set windows taskbar icon
-try:
-	from ctypes import windll
-	appid = 'translationtoolkit.' + VERSION
-	windll.shell32.SetCurrentProcessExplicitAppUserModelID(appid)
-except: pass
+if opSys.startswith('win'):
+	try:
+		from ctypes import windll
+		appid = 'translationtoolkit.' + VERSION
+		windll.shell32.SetCurrentProcessExplicitAppUserModelID(appid)
+	except: pass
 
 # config
 class Config:
 	cfg = None
+	dirty = False
 	
 	def loadConfig():
 		if Config.cfg is not None: return
-		if not exists(CONFIG_FILE):
-			Config.cfg = dict()
-			return
+		Config.cfg = dict()
+		if not exists(CONFIG_FILE): return
 		try:
 			with open(CONFIG_FILE, 'r') as file:
-				Config.cfg = json.load(file)
-		except:
-			Config.cfg = dict()
+				Config.cfg = Config.parseConfig(file.read())
+		except: pass
+	
+	def parseConfig(data):
+		""" Parses the given config [data].
+			If the data is incomplete, all entries before the damaged part are kept.
+		"""
+		try:
+			cfg = json.loads(data)
+			if isinstance(cfg, dict): return cfg
+		except ValueError: pass
+		
+		# parse entry by entry until the data ends
+		cfg = dict()
+		decoder = json.JSONDecoder()
+		def skip(pos, char = None):
+			while pos < len(data) and data[pos].isspace(): pos += 1
+			if char is None: return pos
+			if data[pos:pos+1] != char: raise ValueError('Expected %s' % char)
+			return skip(pos + 1)
+		try:
+			pos = skip(0, '{')
+			while True:
+				key, pos = decoder.raw_decode(data, pos)
+				value, pos = decoder.raw_decode(data, skip(pos, ':'))
+				cfg[key] = value
+				pos = skip(pos, ',')
+		except ValueError: pass
+		return cfg
 	
 	def saveConfig():
-		with open(CONFIG_FILE, 'w') as file:
+		""" Writes the config to disk if it changed.
+			The config is written to a temporary file first and renamed afterwards,
+			so an interrupted write never leaves a partial config file behind.
+		"""
+		if not Config.dirty: return
+		temp_file = CONFIG_FILE + '.temp'
+		with open(temp_file, 'w') as file:
 			json.dump(Config.cfg, file)
+			file.flush()
+			fsync(file.fileno())
+		replace(temp_file, CONFIG_FILE)
+		Config.dirty = False
 	
 	def get(key, default = None):
+		""" Returns the value of the given [key] or the [default] if it is not set.
+			Defaults other than None are stored, so they show up in the config file.
+		"""
 		Config.loadConfig()
 		value = Config.cfg.get(key)
 		if value is None:
-			Config.set(key, default)
+			if default is not None: Config.set(key, default)
 			return default
 		return value
 	
 	def set(key, value):
+		Config.loadConfig()
+		if key in Config.cfg and Config.cfg[key] is not value and Config.cfg[key] == value: return
 		Config.cfg[key] = value
-		Config.saveConfig()
+		Config.dirty = True
 
 
 #############
 ## Updates ##
 #############
 
+class Updates:
+	thread = None
+	result = None
+	shown = False
+	
+	def start(url = UPDATE_URL):
+		""" Starts checking the given [url] for the latest release on a background thread.
+			The network is only queried if the last check is older than the configured interval
+			and the last attempt is older than the retry interval, otherwise the cached result
+			of the last check is used. Every attempt is recorded, so failed checks are retried later.
+		"""
+		now = time()
+		interval = Config.get('update.interval', 24*60*60)
+		retry_interval = Config.get('update.retryInterval', 60*60)
+		if now - Config.get('update.lastCheck', 0) < interval or now - Config.get('update.lastAttempt', 0) < retry_interval:
+			Updates.result = Config.get('update.result')
+			return
+		Config.set('update.lastAttempt', now)
+		Updates.thread = Thread(target=Updates.query, args=(url,), daemon=True)
+		Updates.thread.start()
+	
+	def query(url):
+		""" Queries the given [url] for the latest release and stores its tag and link. """
+		from urllib.request import urlopen
+		import ssl
+		try:
+			with urlopen(url, timeout = 10, context=ssl._create_unverified_context()) as url:
+				data = json.loads(url.read().decode())
+			Updates.result = [data['tag_name'], data['html_url']]
+		except Exception: pass
+	
+	def ready():
+		""" Returns true if the background check finished.
+			The result of a successful check is stored in the config.
+		"""
+		if Updates.thread is None: return True
+		if Updates.thread.is_alive(): return False
+		Updates.thread = None
+		if Updates.result is not None:
+			Config.set('update.lastCheck', time())
+			Config.set('update.result', Updates.result)
+		return True
+
 def checkUpdates():
 	try:
-		# query api
-		latest = r'https://api.github.com/repos/%s/releases/latest' % REPOSITORY
-		with urlopen(latest, timeout = 1, context=ssl._create_unverified_context()) as url:
-			data = json.loads(url.read().decode())
-		tag = data['tag_name']
-		link = data['html_url']
+		# wait for the background check
+		if Updates.shown or not Updates.ready() or not Updates.result: return
+		Updates.shown = True
+		tag, link = Updates.result
 		
 		# compare versions
 		def ver2int(s):
@@ -148,31 +223,52 @@ def checkUpdates():
 		command = input('>> ').strip()
 		script = command.upper() if command else ''
 		
-		if script == 'D': webbrowser.open(link)
+		if script == 'D':
+			import webbrowser
+			webbrowser.open(link)
 		elif script == 'C': pass
 		elif script == 'I': Config.set('ignoreVersion', tag)
 	except Exception: pass
 
-def checkTools():
-	# check xdelta
-	version, url = Config.get('xdelta', (TOOLS['xdelta']['version'], TOOLS['xdelta'][opSys]['url']))
-	if not checkTool(TOOLS['xdelta'][opSys]['exe'], version, args = '-V'):
-		downloadTool(url, TOOLS['xdelta'][opSys]['exe'])
-	
-	# check 3dstool
-	version, url = Config.get('3dstool', (TOOLS['3dstool']['version'], TOOLS['3dstool'][opSys]['url']))
-	if not checkTool(TOOLS['3dstool'][opSys]['exe'], version):
-		downloadTool(url, TOOLS['3dstool'][opSys]['exe'])
-	
-	# check ctrtool
-	version, url = Config.get('ctrtool', (TOOLS['ctrtool']['version'], TOOLS['ctrtool'][opSys]['url']))
-	if not checkTool(TOOLS['ctrtool'][opSys]['exe'], version):
-		downloadTool(url, TOOLS['ctrtool'][opSys]['exe'])
-	
-	# check makerom
-	version, url = Config.get('makerom', (TOOLS['makerom']['version'], TOOLS['makerom'][opSys]['url']))
-	if not checkTool(TOOLS['makerom'][opSys]['exe'], version):
-		downloadTool(url, TOOLS['makerom'][opSys]['exe'])
+class Tools:
+	verified = dict() # tool -> [exe, size, mtime]
+	
+	def signature(exe):
+		""" Returns the size and modification time of the given [exe] or None if it does not exist. """
+		try: info = stat(exe)
+		except OSError: return None
+		return [info.st_size, info.st_mtime_ns]
+	
+	def require(*tools):
+		""" Verifies the executables of the given [tools] and provides missing or outdated ones
+			from the shared tool cache, downloading the ones that are not cached at the same time.
+			The version is verified at first use and the result is cached in the config,
+			so the tool is only called again if the executable changed.
+			Raises an exception if a tool cannot be provided in the required version.
+		"""
+		tools = [tool for tool in tools if tool not in Tools.verified or Tools.verified[tool][1:] != Tools.signature(Tools.verified[tool][0])]
+		if not tools: return
+		from ToolManager import checkTool, provideTools
+		cache = Config.get('tools.verified', dict())
+		missing = list()
+		for tool in tools:
+			exe = TOOLS[tool][opSys]['exe']
+			version, url = Config.get(tool, (TOOLS[tool]['version'], TOOLS[tool][opSys]['url']))
+			if not checkTool(exe, version, args=TOOLS[tool].get('args', ''), cache=cache): missing.append((tool, version, opSys, url, exe))
+		try:
+			if missing: provideTools(missing)
+			for tool, version, _, _, exe in missing:
+				if not checkTool(exe, version, args=TOOLS[tool].get('args', ''), cache=cache):
+					raise Exception('%s %s could not be provided.' % (tool, version))
+		finally: Config.set('tools.verified', cache)
+		for tool in tools:
+			exe = TOOLS[tool][opSys]['exe']
+			Tools.verified[tool] = [exe] + Tools.signature(exe)
+	
+	def get(tool):
+		""" Returns the executable of the given [tool]. """
+		Tools.require(tool)
+		return Tools.verified[tool][0]
 
 
 #############
@@ -180,19 +276,30 @@ def checkTools():
 #############
 
 def verifyStart():
+	Config.saveConfig()
 	command = 'n'
 	while command != 'y':
 		command = input('Start script? [y/n] ')
-		if command == 'n':
-			menu()
-			return False
+		if command == 'n': return False
 	print()
 	return True
 
 def showEnd():
+	from ProcessManager import Ledger
+	if Ledger.entries:
+		print()
+		print('Tool calls:')
+		Ledger.dump(LEDGER_FILE if Config.get('ledger', False) else None)
+		Ledger.clear()
 	print()
 	input('Press Enter to return to menu...')
-	menu()
+
+def setupOriginals():
+	""" Registers the CIA folders of the SW script, so missing original files can be copied on demand. """
+	from TranslationPatcher import Originals
+	Originals.closeImages() # images of an aborted run may be outdated
+	Originals.setSource(None, Config.get('SW.cia'))
+	for ver, dir in Config.get('SW.updates', list()): Originals.setSource(ver, dir)
 
 def askParamter(name, key, default = '', description = None, hide_fallback = False, fallback = None):
 	print('~', ' '.join(w.capitalize() if w[0].islower() else w for w in name.split()), '~')
@@ -205,15 +312,21 @@ def askParamter(name, key, default = '', description = None, hide_fallback = Fal
 	return command
 
 def AP(original_language, force_override):
+	from TranslationPatcher import applyPatches
+	
+	setupOriginals()
 	cls()
 	if not verifyStart(): return
-	applyPatches(xdelta=TOOLS['xdelta'][opSys]['exe'], original_language=original_language, force_override=force_override)
+	applyPatches(xdelta=Tools.get('xdelta'), original_language=original_language, force_override=force_override)
 	showEnd()
 
 def CP(original_language, force_override):
+	from TranslationPatcher import createPatches
+	
+	setupOriginals()
 	cls()
 	if not verifyStart(): return
-	createPatches(xdelta=TOOLS['xdelta'][opSys]['exe'], original_language=original_language, force_override=force_override)
+	createPatches(xdelta=Tools.get('xdelta'), original_language=original_language, force_override=force_override)
 	showEnd()
 
 def _D():
@@ -252,6 +365,9 @@ def _D():
 	return (languages, version, destination_dir)
 
 def D(original_language, force_override):
+	from TranslationPatcher import distribute
+	
+	setupOriginals()
 	cls()
 	
 	languages, version, destination_dir = _D()
@@ -303,6 +419,8 @@ def _S():
 	return (title_id, ip, port, user, passwd)
 
 def S(force_override):
+	from SendViaFTP import sendFiles as sendFilesViaFTP
+	
 	cls()
 	
 	while True:
@@ -321,10 +439,14 @@ def S(force_override):
 	print()
 	
 	if not verifyStart(): return
-	sendFilesViaFTP(source_dir=source_dir, title_id=title_id, ip=ip, port=port, user=user, passwd=passwd, force_override=force_override)
+	sendFilesViaFTP(source_dir=source_dir, title_id=title_id, ip=ip, port=port, user=user, passwd=passwd, force_override=force_override, connections=Config.get('S.connections', 3))
 	showEnd()
 
 def DS(original_language, force_override):
+	from TranslationPatcher import distribute
+	from SendViaFTP import sendFiles as sendFilesViaFTP
+	
+	setupOriginals()
 	cls()
 	
 	languages, version, destination_dir = _D()
@@ -344,7 +466,7 @@ def DS(original_language, force_override):
 	print()
 	print()
 	print('~~ Send via FTP ~~')
-	sendFilesViaFTP(source_dir=destination_dir, title_id=title_id, ip=ip, port=port, user=user, passwd=passwd, force_override=force_override)
+	sendFilesViaFTP(source_dir=destination_dir, title_id=title_id, ip=ip, port=port, user=user, passwd=passwd, force_override=force_override, connections=Config.get('S.connections', 3))
 	
 	showEnd()
 
@@ -370,6 +492,8 @@ def _SC():
 	return (title_id, citra_dir)
 
 def SC(force_override):
+	from SendToCitra import sendFiles as sendFilesToCitra
+	
 	cls()
 	
 	while True:
@@ -393,6 +517,10 @@ def SC(force_override):
 	showEnd()
 
 def DSC(original_language, force_override):
+	from TranslationPatcher import distribute
+	from SendToCitra import sendFiles as sendFilesToCitra
+	
+	setupOriginals()
 	cls()
 	
 	languages, version, destination_dir = _D()
@@ -417,7 +545,10 @@ def DSC(original_language, force_override):
 	
 	showEnd()
 
-def SW(original_language, force_override):
+def SW(original_language, force_override, shared_store):
+	from TranslationPatcher import applyPatches
+	from WorkspaceManager import downloadAndExtractPatches, extractPatches, doUpdateActions, copyOriginalFiles
+	
 	cls()
 	
 	download_url_or_zip_file = askParamter(
@@ -461,26 +592,44 @@ def SW(original_language, force_override):
 			if isdir(update_cia_dir): break
 		updates.append((update_ver, update_cia_dir))
 	Config.set('SW.updates', updates)
+	setupOriginals()
+	
+	while True:
+		copy_mode = askParamter(
+			name = 'copy mode',
+			description = [
+				'Enter \'all\' to copy all original files of the patched folders,',
+				'or \'patched\' to only copy the original files needed by the patches in the workspace.',
+				'Missing original files are copied from the CIA folders when a script needs them.'
+			],
+			key = 'SW.copymode',
+			default = 'all'
+		)
+		if copy_mode in ['all', 'patched']: break
 	
 	print('CIA Folder:', cia_dir)
 	if is_download_url: print('Download URL:', download_url_or_zip_file)
 	else: print('Zip File:', download_url_or_zip_file)
 	for ver, dir in updates:
 		print('Update %s Folder:' % ver, dir)
+	print('Copy Mode:', copy_mode)
+	if shared_store: print('Shared Store:', 'yes')
 	print()
 	
 	if not verifyStart(): return
 	
+	cache = Config.get('UW.cache', dict())
 	if is_download_url:
 		print('~~ Download Patches ~~')
-		if not downloadAndExtractPatches(download_url_or_zip_file):
+		if not downloadAndExtractPatches(download_url_or_zip_file, cache=cache):
 			showEnd()
 			return
 	else:
 		print('~~ Extract Patches ~~')
-		if not extractPatches(download_url_or_zip_file):
+		if not extractPatches(download_url_or_zip_file, cache=cache):
 			showEnd()
 			return
+	Config.set('UW.cache', cache)
 	
 	print()
 	print()
@@ -490,7 +639,7 @@ def SW(original_language, force_override):
 	print()
 	print()
 	print('~~ Copy Original Files ~~')
-	if not copyOriginalFiles(cia_dir, version=None, original_language=original_language):
+	if not copyOriginalFiles(cia_dir, version=None, original_language=original_language, selective=copy_mode == 'patched', store=shared_store):
 		showEnd()
 		return
 	
@@ -498,18 +647,22 @@ def SW(original_language, force_override):
 		print()
 		print()
 		print('~~ Copy Update %s Files ~~' % ver)
-		if not copyOriginalFiles(dir, version=ver, original_language=original_language):
+		if not copyOriginalFiles(dir, version=ver, original_language=original_language, selective=copy_mode == 'patched', store=shared_store):
 			showEnd()
 			return
 	
 	print()
 	print()
 	print('~~ Apply Patches ~~')
-	applyPatches(xdelta=TOOLS['xdelta'][opSys]['exe'], original_language=original_language, force_override=force_override)
+	applyPatches(xdelta=Tools.get('xdelta'), original_language=original_language, force_override=force_override)
 	
 	showEnd()
 
 def UW(original_language, force_override):
+	from TranslationPatcher import applyPatches
+	from WorkspaceManager import downloadAndExtractPatches, extractPatches, doUpdateActions
+	
+	setupOriginals()
 	cls()
 	
 	download_url_or_zip_file = askParamter(
@@ -525,16 +678,18 @@ def UW(original_language, force_override):
 	
 	if not verifyStart(): return
 	
+	cache = Config.get('UW.cache', dict())
 	if is_download_url:
 		print('~~ Download Patches ~~')
-		if not downloadAndExtractPatches(download_url_or_zip_file):
+		if not downloadAndExtractPatches(download_url_or_zip_file, cache=cache):
 			showEnd()
 			return
 	else:
 		print('~~ Extract Patches ~~')
-		if not extractPatches(zip_file=download_url_or_zip_file):
+		if not extractPatches(zip_file=download_url_or_zip_file, cache=cache):
 			showEnd()
 			return
+	Config.set('UW.cache', cache)
 	
 	print()
 	print()
@@ -544,11 +699,17 @@ def UW(original_language, force_override):
 	print()
 	print()
 	print('~~ Apply Patches ~~')
-	applyPatches(xdelta=TOOLS['xdelta'][opSys]['exe'], original_language=original_language, force_override=force_override)
+	applyPatches(xdelta=Tools.get('xdelta'), original_language=original_language, force_override=force_override)
 	
 	showEnd()
 
-def RP(original_language):
+def RP(original_language, layered_fs):
+	from shutil import rmtree
+	from tempfile import mkdtemp
+	from TranslationPatcher import distribute
+	from WorkspaceManager import copyPatchedFiles, prepareReleasePatches, createReleasePatches, createLayeredPatches
+	
+	setupOriginals()
 	cls()
 	
 	languages = askParamter(
@@ -598,35 +759,185 @@ def RP(original_language):
 	print('Version:', version)
 	print('CIA Folder:', cia_dir)
 	print('Patches File:', patches_filename)
+	if layered_fs: print('Mode: LayeredFS')
 	print()
 	
 	if not verifyStart(): return
+	if layered_fs: Tools.require('xdelta')
+	else: Tools.require('xdelta', '3dstool')
 	
-	print('~~ Prepare Release Patches ~~')
-	prepareReleasePatches(cia_dir, original_language=original_language)
+	# LayeredFS patches read the original files from the images and do not modify the cia folder
+	if not layered_fs:
+		print('~~ Prepare Release Patches ~~')
+		prepareReleasePatches(cia_dir, original_language=original_language)
+		print()
+		print()
 	
-	print()
-	print()
 	print('~~ Distribute Patches ~~')
 	temp_dir = mkdtemp()
 	distribute(languages=languages, version=version, version_only=True, original_language=original_language, destination_dir=temp_dir, force_override=True, verbose=1)
 	
+	if layered_fs:
+		print()
+		print()
+		print('~~ Create LayeredFS Patches ~~')
+		createLayeredPatches(temp_dir, cia_dir, patches_filename, xdelta=Tools.get('xdelta'), original_language=original_language)
+		rmtree(temp_dir)
+		showEnd()
+		return
+	
 	print()
 	print()
 	print('~~ Copy Patched Files ~~')
-	if not copyPatchedFiles(temp_dir, cia_dir):
+	sections = copyPatchedFiles(temp_dir, cia_dir)
+	if sections is None:
 		showEnd()
 		return
 	
 	print()
 	print()
 	print('~~ Create Release Patches ~~')
-	createReleasePatches(cia_dir, patches_filename, xdelta=TOOLS['xdelta'][opSys]['exe'], dstool=TOOLS['3dstool'][opSys]['exe'], original_language=original_language)
+	createReleasePatches(cia_dir, patches_filename, xdelta=Tools.get('xdelta'), dstool=Tools.get('3dstool'), original_language=original_language, native_romfs=Config.get('native', False), sections=sections)
 	
 	rmtree(temp_dir)
 	showEnd()
 
+def RPB(original_language, layered_fs):
+	from os import cpu_count
+	from shutil import rmtree
+	from tempfile import mkdtemp
+	from concurrent.futures import ThreadPoolExecutor
+	from TranslationPatcher import distribute
+	from WorkspaceManager import cloneFolder, copyPatchedFiles, prepareReleasePatches, createReleasePatches, createLayeredPatches
+	
+	setupOriginals()
+	cls()
+	
+	while True:
+		targets = askParamter(
+			name = 'targets',
+			description = [
+				'The languages and versions to release patches for, separated by spaces.',
+				'Every target is written as <languages>::<version> (e.g. \'EN::v1.0 DE::v1.0 DE,EN::v1.1\').'
+			],
+			key = 'RPB.targets',
+			default = 'EN::v1.0'
+		)
+		try: targets = [(tuple(target.split('::')[0].split(',')), target.split('::')[1]) for target in targets.split()]
+		except IndexError: continue
+		if targets: break
+	
+	# ask for the extracted CIA folder of every version
+	sources = Config.get('RPB.sources', dict())
+	updates = dict(Config.get('SW.updates', list()))
+	for version in sorted({version for _, version in targets}):
+		while True:
+			source_dir = askParamter(
+				name = 'CIA folder for %s' % version,
+				description = ['The full path to the folder containing the extracted CIA file of version %s.' % version,
+								'The folder is not modified.'],
+				key = None,
+				fallback = sources.get(version, updates.get(version, Config.get('SW.cia', '')))
+			)
+			if isdir(source_dir): break
+		sources[version] = source_dir
+	Config.set('RPB.sources', sources)
+	
+	if not layered_fs:
+		clone_root = askParamter(
+			name = 'clone folder',
+			description = ['Every target gets a copy of the CIA folder in this folder.',
+							'The copies are linked to the original files and only patched files take additional space.'],
+			key = 'RPB.clones',
+			default = join('_release', 'cia')
+		)
+	
+	while True:
+		jobs = askParamter(
+			name = 'jobs',
+			description = ['The number of targets to create patches for at the same time.'],
+			key = 'RPB.jobs',
+			default = str(max(1, (cpu_count() or 1) // 2))
+		)
+		if jobs.isdigit() and int(jobs) > 0: break
+	jobs = int(jobs)
+	
+	# the clones are only used by this run, the folders of RP are kept
+	patches_filenames = Config.get('RP.patchfiles', dict())
+	plan = list()
+	for languages, version in targets:
+		lang_ver = '%s::%s' % ('-'.join(languages), version)
+		if layered_fs: cia_dir = sources[version]
+		else: cia_dir = join(clone_root, '%s-%s' % (version, '-'.join(languages)))
+		patches_filename = patches_filenames.get(lang_ver, join('_release', 'Patches-%s-%s.zip' % (version, '-'.join(languages))))
+		plan.append((languages, version, cia_dir, patches_filename))
+	
+	for languages, version, cia_dir, patches_filename in plan:
+		print('Target %s %s:' % (', '.join(languages), version), cia_dir, '->', patches_filename)
+	print('Jobs:', jobs)
+	if layered_fs: print('Mode: LayeredFS')
+	print()
+	
+	if not verifyStart(): return
+	if layered_fs: Tools.require('xdelta')
+	else: Tools.require('xdelta', '3dstool')
+	
+	# prepare the folders one after another
+	prepared = list()
+	for languages, version, cia_dir, patches_filename in plan:
+		print('~~ Prepare %s %s ~~' % (', '.join(languages), version))
+		# LayeredFS patches read the original files from the images, so the source folder is not modified
+		if not layered_fs:
+			if not cloneFolder(sources[version], cia_dir): continue
+			prepareReleasePatches(cia_dir, original_language=original_language)
+		temp_dir = mkdtemp()
+		distribute(languages=languages, version=version, version_only=True, original_language=original_language, destination_dir=temp_dir, force_override=True, verbose=1)
+		sections = None
+		if not layered_fs:
+			sections = copyPatchedFiles(temp_dir, cia_dir)
+			if sections is None:
+				rmtree(temp_dir)
+				continue
+		prepared.append((languages, version, cia_dir, patches_filename, temp_dir, sections))
+		print()
+		print()
+	
+	# create the patches of multiple targets at the same time
+	print('~~ Create Release Patches ~~')
+	def release(languages, version, cia_dir, patches_filename, temp_dir, sections):
+		try:
+			start = time()
+			if layered_fs: success = createLayeredPatches(temp_dir, cia_dir, patches_filename, xdelta=Tools.get('xdelta'), original_language=original_language)
+			else: success = createReleasePatches(cia_dir, patches_filename, xdelta=Tools.get('xdelta'), dstool=Tools.get('3dstool'), original_language=original_language, native_romfs=Config.get('native', False), sections=sections)
+			return success, time() - start
+		finally: rmtree(temp_dir)
+	with ThreadPoolExecutor(max_workers=jobs) as executor:
+		results = [(target, executor.submit(release, *target)) for target in prepared]
+		results = [(target, result.result()) for target, result in results]
+	
+	print()
+	for languages, version, cia_dir, patches_filename in plan:
+		result = next((r for t, r in results if t[2] == cia_dir and t[3] == patches_filename), None)
+		if result is None: status = 'failed'
+		else: status = '%s in %.2fs' % ('done' if result[0] else 'failed', result[1])
+		print(' *', '%s %s:' % (', '.join(languages), version), status)
+	showEnd()
+
+def GC():
+	from WorkspaceManager import cleanStore
+	
+	cls()
+	
+	print('Removes all original files from the shared store that are not used by any workspace.')
+	print()
+	
+	if not verifyStart(): return
+	cleanStore()
+	showEnd()
+
 def RF():
+	from FileReplacer import replaceFiles
+	
 	cls()
 	
 	while True:
@@ -656,6 +967,9 @@ def RF():
 	showEnd()
 
 def CS(original_language, force_override):
+	from TranslationPatcher import createSaves
+	
+	setupOriginals()
 	cls()
 	
 	while True:
@@ -673,7 +987,9 @@ def CS(original_language, force_override):
 	createSaves(table_file=table_file, original_language=original_language, force_override=force_override)
 	showEnd()
 
-def EG():
+def EG(image_only):
+	from GameManager import extractGame
+	
 	cls()
 	
 	while True:
@@ -692,13 +1008,18 @@ def EG():
 	
 	print('Game File:', game_file)
 	print('Game Folder:', game_dir)
+	if image_only: print('Mode: Keep RomFS Images')
 	print()
 	
 	if not verifyStart(): return
-	for _ in extractGame(game_file=game_file, game_dir=game_dir, dstool=TOOLS['3dstool'][opSys]['exe'], ctrtool=TOOLS['ctrtool'][opSys]['exe']): pass
+	Tools.require('3dstool', 'ctrtool')
+	for _ in extractGame(game_file=game_file, game_dir=game_dir, dstool=Tools.get('3dstool'), ctrtool=Tools.get('ctrtool'), native=Config.get('native', False), extract_romfs=not image_only): pass
 	showEnd()
 
 def RG():
+	import re
+	from GameManager import rebuildGame
+	
 	cls()
 	
 	while True:
@@ -739,7 +1060,8 @@ def RG():
 	print()
 	
 	if not verifyStart(): return
-	for _ in rebuildGame(game_dir=game_dir, game_file=game_file, version=version, dstool=TOOLS['3dstool'][opSys]['exe'], makerom=TOOLS['makerom'][opSys]['exe']): pass
+	Tools.require('3dstool', 'makerom')
+	for _ in rebuildGame(game_dir=game_dir, game_file=game_file, version=version, dstool=Tools.get('3dstool'), makerom=Tools.get('makerom'), native=Config.get('native', False)): pass
 	showEnd()
 
 
@@ -791,6 +1113,14 @@ def printInfo(text):
 	print()
 
 def menu():
+	## Save Config ##
+	
+	Config.saveConfig()
+	
+	## Check Updates ##
+	
+	checkUpdates()
+	
 	## Print Title and Options ##
 	
 	printTitleBox()
@@ -808,7 +1138,7 @@ def menu():
 	printInfo('Sends the folder from the \'D\' script to Citra\'s mod folder for LayeredFS patching.')
 	printOption('SW', 'Setup Workspace', 'EG', 'Extract Game')
 	printOption('UW', 'Update Workspace', 'RG', 'Rebuild Game')
-	printOption('RP', 'Release Patches')
+	printOption('RP', 'Release Patches', 'GC', 'Clean Shared Store')
 	printOption('RF', 'Replace Files', 'DS', 'Distribute & Send via FTP')
 	printOption('CS', 'Create Saves', 'DSC', 'Distribute & Send to Citra')
 	
@@ -816,6 +1146,10 @@ def menu():
 	printCategory('Options')
 	printOption('-f', 'Force Override All Files (e.g. \'AP -f\')')
 	printOption('-o=<XY>', 'Override Original Language (e.g. \'AP -o=JA\')')
+	printOption('-s', 'Link Original Files from the Shared Store (e.g. \'SW -s\')')
+	printOption('-l', 'Release LayeredFS Patches without Rebuilding (e.g. \'RP -l\')')
+	printOption('-b', 'Release Patches for Multiple Targets (e.g. \'RP -b\')')
+	printOption('-i', 'Keep the RomFS Images without Extracting them (e.g. \'EG -i\')')
 	
 	#print()
 	print('_'*(w+m+4+m))
@@ -830,8 +1164,16 @@ def menu():
 	
 	force_override = False
 	original_language = 'JA'
+	shared_store = False
+	layered_fs = False
+	batch = False
+	image_only = False
 	for option in command[1:]:
 		if option == '-f': force_override = True
+		elif option == '-s': shared_store = True
+		elif option == '-l': layered_fs = True
+		elif option == '-b': batch = True
+		elif option == '-i': image_only = True
 		elif option.startswith('-o='): original_language = option[3:]
 	
 	## Call Script ##
@@ -841,25 +1183,33 @@ def menu():
 	elif script == 'D': D(original_language, force_override)
 	elif script == 'S': S(force_override)
 	elif script == 'SC': SC(force_override)
-	elif script == 'SW': SW(original_language, force_override)
+	elif script == 'SW': SW(original_language, force_override, shared_store)
 	elif script == 'UW': UW(original_language, force_override)
-	elif script == 'RP': RP(original_language)
+	elif script == 'RP' and batch: RPB(original_language, layered_fs)
+	elif script == 'RP': RP(original_language, layered_fs)
+	elif script == 'GC': GC()
 	elif script == 'RF': RF()
 	elif script == 'CS': CS(original_language, force_override)
-	elif script == 'EG': EG()
+	elif script == 'EG': EG(image_only)
 	elif script == 'RG': RG()
 	elif script == 'DS': DS(original_language, force_override)
 	elif script == 'DSC': DSC(original_language, force_override)
-	elif script in ['EXIT', 'CLOSE', 'QUIT', ':Q']: return
-	else: menu()
+	elif script in ['EXIT', 'CLOSE', 'QUIT', ':Q']: return False
+	return True
+
+def session():
+	""" Runs the menu in a loop until the user exits.
+		Params, the workspace index, the hash and parse caches and the verified tools
+		are kept between commands and are only invalidated when their files change.
+	"""
+	while menu(): pass
 
 def main():
 	try:
 		cls()
 		rzs()
-		checkUpdates()
-		checkTools()
-		menu()
+		Updates.start()
+		session()
 	except KeyboardInterrupt as e:
 		print('KeyboardInterrupt')
 		print()
@@ -869,6 +1219,8 @@ def main():
 		traceback.print_exc()
 		print()
 		input('Press Enter to exit...')
+	finally:
+		Config.saveConfig()
 
 if __name__ == '__main__':
 	main()
@@ -3,17 +3,32 @@
 <<<
 """
 
-from os import makedirs, listdir, walk, remove, rename
-from os.path import join, normpath, sep, exists, isdir, dirname, splitext, commonprefix, relpath, abspath
-from subprocess import run, PIPE, STDOUT, DEVNULL
+from os import makedirs, listdir, walk, remove, rename, replace, stat, link, cpu_count
+from os.path import join, normpath, sep, exists, isdir, isfile, dirname, basename, splitext, commonprefix, relpath, abspath, getsize
 from zipfile import ZipFile
-from io import BytesIO
-from urllib.request import urlopen
-from tempfile import mkdtemp
-from shutil import move, rmtree, copyfile, copytree
-import ssl
+from shutil import rmtree, copyfile, copy2, copytree, copyfileobj
+from io import RawIOBase
+from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import json
 
-from TranslationPatcher import hash, splitFolder, joinFolder, Params
+from TranslationPatcher import hashCRC, extpath, splitFolder, joinFolder, Params
+from CacheManager import Store, hash, hashSHA256, treeFingerprint, fileSignature, MANIFEST_SUFFIX
+from ContainerManager import openImage, buildRomFS, RomFS, exefsEntries, EXEFS_HEADER_SIZE, ROMFS_IMAGES
+from ProcessManager import runTool
+
+DOWNLOAD_FILE = 'tt-patches.zip'
+RELEASE_MANIFEST = 'tt-release.json'
+BUILD_MANIFEST = 'tt-build.json'
+CHECKSUM_SUFFIX = '.sha256'
+LAYERED_MANIFEST = 'layeredfs.json'
+LAYERED_CACHE = 'tt-layeredfs'
+LAYERED_FOLDERS = [('ExtractedExeFS', ''), ('ExtractedRomFS', 'romfs')] # section -> folder in luma/titles/<TitleID>
+CHUNK_SIZE = 1 << 20
+
+# the complete archive is downloaded if the changed patches make up more than this part of it
+PARTIAL_LIMIT = 0.5
 
 # 0: nothing, 1: normal, 2: all
 VERBOSE = 1
@@ -23,50 +38,367 @@ VERBOSE = 1
 ## Setup ##
 ###########
 
-def downloadAndExtractPatches(download_url):
+def downloadFile(download_url, filename, checksum = None, retries = 5, headers = None):
+	""" Downloads the given [download_url] to the given [filename] in chunks.
+		The data is written to a partial file first and lost connections are
+		resumed using range requests, up to [retries] times in a row.
+		If a SHA-256 [checksum] is given, the downloaded file is verified against it.
+		Additional [headers] are sent with the first request, e.g. for conditional requests.
+		Returns a dict with the etag, last-modified date and SHA-256 digest of the file,
+		or None if the server responded that the file was not modified.
+	"""
+	from urllib.request import urlopen, Request
+	from urllib.error import HTTPError
+	from http.client import HTTPException
+	from time import sleep
+	import ssl
+	
+	partial_file = filename + '.part'
+	if exists(partial_file): remove(partial_file)
+	info = dict()
+	attempt = 0
+	while True:
+		offset = getsize(partial_file) if exists(partial_file) else 0
+		validator = info.get('etag') or info.get('modified')
+		if offset and validator: request_headers = {'Range': 'bytes=%d-' % offset, 'If-Range': validator}
+		elif not info and headers: request_headers = headers
+		else: request_headers = dict()
+		try:
+			with urlopen(Request(download_url, headers=request_headers), timeout=30, context=ssl._create_unverified_context()) as url:
+				if url.status != 206: offset = 0 # server sent the whole file
+				info = {'etag': url.headers.get('ETag'), 'modified': url.headers.get('Last-Modified')}
+				length = url.headers.get('Content-Length')
+				total = offset + int(length) if length is not None else None
+				with open(partial_file, 'ab' if offset else 'wb') as file:
+					for chunk in iter(lambda: url.read(CHUNK_SIZE), b''):
+						file.write(chunk)
+						offset += len(chunk)
+						attempt = 0
+						if VERBOSE >= 1:
+							if total: print('\r  %.1f / %.1f MB (%d%%)' % (offset / 2**20, total / 2**20, 100 * offset // total), end='', flush=True)
+							else: print('\r  %.1f MB' % (offset / 2**20), end='', flush=True)
+			if total is not None and offset < total: raise HTTPException('Connection closed after %d of %d bytes' % (offset, total))
+			if VERBOSE >= 1: print()
+			break
+		except HTTPError as e:
+			if e.code == 304: return None
+			raise
+		except (OSError, HTTPException) as e:
+			if VERBOSE >= 1: print()
+			attempt += 1
+			if attempt > retries: raise
+			if VERBOSE >= 1: print('Warning: %s, resuming download (%d/%d)' % (str(e), attempt, retries))
+			sleep(attempt)
+	
+	# verify checksum
+	info['digest'] = hashSHA256(partial_file)
+	if checksum is not None and info['digest'] != checksum.lower():
+		remove(partial_file)
+		raise Exception('Checksum of the downloaded file does not match.')
+	
+	replace(partial_file, filename)
+	return info
+
+def createManifest(zip_file, manifest_file = None):
+	""" Creates a manifest listing the path, size and MD5 digest of all patches in the given [zip_file]
+		and the SHA-256 digest of the archive.
+		The manifest is saved to [manifest_file] or next to the archive by default,
+		so it can be published together with the archive. The digest is also saved to a checksum file next to the archive.
+	"""
+	if manifest_file is None: manifest_file = zip_file + MANIFEST_SUFFIX
+	files = list()
+	with ZipFile(zip_file) as zip:
+		for file in zip.infolist():
+			if file.is_dir(): continue
+			simplename = patchName(file.filename)
+			if simplename is None: continue
+			hasher = md5()
+			with zip.open(file) as f:
+				for chunk in iter(lambda: f.read(CHUNK_SIZE), b''): hasher.update(chunk)
+			files.append({'path': '/'.join(simplename.split(sep)), 'size': file.file_size, 'md5': hasher.hexdigest()})
+	digest = hashSHA256(zip_file)
+	with open(manifest_file, 'w') as file:
+		json.dump({'version': 1, 'sha256': digest, 'files': files}, file, indent=1)
+	with open(zip_file + CHECKSUM_SUFFIX, 'w') as file:
+		file.write('%s  %s\n' % (digest, basename(zip_file)))
+	if VERBOSE >= 1: print('Saved manifest of %d patches to %s' % (len(files), manifest_file))
+	return manifest_file
+
+def fetchChecksum(download_url):
+	""" Returns the SHA-256 digest of the archive at the given [download_url]
+		from the checksum file or the manifest published next to it, or None if neither is available.
+	"""
+	from urllib.request import urlopen
+	import ssl
 	try:
-		with urlopen(download_url, context=ssl._create_unverified_context()) as url: data = url.read()
-		return extractPatches(BytesIO(data))
+		with urlopen(download_url + CHECKSUM_SUFFIX, timeout=30, context=ssl._create_unverified_context()) as url:
+			digest = url.read().decode().split()[0]
+		if len(digest) == 64: return digest.lower()
+	except Exception: pass
+	try:
+		with urlopen(download_url + MANIFEST_SUFFIX, timeout=30, context=ssl._create_unverified_context()) as url:
+			return json.loads(url.read().decode()).get('sha256')
+	except Exception: return None
+
+class RemoteFile(RawIOBase):
+	""" A read-only file served over HTTP.
+		The requested parts are fetched using range requests, so a zip archive
+		can be opened and single members can be read without downloading it completely.
+	"""
+	
+	def __init__(self, url, block_size = 1 << 16):
+		self.url = url
+		self.block_size = block_size
+		self.pos = 0
+		self.buffer = b''
+		self.buffer_start = 0
+		self.requests = 0
+		self.received = 0
+		self.size = None
+		self.prefetch(0, 1)
+	
+	def prefetch(self, start, length):
+		""" Fetches [length] bytes starting at [start] into the buffer. """
+		from urllib.request import urlopen, Request
+		import ssl
+		end = start + length - 1 if self.size is None else min(start + length, self.size) - 1
+		request = Request(self.url, headers={'Range': 'bytes=%d-%d' % (start, end)})
+		with urlopen(request, timeout=30, context=ssl._create_unverified_context()) as url:
+			if url.status != 206: raise Exception('The server does not support range requests.')
+			self.size = int(url.headers['Content-Range'].rsplit('/', 1)[1])
+			self.buffer = url.read()
+		self.buffer_start = start
+		self.requests += 1
+		self.received += len(self.buffer)
+	
+	def readable(self): return True
+	def seekable(self): return True
+	def tell(self): return self.pos
+	
+	def seek(self, offset, whence = 0):
+		if whence == 0: self.pos = offset
+		elif whence == 1: self.pos += offset
+		elif whence == 2: self.pos = self.size + offset
+		return self.pos
+	
+	def readinto(self, b):
+		if self.pos >= self.size: return 0
+		offset = self.pos - self.buffer_start
+		if offset < 0 or offset >= len(self.buffer):
+			self.prefetch(self.pos, max(len(b), self.block_size))
+			offset = 0
+		n = min(len(b), len(self.buffer) - offset)
+		b[:n] = self.buffer[offset:offset+n]
+		self.pos += n
+		return n
+
+def downloadChangedPatches(download_url, cache = None):
+	""" Downloads only the patches that differ from the workspace using the manifest
+		published next to the archive at the given [download_url].
+		The changed members are read from the remote archive using range requests
+		and verified against the manifest before they replace the old patches.
+		If a [cache] dict is given, the manifest is only transferred if it changed since the last update
+		and the source and digest of the archive are stored in it like for a complete download.
+		Returns None if no manifest is available, the server does not support range requests
+		or the changed patches make up most of the archive, otherwise true if all changed patches were updated.
+	"""
+	from urllib.request import urlopen, Request
+	from urllib.error import HTTPError
+	import ssl
+	
+	# fetch manifest, using a conditional request for the last downloaded url
+	cached = cache is not None and cache.get('source') == download_url
+	headers = {'If-None-Match': cache['manifest']} if cached and cache.get('manifest') else dict()
+	try:
+		with urlopen(Request(download_url + MANIFEST_SUFFIX, headers=headers), timeout=30, context=ssl._create_unverified_context()) as url:
+			manifest = json.loads(url.read().decode())
+			etag = url.headers.get('ETag')
+	except HTTPError as e:
+		if e.code != 304: return None
+		if VERBOSE >= 1: print('Patches are up to date.')
+		return True
+	except Exception: return None
+	
+	def updateCache():
+		if cache is None: return
+		cache.clear()
+		cache['source'] = download_url
+		if manifest.get('sha256'): cache['digest'] = manifest['sha256']
+		if etag: cache['manifest'] = etag
+	
+	# skip archives that did not change since the last update
+	if cached and manifest.get('sha256') and cache.get('digest') == manifest['sha256']:
+		if VERBOSE >= 1: print('Patches did not change.')
+		updateCache()
+		return True
+	
+	# compare manifest with workspace
+	changed = dict()
+	for entry in manifest['files']:
+		simplename = join(*entry['path'].split('/'))
+		if exists(simplename) and getsize(simplename) == entry['size'] and hash(simplename).hex() == entry['md5']: continue
+		changed[simplename] = entry
+	if VERBOSE >= 1: print('Found %d changed of %d patches.' % (len(changed), len(manifest['files'])))
+	if not changed:
+		updateCache()
+		return True
+	
+	# extract changed patches from the remote archive
+	try: remote = RemoteFile(download_url)
+	except Exception: return None
+	with ZipFile(remote) as zip:
+		files = [(file, patchName(file.filename)) for file in zip.infolist()]
+		files = [(file, simplename) for file, simplename in files if simplename in changed]
+		
+		# many small requests are slower than a single download of the whole archive
+		changed_size = sum(file.compress_size for file, _ in files)
+		if changed_size > remote.size * PARTIAL_LIMIT:
+			if VERBOSE >= 1: print('Downloading the complete archive, since %d%% of it changed.' % (100 * changed_size // remote.size))
+			return None
+		
+		for file, simplename in files:
+			if VERBOSE >= 1: print(' *', simplename)
+			remote.prefetch(file.header_offset, 30 + len(file.filename.encode()) + len(file.extra) + file.compress_size + 1024)
+			extractEntry(zip, file, simplename, digest=changed.pop(simplename)['md5'])
+	if changed: raise Exception('The archive does not contain %s.' % next(iter(changed)))
+	updateCache()
+	
+	if VERBOSE >= 1:
+		print()
+		print('Downloaded %d of %d bytes in %d requests.' % (remote.received, remote.size, remote.requests))
+	return True
+
+def downloadAndExtractPatches(download_url, checksum = None, cache = None):
+	""" Downloads the patches from the given [download_url] and extracts them.
+		If no [checksum] is given, the one published next to the archive is used if available.
+		If a [cache] dict is given, the etag and last-modified date of the download are stored in it
+		and the next download of the same url is only transferred if the archive changed.
+	"""
+	try:
+		# update only the changed patches if a manifest is published
+		if checksum is None:
+			result = downloadChangedPatches(download_url, cache)
+			if result is not None: return result
+			checksum = fetchChecksum(download_url)
+		
+		# send a conditional request for the last downloaded url
+		headers = dict()
+		if cache is not None and cache.get('source') == download_url:
+			if cache.get('etag'): headers['If-None-Match'] = cache['etag']
+			if cache.get('modified'): headers['If-Modified-Since'] = cache['modified']
+		info = downloadFile(download_url, DOWNLOAD_FILE, checksum, headers=headers)
+		if info is None:
+			if VERBOSE >= 1: print('Patches are up to date.')
+			return True
+		if VERBOSE >= 1: print()
+		
+		# extract patches
+		try: result = extractPatches(DOWNLOAD_FILE, cache=cache, source=download_url, digest=info['digest'])
+		finally: remove(DOWNLOAD_FILE)
+		if result and cache is not None:
+			cache['etag'] = info['etag']
+			cache['modified'] = info['modified']
+		return result
 	except Exception as e:
 		print('Error:', str(e))
 		return False
 
-def extractPatches(zip_file):
+def patchName(filename):
+	""" Returns the path in the workspace of the patch with the given [filename]
+		in a patches archive, or None if it is the root folder of the archive.
+	"""
+	simplename = normpath(filename).split(sep)[1:]
+	return join(*simplename) if simplename else None
+
+def extractEntry(zip, file, simplename, digest = None):
+	""" Streams the given [file] of the given [zip] archive to a temporary file
+		next to [simplename] and replaces [simplename] with it afterwards.
+		If an MD5 [digest] is given, the file is verified before it replaces [simplename].
+	"""
+	directory = dirname(simplename)
+	if directory: makedirs(directory, exist_ok=True)
+	temp_file = simplename + '.temp'
+	try:
+		if digest is None:
+			with zip.open(file) as src, open(temp_file, 'wb') as dest: copyfileobj(src, dest)
+		else:
+			hasher = md5()
+			with zip.open(file) as src, open(temp_file, 'wb') as dest:
+				for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+					hasher.update(chunk)
+					dest.write(chunk)
+			if hasher.hexdigest() != digest: raise Exception('Digest of %s does not match the manifest.' % simplename)
+		replace(temp_file, simplename)
+	finally:
+		if exists(temp_file): remove(temp_file)
+
+def extractPatches(zip_file, cache = None, source = None, digest = None, workers = None):
+	""" Extracts all changed patches from the given [zip_file] into the workspace
+		using the given number of [workers].
+		If a [cache] dict is given, the [source] and [digest] of the archive are stored in it
+		and an archive with the same source and digest as the last one is not extracted again.
+	"""
 	try:
-		# create temporary folder
-		tempdir = mkdtemp()
+		# skip archives that did not change since the last extraction
+		if cache is not None:
+			if source is None: source = abspath(zip_file)
+			if digest is None: digest = hashSHA256(zip_file)
+			if cache.get('source') == source and cache.get('digest') == digest:
+				if VERBOSE >= 1: print('Patches did not change.')
+				return True
+			cache.clear()
+		
+		# plan extraction and create all directories beforehand
+		with ZipFile(zip_file) as archive:
+			files = [(file, patchName(file.filename)) for file in archive.infolist() if not file.is_dir()]
+		files = [(file, simplename) for file, simplename in files if simplename is not None]
+		for directory in sorted({dirname(simplename) for _, simplename in files} - {''}):
+			makedirs(directory, exist_ok=True)
+		
+		# extract changed patches next to their destination, every worker uses its own zip handle
+		local = threading.local()
+		handles = list()
+		def extract(file, simplename):
+			# compare size and checksum from the zip directory before extracting
+			if exists(simplename) and getsize(simplename) == file.file_size and hashCRC(simplename) == file.CRC:
+				return False
+			# stream to a temporary file and replace the old patch
+			if not hasattr(local, 'zip'):
+				local.zip = ZipFile(zip_file)
+				handles.append(local.zip)
+			extractEntry(local.zip, file, simplename)
+			return True
 		
-		# extract patches to temporary folder and move them
 		ctr = dict()
 		folders = list()
-		with ZipFile(zip_file) as zip:
-			for file in zip.infolist():
-				if file.is_dir(): continue
-				filename = file.filename
-				simplename = normpath(filename).split(sep)[1:]
-				if not simplename: continue
-				folder = simplename[0] if len(simplename) > 1 else None
-				simplename = join(*simplename)
-				if VERBOSE >= 2: print(simplename)
-				if VERBOSE == 1 and folder and folder not in folders:
-					print(folder)
-					folders.append(folder)
-				extracted_file = zip.extract(filename, path=tempdir)
-				if exists(simplename) and hash(extracted_file) == hash(simplename):
-					remove(extracted_file)
-				else:
-					directory = dirname(simplename)
-					if directory: makedirs(directory, exist_ok=True)
-					move(extracted_file, simplename)
-					ctr['update'] = ctr.get('update', 0) + 1
-				ctr['extract'] = ctr.get('extract', 0) + 1
+		if workers is None: workers = min(8, cpu_count() or 1)
+		try:
+			with ThreadPoolExecutor(max_workers=workers) as executor:
+				results = [executor.submit(extract, file, simplename) for file, simplename in files]
+				# report progress in archive order
+				for (file, simplename), result in zip(files, results):
+					folder = simplename.split(sep)[0] if sep in simplename else None
+					if VERBOSE >= 2: print(simplename)
+					if VERBOSE == 1 and folder and folder not in folders:
+						print(folder)
+						folders.append(folder)
+					if result.result():
+						ctr['extract'] = ctr.get('extract', 0) + 1
+						ctr['write'] = ctr.get('write', 0) + file.file_size
+					else:
+						ctr['keep'] = ctr.get('keep', 0) + 1
+						ctr['avoid'] = ctr.get('avoid', 0) + file.file_size
+		finally:
+			for handle in handles: handle.close()
 		if VERBOSE >= 1:
 			print()
 			print('Extracted %d patches.' % ctr.get('extract', 0))
-			print('Updated %d patches.'    % ctr.get('update', 0))
+			print('Kept %d unchanged patches.' % ctr.get('keep', 0))
+			print('Wrote %d bytes, avoided writing %d bytes.' % (ctr.get('write', 0), ctr.get('avoid', 0)))
 		
-		# delete temporary folder
-		rmtree(tempdir)
+		if cache is not None:
+			cache['source'] = source
+			cache['digest'] = digest
 		return True
 	
 	except Exception as e:
@@ -100,7 +432,30 @@ def doUpdateActions():
 	
 	if VERBOSE >= 1: print('Finished all actions.')
 
-def copyOriginalFiles(cia_dir, version = None, original_language = 'JA'):
+def requiredOriginals(folder, types, version = None, original_language = 'JA'):
+	""" Returns the names of the original files of the given [folder] and [version] that are needed
+		by the patches (.xdelta, .patJ, .patE) and edited files in the workspace.
+	"""
+	xdelta_types = Params.xdeltaFolders().get(folder, list())
+	pat = Params.patFolders().get(folder)
+	required = set()
+	for dir in listdir('.'):
+		parts = splitFolder(dir)
+		if not isdir(dir) or parts['folder'] != folder or parts.get('version') != version or parts.get('lang') == original_language: continue
+		for file in [join(dp, f) for dp, dn, fn in walk(dir) for f in fn]:
+			simplename = join(*extpath(file))
+			name, ext = splitext(simplename)
+			if ext == '.xdelta' and splitext(name)[1] in xdelta_types: required.add(name)
+			elif ext in xdelta_types: required.add(simplename)
+			elif pat and ext in pat[1:]: required.add(name + pat[1])
+	return {simplename for simplename in required if splitext(simplename)[1] in types}
+
+def copyOriginalFiles(cia_dir, version = None, original_language = 'JA', selective = False, store = False):
+	""" Copies the original files from the given [cia_dir] to the original folders of the given [version].
+		If [selective] is true, only the files needed by the patches and edited files in the workspace are copied.
+		If [store] is true, the files are added to the shared store and linked into the workspace.
+		Folders of RomFS images that were not extracted are read directly from the images.
+	"""
 	try:
 		# collect patched folders
 		folders = Params.xdeltaFolders().copy() # merge xdelta and pat folders
@@ -110,26 +465,56 @@ def copyOriginalFiles(cia_dir, version = None, original_language = 'JA'):
 		
 		# copy files
 		ctr = dict()
-		for folder, types in sorted(folders.items()):
-			cia_folder = join(cia_dir, Params.parentFolders()[folder])
-			workspace_folder = joinFolder(folder, original_language, version)
-			if VERBOSE >= 1: print(workspace_folder)
-			for original_file in [join(dp, f) for dp, dn, fn in walk(cia_folder) for f in fn if splitext(f)[1] in types]:
-				common_prefix = commonprefix((original_file, cia_folder))
-				simplename = relpath(original_file, common_prefix)
-				workspace_file = join(workspace_folder, simplename)
-				if VERBOSE >= 2: print(' *', simplename)
-				ctr['find'] = ctr.get('find', 0) + 1
-				if exists(workspace_file) and hash(original_file) == hash(workspace_file): continue
-				directory = dirname(workspace_file)
-				if directory: makedirs(directory, exist_ok=True)
-				copyfile(original_file, workspace_file)
-				ctr['copy'] = ctr.get('copy', 0) + 1
+		images = list()
+		try:
+			for folder, types in sorted(folders.items()):
+				cia_folder = join(cia_dir, Params.parentFolders()[folder])
+				workspace_folder = joinFolder(folder, original_language, version)
+				if VERBOSE >= 1: print(workspace_folder)
+				# read the original files straight from the RomFS image if the folder was not extracted
+				image = openImage(cia_dir, Params.parentFolders()[folder]) if not isdir(cia_folder) else None
+				if image is not None:
+					image, prefix = image
+					images.append(image)
+					base = prefix + '/' if prefix else ''
+					if selective: paths = [base + '/'.join(f.split(sep)) for f in sorted(requiredOriginals(folder, types, version, original_language))]
+					else: paths = image.select([prefix], types)
+					original_files = [(join(*path[len(base):].split('/')), path) for path in paths if path in image.files()]
+				else:
+					if selective: original_files = [join(cia_folder, f) for f in sorted(requiredOriginals(folder, types, version, original_language)) if isfile(join(cia_folder, f))]
+					else: original_files = [join(dp, f) for dp, dn, fn in walk(cia_folder) for f in fn if splitext(f)[1] in types]
+					original_files = [(relpath(f, commonprefix((f, cia_folder))), f) for f in original_files]
+				for simplename, original_file in original_files:
+					workspace_file = join(workspace_folder, simplename)
+					if VERBOSE >= 2: print(' *', simplename)
+					ctr['find'] = ctr.get('find', 0) + 1
+					if image is not None:
+						with image.read(original_file) as data: digest = md5(data).digest()
+					else: digest = hash(original_file)
+					if exists(workspace_file) and digest == hash(workspace_file) and (not store or Store.digest(workspace_file) == digest): continue
+					directory = dirname(workspace_file)
+					if directory: makedirs(directory, exist_ok=True)
+					if image is not None:
+						with image.read(original_file) as data, open(workspace_file + '.temp', 'wb') as file: file.write(data)
+						replace(workspace_file + '.temp', workspace_file)
+						if store and Store.materialize(workspace_file, workspace_file, digest): ctr['link'] = ctr.get('link', 0) + 1
+						else: ctr['copy'] = ctr.get('copy', 0) + 1
+					elif store and Store.materialize(original_file, workspace_file, digest): ctr['link'] = ctr.get('link', 0) + 1
+					else:
+						if exists(workspace_file): remove(workspace_file)
+						copyfile(original_file, workspace_file)
+						ctr['copy'] = ctr.get('copy', 0) + 1
+		finally:
+			for image in images: image.close()
+		if store: Store.saveIndex()
 		
 		if VERBOSE >= 1:
 			print()
 			print('Found %d files.' % ctr.get('find', 0))
 			print('Copied %d files.' % ctr.get('copy', 0))
+			if store:
+				print('Linked %d files from the shared store.' % ctr.get('link', 0))
+				printStoreStats()
 		
 		return True
 		
@@ -138,33 +523,96 @@ def copyOriginalFiles(cia_dir, version = None, original_language = 'JA'):
 		return False
 
 
+def printStoreStats():
+	stats = Store.stats()
+	print('Shared store: %d objects, %d bytes, %d references, %d bytes saved.' % (stats.get('objects', 0), stats.get('size', 0), stats.get('references', 0), stats.get('saved', 0)))
+
+def cleanStore():
+	""" Removes all objects from the shared store that are not linked to any workspace. """
+	try:
+		ctr = Store.collectGarbage()
+		if VERBOSE >= 1:
+			print('Removed %d objects, %d bytes.' % (ctr.get('objects', 0), ctr.get('size', 0)))
+			printStoreStats()
+		return True
+	except Exception as e:
+		print('Error:', str(e))
+		return False
+
+
 #############
 ## Release ##
 #############
 
 def copyPatchedFiles(output_folder, cia_dir):
+	""" Copies all files from the given [output_folder] to the given [cia_dir].
+		Files that are unchanged since the last copy according to the release manifest
+		in the [cia_dir] are skipped. RomFS images that were not extracted by EG are extracted first.
+		Returns the set of changed sections (e.g. ExtractedRomFS) or None if an error occurred.
+	"""
 	try:
+		# extract the images of the patched sections that were kept by EG
+		for section in listdir(output_folder):
+			image_file = join(cia_dir, ROMFS_IMAGES.get(section, ''))
+			if section not in ROMFS_IMAGES or isdir(join(cia_dir, section)) or not isfile(image_file): continue
+			if VERBOSE >= 1: print('Extracting %s...' % ROMFS_IMAGES[section])
+			temp_dir = join(cia_dir, section + '.temp')
+			if isdir(temp_dir): rmtree(temp_dir)
+			with RomFS(image_file) as image: image.extract(temp_dir)
+			rename(temp_dir, join(cia_dir, section))
+		
+		# load manifest of the files written by the last release
+		manifest_file = join(cia_dir, RELEASE_MANIFEST)
+		try:
+			with open(manifest_file, 'r') as file: manifest = json.load(file)
+		except: manifest = dict()
+		
 		if VERBOSE >= 1: print('Copying files...')
-		ctr = 0
-		for src_file in [join(dp, f) for dp, dn, fn in walk(output_folder) for f in fn]:
-			common_prefix = commonprefix((src_file, output_folder))
-			simplename = relpath(src_file, common_prefix)
-			if VERBOSE >= 2: print(' *', simplename)
-			dest_file = join(cia_dir, simplename)
-			directory = dirname(dest_file)
-			if directory: makedirs(directory, exist_ok=True)
-			copyfile(src_file, dest_file)
-			ctr += 1
+		ctr = dict()
+		sections = set()
+		try:
+			for src_file in [join(dp, f) for dp, dn, fn in walk(output_folder) for f in fn]:
+				common_prefix = commonprefix((src_file, output_folder))
+				simplename = relpath(src_file, common_prefix)
+				key = '/'.join(simplename.split(sep))
+				dest_file = join(cia_dir, simplename)
+				digest = hash(src_file).hex()
+				
+				# compare with the manifest and the destination file
+				entry = manifest.get(key)
+				if exists(dest_file):
+					info = stat(dest_file)
+					if entry == [digest, info.st_size, info.st_mtime_ns] or hash(dest_file).hex() == digest:
+						if VERBOSE >= 2: print(' *', simplename, 'keep')
+						manifest[key] = [digest, info.st_size, info.st_mtime_ns]
+						ctr['keep'] = ctr.get('keep', 0) + 1
+						continue
+				
+				# copy to a temporary file and replace the old file
+				if VERBOSE >= 2: print(' *', simplename, 'copy')
+				directory = dirname(dest_file)
+				if directory: makedirs(directory, exist_ok=True)
+				copyfile(src_file, dest_file + '.temp')
+				replace(dest_file + '.temp', dest_file)
+				info = stat(dest_file)
+				manifest[key] = [digest, info.st_size, info.st_mtime_ns]
+				sections.add(simplename.split(sep)[0])
+				ctr['copy'] = ctr.get('copy', 0) + 1
+		finally:
+			with open(manifest_file + '.temp', 'w') as file: json.dump(manifest, file)
+			replace(manifest_file + '.temp', manifest_file)
 		
 		if VERBOSE >= 1:
 			print()
-			print('Copied %d files.' % ctr)
+			print('Copied %d files.' % ctr.get('copy', 0))
+			print('Kept %d files.' % ctr.get('keep', 0))
+			print('Changed sections: %s' % (', '.join(sorted(sections)) if sections else 'none'))
 		
-		return True
+		return sections
 		
 	except Exception as e:
 		print('Error:', str(e))
-		return False
+		return None
 
 def prepareReleasePatches(cia_dir, original_language = 'JA'):
 	ctr = 0
@@ -183,51 +631,205 @@ def prepareReleasePatches(cia_dir, original_language = 'JA'):
 	
 	if VERBOSE >= 1: print('Saved %d files.' % ctr)
 
-def createReleasePatches(cia_dir, patches_filename, xdelta, dstool, original_language = 'JA'):
+def runSteps(steps, workers = None):
+	""" Runs the given [steps], a dict of name -> (function, list of names of required steps),
+		concurrently using the given number of [workers]. Every step is started as soon as all
+		its required steps finished. Returns a dict of name -> duration in seconds.
+		Raises the exception of the first failed step after all running steps finished.
+	"""
+	from time import perf_counter
+	
+	def timed(function):
+		start = perf_counter()
+		function()
+		return perf_counter() - start
+	
+	timings = dict()
+	running = dict()
+	pending = dict(steps)
+	with ThreadPoolExecutor(max_workers=workers or len(steps) or 1) as executor:
+		while pending or running:
+			# start all steps whose requirements finished
+			for name, (function, requires) in list(pending.items()):
+				if all(r in timings for r in requires):
+					running[executor.submit(timed, function)] = name
+					del pending[name]
+			if not running: raise Exception('Unresolvable step dependencies: %s' % ', '.join(pending))
+			# wait for the next step to finish
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				name = running.pop(future)
+				if future.exception() is not None:
+					wait(running)
+					raise future.exception()
+				timings[name] = future.result()
+	return timings
+
+def cloneFolder(source_dir, dest_dir):
+	""" Clones the given [source_dir] to the given [dest_dir] using hardlinks, falling back to copies.
+		Files that already exist in the [dest_dir] are kept, so a clone can be updated
+		without undoing the changes of earlier releases.
+		Files in a clone must only be replaced, never modified in place (see breakLinks).
+		Returns true if the folder was cloned successfully.
+	"""
 	try:
-		# create banner patch
-		if exists(join(cia_dir, 'ExtractedBanner')):
-			# rebuild banner
-			if VERBOSE >= 1: print('Rebuilding banner...')
-			rename(join(cia_dir, 'ExtractedBanner', 'banner.cgfx'), join(cia_dir, 'ExtractedBanner', 'banner0.bcmdl'))
-			run([abspath(dstool), '-ctf', 'banner', 'banner.bin', '--banner-dir', 'ExtractedBanner'], cwd=cia_dir, stdout=DEVNULL, stderr=DEVNULL)
-			rename(join(cia_dir, 'ExtractedBanner', 'banner0.bcmdl'), join(cia_dir, 'ExtractedBanner', 'banner.cgfx'))
+		if VERBOSE >= 1: print('Cloning %s to %s...' % (source_dir, dest_dir))
+		ctr = dict()
+		for dp, dn, fn in walk(source_dir):
+			directory = join(dest_dir, relpath(dp, source_dir))
+			makedirs(directory, exist_ok=True)
+			for f in fn:
+				dest_file = join(directory, f)
+				if exists(dest_file):
+					ctr['keep'] = ctr.get('keep', 0) + 1
+					continue
+				try:
+					link(join(dp, f), dest_file)
+					ctr['link'] = ctr.get('link', 0) + 1
+				except OSError:
+					copyfile(join(dp, f), dest_file)
+					ctr['copy'] = ctr.get('copy', 0) + 1
+		if VERBOSE >= 1:
+			print('Linked %d files.' % ctr.get('link', 0))
+			if ctr.get('copy', 0) > 0: print('Copied %d files.' % ctr.get('copy', 0))
+			print('Kept %d files.' % ctr.get('keep', 0))
+		return True
+		
+	except Exception as e:
+		print('Error:', str(e))
+		return False
+
+def breakLinks(files, keep = True):
+	""" Replaces each of the given [files] that is linked to other files with a copy of itself,
+		so tools can write to it in place without changing the linked files.
+		The modification time is preserved. If [keep] is false, the linked files are removed instead,
+		which avoids copying outputs that are written completely new.
+	"""
+	for file in files:
+		try: info = stat(file)
+		except OSError: continue
+		if info.st_nlink < 2: continue
+		if VERBOSE >= 2: print(' *', 'Break link:', file)
+		if not keep:
+			remove(file)
+			continue
+		copy2(file, file + '.temp')
+		replace(file + '.temp', file)
+
+def createReleasePatches(cia_dir, patches_filename, xdelta, dstool, original_language = 'JA', native_romfs = False, sections = None):
+	""" Rebuilds the banner and RomFS of the given [cia_dir] and creates the release patches.
+		Independent steps run concurrently, the banner and RomFS patches are created
+		as soon as their rebuild finished.
+		The banner and RomFS are only rebuilt if their files or the tools changed since the last release.
+		If [native_romfs] is true, the RomFS is built without 3dstool and updated incrementally if possible.
+		If the set of changed [sections] returned by copyPatchedFiles is given, the files of the other
+		sections are not compared with the last release again.
+	"""
+	try:
+		# load fingerprints of the last release
+		build_file = join(cia_dir, BUILD_MANIFEST)
+		try:
+			with open(build_file, 'r') as file: build = json.load(file)
+		except: build = dict()
+		tools = {'xdelta': hash(xdelta).hex(), '3dstool': hash(dstool).hex(), 'romfs': 'native' if native_romfs else '3dstool'}
+		fingerprints = dict()
+		skipped = set()
+		
+		# tools write their outputs in place, which must not change files of cloned folders,
+		# so the links of the outputs are broken right before they are written
+		
+		def upToDate(name, files, signatures):
+			""" Returns true if the given [files] and [signatures] match the last build of [name]. """
+			entry = build.get(name)
+			if entry is None or entry['tools'] != tools: return False
+			if {k: v[2] for k, v in entry['files'].items()} != {k: v[2] for k, v in files.items()}: return False
+			for f in signatures:
+				signature = fileSignature(join(cia_dir, f))
+				if signature is None or signature != entry['signatures'].get(f): return False
+			return True
+		
+		def fingerprint(name, section):
+			""" Returns the fingerprints of the files of the given [section] for the build of [name]. """
+			entry = build.get(name)
+			if sections is not None and section not in sections and entry is not None: return entry['files']
+			return treeFingerprint(join(cia_dir, section), entry['files'] if entry else None)
+		
+		def record(name, files, signatures):
+			build[name] = {'tools': tools, 'files': files, 'signatures': {f: fileSignature(join(cia_dir, f)) for f in signatures}}
+		
+		def rebuildBanner():
+			files = fingerprint('banner', 'ExtractedBanner')
+			if upToDate('banner', files, ['banner.bin']):
+				if VERBOSE >= 1: print('Skip banner rebuild, unchanged')
+				skipped.add('banner rebuild')
+			else:
+				if VERBOSE >= 1: print('Rebuilding banner...')
+				build.pop('banner', None)
+				breakLinks([join(cia_dir, 'banner.bin')], keep=False)
+				rename(join(cia_dir, 'ExtractedBanner', 'banner.cgfx'), join(cia_dir, 'ExtractedBanner', 'banner0.bcmdl'))
+				try: runTool([abspath(dstool), '-ctf', 'banner', 'banner.bin', '--banner-dir', 'ExtractedBanner'], cwd=cia_dir)
+				finally: rename(join(cia_dir, 'ExtractedBanner', 'banner0.bcmdl'), join(cia_dir, 'ExtractedBanner', 'banner.cgfx'))
+				record('banner', files, ['banner.bin'])
 			# copy to exeFS (if you want to create a CIA file)
 			if exists(join(cia_dir, 'ExtractedExeFS')):
 				if VERBOSE >= 1: print('Copy banner to ExtractedExeFS')
+				breakLinks([join(cia_dir, 'ExtractedExeFS', 'banner.bin')], keep=False)
 				copyfile(join(cia_dir, 'banner.bin'), join(cia_dir, 'ExtractedExeFS', 'banner.bin'))
-			# create patch
-			if hash(join(cia_dir, 'banner.bin')) != hash(join(cia_dir, 'banner-%s.bin' % original_language)):
-				if VERBOSE >= 1: print('Creating banner patch...')
-				run([abspath(xdelta), '-f', '-s', 'banner-%s.bin' % original_language, 'banner.bin', 'banner.xdelta'], cwd=cia_dir)
-				if VERBOSE >= 1: print()
-			else:
-				if VERBOSE >= 2:
-					print('Skip banner patch')
-					print()
 		
-		# create code and icon patch
-		for item in ['code', 'icon']:
-			if exists(join(cia_dir, 'ExtractedExeFS', '%s.bin' % item)):
-				# create patch
-				if hash(join(cia_dir, 'ExtractedExeFS', '%s.bin' % item)) != hash(join(cia_dir, '%s-%s.bin' % (item, original_language))):
-					if VERBOSE >= 1: print('Creating %s patch...' % item)
-					run([abspath(xdelta), '-f', '-s', '%s-%s.bin' % (item, original_language), join('ExtractedExeFS', '%s.bin' % item), '%s.xdelta' % item], cwd=cia_dir)
-					if VERBOSE >= 1: print()
-				else:
-					if VERBOSE >= 2:
-						print('Skip %s patch' % item)
-						print()
+		def createPatch(item, orig_file, edit_file, patch_file):
+			if hash(join(cia_dir, edit_file)) != hash(join(cia_dir, orig_file)):
+				if VERBOSE >= 1: print('Creating %s patch...' % item)
+				breakLinks([join(cia_dir, patch_file)], keep=False)
+				runTool([abspath(xdelta), '-f', '-s', orig_file, edit_file, patch_file], cwd=cia_dir)
+			elif VERBOSE >= 2: print('Skip %s patch' % item)
 		
-		# create romFS patch
-		if exists(join(cia_dir, 'ExtractedRomFS')):
-			# rebuild romFS
+		romfs_signatures = ['DecryptedRomFS.bin', 'CustomRomFS.bin', 'RomFS.xdelta']
+		
+		def rebuildRomFS():
+			fingerprints['romfs'] = fingerprint('romfs', 'ExtractedRomFS')
+			if upToDate('romfs', fingerprints['romfs'], romfs_signatures):
+				if VERBOSE >= 1: print('Skip RomFS rebuild, unchanged')
+				skipped.add('RomFS rebuild')
+				return
 			if VERBOSE >= 1: print('Rebuilding RomFS...')
-			run([abspath(dstool), '-ctf', 'romfs', 'CustomRomFS.bin', '--romfs-dir', 'ExtractedRomFS'], cwd=cia_dir, stdout=DEVNULL, stderr=DEVNULL)
-			# create patch
+			build.pop('romfs', None)
+			# the native build updates the image in place if possible
+			breakLinks([join(cia_dir, 'CustomRomFS.bin')], keep=native_romfs)
+			if native_romfs:
+				if buildRomFS(join(cia_dir, 'ExtractedRomFS'), join(cia_dir, 'CustomRomFS.bin'), incremental=True):
+					if VERBOSE >= 1: print('Updated RomFS incrementally')
+			else: runTool([abspath(dstool), '-ctf', 'romfs', 'CustomRomFS.bin', '--romfs-dir', 'ExtractedRomFS'], cwd=cia_dir)
+		
+		def createRomFSPatch():
+			if 'RomFS rebuild' in skipped:
+				skipped.add('RomFS patch')
+				return
 			if VERBOSE >= 1: print('Creating RomFS patch...')
-			run([abspath(xdelta), '-f', '-s', 'DecryptedRomFS.bin', 'CustomRomFS.bin', 'RomFS.xdelta'], cwd=cia_dir)
-			if VERBOSE >= 1: print()
+			breakLinks([join(cia_dir, 'RomFS.xdelta')], keep=False)
+			runTool([abspath(xdelta), '-f', '-s', 'DecryptedRomFS.bin', 'CustomRomFS.bin', 'RomFS.xdelta'], cwd=cia_dir)
+			record('romfs', fingerprints['romfs'], romfs_signatures)
+		
+		# plan steps
+		steps = dict()
+		if exists(join(cia_dir, 'ExtractedBanner')):
+			steps['banner rebuild'] = (rebuildBanner, [])
+			steps['banner patch'] = (lambda: createPatch('banner', 'banner-%s.bin' % original_language, 'banner.bin', 'banner.xdelta'), ['banner rebuild'])
+		for item in ['code', 'icon']:
+			if exists(join(cia_dir, 'ExtractedExeFS', '%s.bin' % item)):
+				steps['%s patch' % item] = (lambda item=item: createPatch(item, '%s-%s.bin' % (item, original_language), join('ExtractedExeFS', '%s.bin' % item), '%s.xdelta' % item), [])
+		if exists(join(cia_dir, 'ExtractedRomFS')):
+			steps['RomFS rebuild'] = (rebuildRomFS, [])
+			steps['RomFS patch'] = (createRomFSPatch, ['RomFS rebuild'])
+		
+		# run steps
+		try: timings = runSteps(steps)
+		finally:
+			with open(build_file + '.temp', 'w') as file: json.dump(build, file)
+			replace(build_file + '.temp', build_file)
+		if VERBOSE >= 1:
+			print()
+			for name, duration in timings.items(): print(' *', '%s: %s' % (name, 'skipped' if name in skipped else '%.2fs' % duration))
+			print()
 		
 		# archive patches
 		directory = dirname(patches_filename)
@@ -247,3 +849,209 @@ def createReleasePatches(cia_dir, patches_filename, xdelta, dstool, original_lan
 	except Exception as e:
 		print('Error:', str(e))
 		return False
+
+class OriginalFiles:
+	""" Reads the original files of the given [cia_dir] for LayeredFS patches.
+		The files are read from DecryptedExeFS.bin and DecryptedRomFS.bin, which are never patched,
+		since the extracted folders are overwritten by RP and in the clones of RPB.
+		Without the images the saved original ExeFS files (e.g. code-JA.bin) and the extracted folders
+		are used, unless the [cia_dir] contains files of a release.
+	"""
+	
+	def __init__(self, cia_dir, original_language = 'JA'):
+		self.cia_dir = cia_dir
+		self.original_language = original_language
+		self.patched = exists(join(cia_dir, RELEASE_MANIFEST))
+		self.exefs = None
+		self.romfs = None
+		exefs_file = join(cia_dir, 'DecryptedExeFS.bin')
+		if isfile(exefs_file):
+			with open(exefs_file, 'rb') as file: header = file.read(EXEFS_HEADER_SIZE)
+			self.exefs = {name.lstrip('.') + '.bin': (EXEFS_HEADER_SIZE + offset, size) for name, offset, size in exefsEntries(header)}
+		romfs_file = join(cia_dir, 'DecryptedRomFS.bin')
+		if isfile(romfs_file):
+			self.romfs = RomFS(romfs_file)
+			self.romfs.files() # index the image before it is read by multiple threads
+	
+	def __enter__(self): return self
+	def __exit__(self, *args): self.close()
+	
+	def close(self):
+		if self.romfs is not None: self.romfs.close()
+	
+	def read(self, section, simplename):
+		""" Returns the data of the original file of the given [simplename] in the given [section]
+			or None if the file is not part of the original game.
+		"""
+		path = '/'.join(simplename.split(sep))
+		if section == 'ExtractedExeFS':
+			if self.exefs is not None:
+				if path not in self.exefs: return None
+				offset, size = self.exefs[path]
+				with open(join(self.cia_dir, 'DecryptedExeFS.bin'), 'rb') as file:
+					file.seek(offset)
+					return file.read(size)
+			name, ext = splitext(simplename)
+			saved_file = join(self.cia_dir, '%s-%s%s' % (name, self.original_language, ext))
+			if exists(saved_file):
+				with open(saved_file, 'rb') as file: return file.read()
+		elif section == 'ExtractedRomFS' and self.romfs is not None:
+			if path not in self.romfs.files(): return None
+			with self.romfs.read(path) as data: return bytes(data)
+		# the extracted folders only contain the original files if no release was created from them
+		if self.patched: raise Exception('The files of %s were replaced by a release, the decrypted images are required for the original files' % self.cia_dir)
+		orig_file = join(self.cia_dir, section, simplename)
+		if not isfile(orig_file): return None
+		with open(orig_file, 'rb') as file: return file.read()
+
+def createLayeredPatches(output_folder, cia_dir, patches_filename, xdelta, original_language = 'JA', workers = None, cache_dir = LAYERED_CACHE):
+	""" Creates a release archive for LayeredFS from the files in the given [output_folder]
+		without rebuilding the RomFS. Every file is stored as an xdelta patch against its original
+		in the [cia_dir] or as a raw file if it is new or the patch would not be smaller.
+		The [cia_dir] is not modified. Patches are cached in the [cache_dir] of the workspace
+		and reused by later releases if the files did not change.
+		The archive uses the layout of luma/titles/<TitleID> and contains a manifest for applyLayeredPatches.
+	"""
+	try:
+		makedirs(cache_dir, exist_ok=True)
+		
+		# plan entries
+		jobs = list()
+		for section, folder in LAYERED_FOLDERS:
+			for src_file in [join(dp, f) for dp, dn, fn in walk(join(output_folder, section)) for f in fn]:
+				simplename = relpath(src_file, join(output_folder, section))
+				arcname = '/'.join(([folder] if folder else []) + simplename.split(sep))
+				jobs.append((src_file, section, simplename, arcname))
+		
+		def createEntry(src_file, section, simplename, arcname):
+			""" Returns the name, manifest entry, file to archive and action for the given file. """
+			digest = hash(src_file).hex()
+			data = originals.read(section, simplename)
+			if data is None: return arcname, {'type': 'raw', 'digest': digest}, src_file, 'raw'
+			source = md5(data).hexdigest()
+			if source == digest: return arcname, None, None, 'skip'
+			patch_file = join(cache_dir, '%s-%s.xdelta' % (source, digest))
+			action = 'reuse'
+			if not exists(patch_file):
+				# the cache may be shared by releases created at the same time
+				temp_file = '%s.%d.temp' % (patch_file, threading.get_ident())
+				orig_file = temp_file + '.orig'
+				try:
+					with open(orig_file, 'wb') as file: file.write(data)
+					runTool([abspath(xdelta), '-f', '-s', orig_file, src_file, temp_file])
+					replace(temp_file, patch_file)
+				finally:
+					for file in [orig_file, temp_file]:
+						if exists(file): remove(file)
+				action = 'patch'
+			if getsize(patch_file) >= getsize(src_file): return arcname, {'type': 'raw', 'digest': digest}, src_file, 'raw'
+			return arcname, {'type': 'xdelta', 'source': source, 'digest': digest}, patch_file, action
+		
+		if VERBOSE >= 1: print('Creating patches...')
+		if workers is None: workers = cpu_count() or 1
+		with OriginalFiles(cia_dir, original_language) as originals, ThreadPoolExecutor(max_workers=workers) as executor:
+			results = list(executor.map(lambda job: createEntry(*job), jobs))
+		
+		# archive patches and raw files
+		ctr = dict()
+		manifest = dict()
+		directory = dirname(patches_filename)
+		if directory: makedirs(directory, exist_ok=True)
+		with ZipFile(patches_filename, 'w') as zip:
+			for arcname, entry, file, action in results:
+				if VERBOSE >= 2: print(' *', arcname, action)
+				ctr[action] = ctr.get(action, 0) + 1
+				if entry is None: continue
+				zip.write(file, arcname=arcname + '.xdelta' if entry['type'] == 'xdelta' else arcname)
+				manifest[arcname] = entry
+			zip.writestr(LAYERED_MANIFEST, json.dumps(manifest, indent=1))
+		if VERBOSE >= 1:
+			print()
+			print('Created %d patches.' % ctr.get('patch', 0))
+			print('Reused %d patches.' % ctr.get('reuse', 0))
+			print('Added %d raw files.' % ctr.get('raw', 0))
+			if ctr.get('skip', 0) > 0: print('Skipped %d unchanged files.' % ctr.get('skip', 0))
+			print()
+			print('Saved all patches to %s' % patches_filename)
+		
+		return True
+		
+	except Exception as e:
+		print('Error:', str(e))
+		return False
+
+def applyLayeredPatches(patches_filename, cia_dir, output_folder, xdelta, original_language = 'JA', workers = None):
+	""" Applies the given LayeredFS [patches_filename] created by createLayeredPatches
+		to the original files in the given [cia_dir] and writes the files to the [output_folder],
+		which can be copied to luma/titles/<TitleID> or used as a Citra mod.
+		Files that are already up to date are kept.
+	"""
+	try:
+		with ZipFile(patches_filename) as zip: manifest = json.loads(zip.read(LAYERED_MANIFEST))
+		sections = {folder: section for section, folder in LAYERED_FOLDERS}
+		
+		originals = OriginalFiles(cia_dir, original_language)
+		
+		# every worker uses its own zip handle
+		local = threading.local()
+		handles = list()
+		def applyEntry(arcname, entry):
+			dest_file = join(output_folder, *arcname.split('/'))
+			if exists(dest_file) and hash(dest_file).hex() == entry['digest']: return 'keep'
+			if not hasattr(local, 'zip'):
+				local.zip = ZipFile(patches_filename)
+				handles.append(local.zip)
+			if entry['type'] == 'raw':
+				extractEntry(local.zip, arcname, dest_file)
+			else:
+				parts = arcname.split('/')
+				folder = parts[0] if len(parts) > 1 and parts[0] in sections else ''
+				simplename = join(*parts[1:]) if folder else join(*parts)
+				data = originals.read(sections[folder], simplename)
+				if data is None or md5(data).hexdigest() != entry['source']:
+					raise Exception('Original file does not match the patch: %s' % arcname)
+				patch_file = dest_file + '.xdelta'
+				orig_file = dest_file + '.orig'
+				try:
+					extractEntry(local.zip, arcname + '.xdelta', patch_file)
+					with open(orig_file, 'wb') as file: file.write(data)
+					runTool([abspath(xdelta), '-f', '-d', '-s', orig_file, patch_file, dest_file + '.temp'])
+					replace(dest_file + '.temp', dest_file)
+				finally:
+					for file in [patch_file, orig_file]:
+						if exists(file): remove(file)
+			if hash(dest_file).hex() != entry['digest']: raise Exception('Patched file does not match: %s' % arcname)
+			return 'update'
+		
+		ctr = dict()
+		if workers is None: workers = cpu_count() or 1
+		try:
+			with ThreadPoolExecutor(max_workers=workers) as executor:
+				results = [(arcname, executor.submit(applyEntry, arcname, entry)) for arcname, entry in manifest.items()]
+				for arcname, result in results:
+					action = result.result()
+					if VERBOSE >= 2: print(' *', arcname, action)
+					ctr[action] = ctr.get(action, 0) + 1
+		finally:
+			for handle in handles: handle.close()
+			originals.close()
+		if VERBOSE >= 1:
+			print('Updated %d files.' % ctr.get('update', 0))
+			print('Kept %d files.' % ctr.get('keep', 0))
+		
+		return True
+		
+	except Exception as e:
+		print('Error:', str(e))
+		return False
+
+if __name__ == '__main__':
+	import sys
+	if len(sys.argv) == 2:
+		createManifest(sys.argv[1])
+	elif len(sys.argv) == 5:
+		applyLayeredPatches(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+	else:
+		print('Usage:')
+		print('  * py -3 WorkspaceManager.py <PatchesZip>')
+		print('  * py -3 WorkspaceManager.py <LayeredFSPatchesZip> <CIAFolder> <OutputFolder> <xdelta>')
@@ -0,0 +1,259 @@
+""" Author: Dominik Beese
+>>> Container Tests
+<<<
+"""
+
+from os import makedirs, utime, walk
+from os.path import dirname, abspath, join, relpath, sep
+from tempfile import TemporaryDirectory
+from hashlib import sha256
+from shutil import which
+from time import time, perf_counter
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from ContainerManager import RomFS, buildRomFS, pathHash, align, IVFC_HEADER, IVFC_HEADER_SIZE, FILE_ENTRY, INVALID
+from ContainerManager import buildExeFS, extractExeFS, exefsEntries, EXEFS_ENTRY, buildNCCH, extractNCCH, ncchRegions, MEDIA_UNIT
+
+FILES = {
+	'a.txt': b'a' * 100,
+	'b.bin': bytes(range(256)) * 40,
+	'ÿ.txt': b'y',
+	'Ā.txt': b'A',
+	'data/Battle/x.bcres': b'x' * 0x1234,
+	'data/Battle/y.bcres': b'',
+	'data/Field/z.nut': b'z' * 0x2345,
+	'data/empty/e.txt': b'e',
+}
+
+def writeFiles(folder, files, mtime = None):
+	""" Writes the given [files], a dict of path -> data, to the given [folder]. """
+	for path, data in files.items():
+		file = join(folder, *path.split('/'))
+		makedirs(dirname(file), exist_ok=True)
+		with open(file, 'wb') as f: f.write(data)
+		if mtime is not None: utime(file, ns=(mtime, mtime))
+
+def readFile(file):
+	with open(file, 'rb') as f: return f.read()
+
+def writeExeFS(folder):
+	""" Writes the files of an ExeFS and its header to the given [folder]. """
+	writeFiles(join(folder, 'exefs'), {'code.bin': bytes(range(256)) * 50, 'banner.bnr': b'b' * 3000, 'icon.bin': b'i' * 0x36C0})
+	header = bytearray(0x200)
+	for i, name in enumerate([b'.code', b'banner', b'icon']): EXEFS_ENTRY.pack_into(header, i * EXEFS_ENTRY.size, name, 0, 0)
+	with open(join(folder, 'header.bin'), 'wb') as file: file.write(header)
+
+def writeNCCHHeader(file):
+	header = bytearray(0x200)
+	header[0x100:0x104] = b'NCCH'
+	header[0x180:0x184] = (0x400).to_bytes(4, 'little')
+	with open(file, 'wb') as f: f.write(header)
+
+def blockHashes(data, block_size):
+	return b''.join(sha256(data[i:i+block_size].ljust(block_size, b'\0')).digest() for i in range(0, len(data), block_size))
+
+
+class TestRomFS(unittest.TestCase):
+	
+	def setUp(self):
+		self.temp = TemporaryDirectory()
+		self.dir = self.temp.name
+		writeFiles(join(self.dir, 'romfs'), FILES)
+	
+	def tearDown(self):
+		self.temp.cleanup()
+	
+	def verifyHashTree(self, image_file):
+		""" Checks every level of the IVFC hash tree of the given [image_file]. """
+		data = readFile(image_file)
+		header = IVFC_HEADER.unpack_from(data, 0)
+		self.assertEqual(header[0], b'IVFC')
+		master_size = header[2]
+		(_, size1, log1, _), (_, size2, log2, _), (_, size3, log3, _) = header[3:7], header[7:11], header[11:15]
+		# physical order: header, master hash, level 3, level 1, level 2
+		offset3 = align(IVFC_HEADER_SIZE + master_size, 1 << log3)
+		offset1 = offset3 + align(size3, 1 << log3)
+		offset2 = offset1 + align(size1, 1 << log1)
+		level1, level2, level3 = data[offset1:offset1+size1], data[offset2:offset2+size2], data[offset3:offset3+size3]
+		self.assertEqual(blockHashes(level3, 1 << log3), level2)
+		self.assertEqual(blockHashes(level2, 1 << log2), level1)
+		self.assertEqual(blockHashes(level1, 1 << log1), data[IVFC_HEADER_SIZE:IVFC_HEADER_SIZE+master_size])
+		return level3
+	
+	def test_round_trip(self):
+		image_file = join(self.dir, 'romfs.bin')
+		self.assertFalse(buildRomFS(join(self.dir, 'romfs'), image_file))
+		self.verifyHashTree(image_file)
+		with RomFS(image_file) as image:
+			self.assertEqual(sorted(image.files()), sorted(FILES))
+			for path, data in FILES.items():
+				with image.read(path) as view: self.assertEqual(bytes(view), data)
+			self.assertEqual(image.select(['data/Battle'], ['.bcres']), ['data/Battle/x.bcres', 'data/Battle/y.bcres'])
+			self.assertEqual(image.extract(join(self.dir, 'out')), len(FILES))
+		extracted = {'/'.join(relpath(join(dp, f), join(self.dir, 'out')).split(sep)) for dp, dn, fn in walk(join(self.dir, 'out')) for f in fn}
+		self.assertEqual(extracted, set(FILES))
+	
+	def test_order_and_lookup(self):
+		""" Entries are sorted by UTF-16 code units and can be found through the hash tables. """
+		image_file = join(self.dir, 'romfs.bin')
+		buildRomFS(join(self.dir, 'romfs'), image_file)
+		level3 = self.verifyHashTree(image_file)
+		with RomFS(image_file) as image:
+			root_files = [path for path in image.files() if '/' not in path]
+			self.assertEqual(root_files, ['a.txt', 'b.bin', 'ÿ.txt', 'Ā.txt'])
+		# find every file through the file hash table
+		_, dir_hash, dir_hash_size, dir_meta, _, file_hash, file_hash_size, file_meta, _, _ = [int.from_bytes(level3[i:i+4], 'little') for i in range(0, 40, 4)]
+		buckets = [int.from_bytes(level3[file_hash+i:file_hash+i+4], 'little') for i in range(0, file_hash_size, 4)]
+		found = set()
+		for head in buckets:
+			entry = head
+			while entry != INVALID:
+				parent, _, _, _, collision, name_size = FILE_ENTRY.unpack_from(level3, file_meta + entry)
+				name = level3[file_meta+entry+FILE_ENTRY.size:file_meta+entry+FILE_ENTRY.size+name_size]
+				self.assertEqual(buckets[pathHash(parent, name) % len(buckets)], head)
+				found.add(name.decode('utf-16-le'))
+				entry = collision
+		self.assertEqual(found, {path.split('/')[-1] for path in FILES})
+	
+	def test_incremental_build(self):
+		""" Updating an image in place gives the same image as a full build. """
+		old = int((time() - 60) * 1e9)
+		writeFiles(join(self.dir, 'romfs'), FILES, mtime=old)
+		image_file, full_file = join(self.dir, 'romfs.bin'), join(self.dir, 'full.bin')
+		buildRomFS(join(self.dir, 'romfs'), image_file, incremental=True)
+		
+		# same aligned size -> updated in place
+		writeFiles(join(self.dir, 'romfs'), {'data/Field/z.nut': b'Z' * 0x2341}, mtime=old + 10**9)
+		self.assertTrue(buildRomFS(join(self.dir, 'romfs'), image_file, incremental=True))
+		buildRomFS(join(self.dir, 'romfs'), full_file)
+		self.assertEqual(readFile(image_file), readFile(full_file))
+		self.verifyHashTree(image_file)
+		
+		# unchanged files -> nothing to rebuild
+		self.assertTrue(buildRomFS(join(self.dir, 'romfs'), image_file, incremental=True))
+		self.assertEqual(readFile(image_file), readFile(full_file))
+		
+		# new file -> rebuilt completely
+		writeFiles(join(self.dir, 'romfs'), {'data/Field/new.nut': b'n' * 10}, mtime=old)
+		self.assertFalse(buildRomFS(join(self.dir, 'romfs'), image_file, incremental=True))
+		buildRomFS(join(self.dir, 'romfs'), full_file)
+		self.assertEqual(readFile(image_file), readFile(full_file))
+
+
+class TestExeFS(unittest.TestCase):
+	
+	def setUp(self):
+		self.temp = TemporaryDirectory()
+		self.dir = self.temp.name
+		writeExeFS(self.dir)
+	
+	def tearDown(self):
+		self.temp.cleanup()
+	
+	def test_round_trip(self):
+		exefs_file = join(self.dir, 'exefs.bin')
+		buildExeFS(join(self.dir, 'exefs'), join(self.dir, 'header.bin'), exefs_file)
+		data = readFile(exefs_file)
+		# every section is aligned and its hash is stored in reverse order
+		for i, (name, offset, size) in enumerate(exefsEntries(data)):
+			self.assertEqual(offset % MEDIA_UNIT, 0)
+			self.assertEqual(data[0xC0+(9-i)*0x20:0xC0+(10-i)*0x20], sha256(data[0x200+offset:0x200+offset+size]).digest())
+		extractExeFS(exefs_file, join(self.dir, 'out'), join(self.dir, 'out-header.bin'))
+		self.assertEqual(readFile(join(self.dir, 'out', 'code.bin')), readFile(join(self.dir, 'exefs', 'code.bin')))
+		self.assertEqual(readFile(join(self.dir, 'out', 'banner.bin')), readFile(join(self.dir, 'exefs', 'banner.bnr')))
+		# rebuilding the extracted files gives the same ExeFS
+		buildExeFS(join(self.dir, 'out'), join(self.dir, 'out-header.bin'), join(self.dir, 'exefs2.bin'))
+		self.assertEqual(readFile(join(self.dir, 'exefs2.bin')), data)
+	
+	def test_ncch_round_trip(self):
+		buildExeFS(join(self.dir, 'exefs'), join(self.dir, 'header.bin'), join(self.dir, 'exefs.bin'))
+		writeFiles(join(self.dir, 'romfs'), FILES)
+		buildRomFS(join(self.dir, 'romfs'), join(self.dir, 'romfs.bin'))
+		writeFiles(self.dir, {'exheader.bin': bytes(range(256)) * 8, 'logo.bin': b'l' * 0x2000, 'plain.bin': b'plain' * 10})
+		writeNCCHHeader(join(self.dir, 'ncch-header.bin'))
+		regions = {region: join(self.dir, '%s.bin' % region) for region in ['exheader', 'logo', 'plain', 'exefs', 'romfs']}
+		buildNCCH(join(self.dir, 'ncch.bin'), join(self.dir, 'ncch-header.bin'), **regions)
+		
+		# the header contains the hashes of the regions
+		data = readFile(join(self.dir, 'ncch.bin'))
+		offsets = ncchRegions(data[:0x200])
+		self.assertEqual(data[0x160:0x180], sha256(readFile(regions['exheader'])[:0x400]).digest())
+		self.assertEqual(data[0x1C0:0x1E0], sha256(data[offsets['exefs'][0]:offsets['exefs'][0]+0x200]).digest())
+		romfs_hashed = int.from_bytes(data[0x1B8:0x1BC], 'little') * MEDIA_UNIT
+		self.assertEqual(data[0x1E0:0x200], sha256(data[offsets['romfs'][0]:offsets['romfs'][0]+romfs_hashed]).digest())
+		self.assertEqual(offsets['romfs'][0] % 0x1000, 0)
+		
+		# extract the regions and rebuild the partition from them
+		extracted = {region: join(self.dir, 'out-%s.bin' % region) for region in regions}
+		extractNCCH(join(self.dir, 'ncch.bin'), header=join(self.dir, 'out-header.bin'), **extracted)
+		self.assertEqual(readFile(extracted['exheader']), readFile(regions['exheader']))
+		self.assertEqual(readFile(extracted['exefs']), readFile(regions['exefs']))
+		romfs = readFile(regions['romfs'])
+		self.assertEqual(readFile(extracted['romfs']).rstrip(b'\0'), romfs.rstrip(b'\0'))
+		with RomFS(extracted['romfs']) as image: self.assertEqual(sorted(image.files()), sorted(FILES))
+		buildNCCH(join(self.dir, 'ncch2.bin'), join(self.dir, 'out-header.bin'), **extracted)
+		self.assertEqual(readFile(join(self.dir, 'ncch2.bin')), data)
+
+
+@unittest.skipUnless(which('3dstool'), '3dstool not found')
+class TestCompatibility(unittest.TestCase):
+	""" The native builders must create the same images as 3dstool. """
+	
+	def setUp(self):
+		self.temp = TemporaryDirectory()
+		self.dir = self.temp.name
+		writeExeFS(self.dir)
+	
+	def tearDown(self):
+		self.temp.cleanup()
+	
+	def dstool(self, *args):
+		subprocess.run(['3dstool'] + list(args), cwd=self.dir, check=True, capture_output=True)
+	
+	def assertSameFiles(self, file, other):
+		self.assertEqual(sha256(readFile(join(self.dir, file))).hexdigest(), sha256(readFile(join(self.dir, other))).hexdigest())
+	
+	def test_romfs(self):
+		writeFiles(join(self.dir, 'romfs'), FILES)
+		buildRomFS(join(self.dir, 'romfs'), join(self.dir, 'native.bin'))
+		self.dstool('-ctf', 'romfs', 'romfs.bin', '--romfs-dir', 'romfs')
+		self.assertSameFiles('native.bin', 'romfs.bin')
+	
+	def test_romfs_incremental(self):
+		""" An image updated in place matches 3dstool and is faster to create than a complete build. """
+		old = int((time() - 60) * 1e9)
+		files = {'data/%02d/%03d.bin' % (i % 10, i): bytes([i]) * (i * 997) for i in range(200)}
+		writeFiles(join(self.dir, 'romfs'), files, mtime=old)
+		buildRomFS(join(self.dir, 'romfs'), join(self.dir, 'native.bin'), incremental=True)
+		writeFiles(join(self.dir, 'romfs'), {'data/07/107.bin': b'x' * (107 * 997)}, mtime=old + 10**9)
+		start = perf_counter()
+		self.assertTrue(buildRomFS(join(self.dir, 'romfs'), join(self.dir, 'native.bin'), incremental=True))
+		native = perf_counter() - start
+		start = perf_counter()
+		self.dstool('-ctf', 'romfs', 'romfs.bin', '--romfs-dir', 'romfs')
+		dstool = perf_counter() - start
+		self.assertSameFiles('native.bin', 'romfs.bin')
+		self.assertLess(native, dstool)
+	
+	def test_exefs(self):
+		buildExeFS(join(self.dir, 'exefs'), join(self.dir, 'header.bin'), join(self.dir, 'native.bin'))
+		self.dstool('-ctf', 'exefs', 'exefs.bin', '--exefs-dir', 'exefs', '--header', 'header.bin')
+		self.assertSameFiles('native.bin', 'exefs.bin')
+	
+	def test_ncch(self):
+		self.dstool('-ctf', 'exefs', 'exefs.bin', '--exefs-dir', 'exefs', '--header', 'header.bin')
+		writeFiles(join(self.dir, 'romfs'), FILES)
+		self.dstool('-ctf', 'romfs', 'romfs.bin', '--romfs-dir', 'romfs')
+		writeFiles(self.dir, {'exheader.bin': bytes(range(256)) * 8, 'logo.bin': b'l' * 0x2000, 'plain.bin': b'plain' * 10})
+		writeNCCHHeader(join(self.dir, 'ncch-header.bin'))
+		regions = {region: join(self.dir, '%s.bin' % region) for region in ['exheader', 'logo', 'plain', 'exefs', 'romfs']}
+		buildNCCH(join(self.dir, 'native.bin'), join(self.dir, 'ncch-header.bin'), **regions)
+		self.dstool('-ctf', 'cxi', 'ncch.bin', '--header', 'ncch-header.bin', '--exh', 'exheader.bin', '--logo', 'logo.bin', '--plain', 'plain.bin', '--exefs', 'exefs.bin', '--romfs', 'romfs.bin')
+		self.assertSameFiles('native.bin', 'ncch.bin')
+
+
+if __name__ == '__main__':
+	unittest.main()
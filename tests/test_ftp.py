@@ -0,0 +1,147 @@
+""" Author: Dominik Beese
+>>> Send via FTP Tests
+<<<
+"""
+
+from os import makedirs
+from os.path import dirname, abspath, join
+from tempfile import TemporaryDirectory
+from contextlib import redirect_stdout
+from ftplib import error_temp, error_reply
+from threading import Lock, current_thread
+from time import sleep
+import io
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+import SendViaFTP
+
+TITLE_ID = '0004000000123400'
+
+
+class FakeFTP:
+	""" A stand-in for ftplib.FTP that stores the sent files in [files].
+		Errors can be injected for storing single files and for connecting from a single worker.
+	"""
+	lock = Lock()
+	files = dict()
+	dirs = set()
+	connects = 0
+	store_errors = dict() # path -> list of exceptions raised on the next stores
+	refuse_worker = False # refuse every connection of the first worker that connects
+	refused = None
+	delay = 0
+	
+	def reset():
+		FakeFTP.files, FakeFTP.dirs, FakeFTP.store_errors = dict(), {''}, dict()
+		FakeFTP.connects, FakeFTP.refuse_worker, FakeFTP.refused, FakeFTP.delay = 0, False, None, 0
+	
+	def __init__(self, timeout = None):
+		self.path = ''
+	
+	def __enter__(self): return self
+	def __exit__(self, *args): self.close()
+	
+	def connect(self, host, port):
+		with FakeFTP.lock:
+			FakeFTP.connects += 1
+			if FakeFTP.refuse_worker and FakeFTP.connects > 1:
+				if FakeFTP.refused is None: FakeFTP.refused = current_thread()
+				if FakeFTP.refused is current_thread(): raise ConnectionRefusedError('Connection refused')
+		return '220 Fake'
+	
+	def login(self, user, passwd): return '230 Logged in'
+	def quit(self): return '221 Goodbye'
+	def close(self): pass
+	
+	def cwd(self, directory):
+		path = directory.strip('/') if directory.startswith('/') else '/'.join(filter(None, [self.path, directory]))
+		if path not in FakeFTP.dirs: raise Exception('550 No such directory: %s' % path)
+		self.path = path
+	
+	def mkd(self, directory):
+		FakeFTP.dirs.add('/'.join(filter(None, [self.path, directory])))
+	
+	def mlsd(self, path = '.'):
+		prefix = self.path + '/' if self.path else ''
+		names = {p[len(prefix):] for p in FakeFTP.dirs | set(FakeFTP.files) if p.startswith(prefix) and p != self.path}
+		return [(name, {'modify': '19700101000000'}) for name in sorted(names) if '/' not in name]
+	
+	def storbinary(self, command, file):
+		path = command[len('STOR '):].strip('/')
+		with FakeFTP.lock:
+			errors = FakeFTP.store_errors.get(path)
+			if errors: raise errors.pop(0)
+		sleep(FakeFTP.delay)
+		data = file.read()
+		with FakeFTP.lock: FakeFTP.files[path] = data
+
+
+class TestSendViaFTP(unittest.TestCase):
+	
+	def setUp(self):
+		self.temp = TemporaryDirectory()
+		self.dir = self.temp.name
+		self.originals = SendViaFTP.FTP, SendViaFTP.sleep
+		SendViaFTP.FTP, SendViaFTP.sleep = FakeFTP, lambda seconds: None
+		FakeFTP.reset()
+		self.files = {'ExtractedExeFS/code.bin': b'c' * 10, 'ExtractedRomFS/a.txt': b'a', 'ExtractedRomFS/data/b.bin': b'b' * 100}
+		for path, data in self.files.items():
+			file = join(self.dir, *path.split('/'))
+			makedirs(dirname(file), exist_ok=True)
+			with open(file, 'wb') as f: f.write(data)
+	
+	def tearDown(self):
+		SendViaFTP.FTP, SendViaFTP.sleep = self.originals
+		self.temp.cleanup()
+	
+	def send(self, connections = 2):
+		""" Sends the files and returns the output. """
+		output = io.StringIO()
+		with redirect_stdout(output):
+			SendViaFTP.sendFiles(self.dir, TITLE_ID, '127.0.0.1', 5000, '', '', force_override=True, connections=connections)
+		return output.getvalue()
+	
+	def remote(self, path):
+		return 'luma/titles/%s/%s' % (TITLE_ID.lower(), path.replace('ExtractedExeFS/', '').replace('ExtractedRomFS/', 'romfs/'))
+	
+	def assertSent(self, output):
+		self.assertEqual(FakeFTP.files, {self.remote(path): data for path, data in self.files.items()})
+		self.assertNotIn('Error', output)
+	
+	def test_send(self):
+		output = self.send(connections='3')
+		self.assertSent(output)
+		self.assertIn('Sent 3 files.', output)
+	
+	def test_retry(self):
+		FakeFTP.store_errors[self.remote('ExtractedRomFS/a.txt')] = [error_temp('421 Timeout'), EOFError()]
+		output = self.send()
+		self.assertSent(output)
+		self.assertIn('Retried 2 times.', output)
+	
+	def test_unexpected_reply(self):
+		""" A file that fails permanently does not stop the worker from sending the other files. """
+		FakeFTP.store_errors[self.remote('ExtractedRomFS/a.txt')] = [error_reply('250 Unexpected')]
+		output = self.send(connections=1)
+		self.assertEqual(set(FakeFTP.files), {self.remote(path) for path in self.files} - {self.remote('ExtractedRomFS/a.txt')})
+		self.assertIn('Error: Failed to send 1 files.', output)
+	
+	def test_requeue(self):
+		""" The files of a worker that cannot connect are sent by the other workers. """
+		FakeFTP.refuse_worker = True
+		FakeFTP.delay = 0.2
+		output = self.send(connections=2)
+		self.assertSent(output)
+		self.assertIn('Retried %d times.' % SendViaFTP.RETRIES, output)
+	
+	def test_invalid_connections(self):
+		for connections in ['x', None, 0, -1]:
+			output = self.send(connections=connections)
+			self.assertIn('Error: Invalid number of connections', output)
+		self.assertEqual(FakeFTP.connects, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
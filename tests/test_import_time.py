@@ -0,0 +1,46 @@
+""" Author: Dominik Beese
+>>> Import Time Tests
+<<<
+"""
+
+from os.path import dirname, abspath
+import subprocess
+import sys
+import unittest
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+# seconds the startup imports may take at most
+IMPORT_BUDGET = 0.25
+
+def importTimes(module):
+	""" Imports the given [module] in a new interpreter and returns a dict of module -> cumulative seconds. """
+	proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], cwd=ROOT, capture_output=True, text=True)
+	if proc.returncode != 0: raise AssertionError(proc.stderr)
+	times = dict()
+	for line in proc.stderr.splitlines():
+		if not line.startswith('import time:') or '|' not in line: continue
+		_, cumulative, name = line[len('import time:'):].split('|')
+		if not cumulative.strip().isdigit(): continue # header
+		times[name.strip()] = int(cumulative) / 1e6
+	return times
+
+
+class TestImportTime(unittest.TestCase):
+	
+	def test_toolkit_startup(self):
+		""" The menu must not load the modules the scripts import when they are called. """
+		times = importTimes('TranslationToolkit')
+		for module in ['BinJEditor', 'zipfile', 'ContainerManager', 'WorkspaceManager', 'TranslationPatcher', 'GameManager', 'urllib.request', 'ssl']:
+			self.assertNotIn(module, times)
+		self.assertLess(times['TranslationToolkit'], IMPORT_BUDGET)
+	
+	def test_game_manager(self):
+		""" Extracting and building games must not load the patching code. """
+		times = importTimes('GameManager')
+		for module in ['BinJEditor', 'zipfile', 'WorkspaceManager', 'TranslationPatcher']:
+			self.assertNotIn(module, times)
+
+
+if __name__ == '__main__':
+	unittest.main()
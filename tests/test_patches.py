@@ -0,0 +1,236 @@
+""" Author: Dominik Beese
+>>> Patch Download Tests
+<<<
+"""
+
+from os import makedirs, chdir, getcwd, listdir
+from os.path import dirname, abspath, join, exists
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile, ZIP_STORED
+from hashlib import md5, sha256
+from threading import Thread
+from random import Random
+import json
+import re
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+import WorkspaceManager
+from WorkspaceManager import downloadFile, downloadAndExtractPatches, createManifest, MANIFEST_SUFFIX
+
+
+class PatchServer(HTTPServer):
+	""" A static file server for the given [files], a dict of path -> data,
+		that supports conditional and range requests unless [ranges] is false.
+		If [drop_after] is set, the connection is closed after sending this many bytes of a response
+		and [after_drop] is called. Every request is recorded in [requests] as (path, headers, status, bytes sent).
+	"""
+	
+	def __init__(self):
+		self.files = dict()
+		self.ranges = True
+		self.drop_after = None
+		self.after_drop = None
+		self.requests = list()
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(handler): self.respond(handler)
+			def log_message(handler, *args): pass
+		super().__init__(('127.0.0.1', 0), Handler)
+		self.url = 'http://127.0.0.1:%d' % self.server_port
+	
+	def etag(self, data): return '"%s"' % md5(data).hexdigest()
+	
+	def respond(self, handler):
+		headers = {k.lower(): v for k, v in handler.headers.items()}
+		data = self.files.get(handler.path)
+		if data is None: return self.send(handler, headers, 404)
+		etag = self.etag(data)
+		if headers.get('if-none-match') == etag: return self.send(handler, headers, 304)
+		match = re.fullmatch(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+		if match and self.ranges and headers.get('if-range', etag) == etag:
+			start = int(match.group(1))
+			end = min(int(match.group(2)), len(data) - 1) if match.group(2) else len(data) - 1
+			return self.send(handler, headers, 206, data[start:end+1], etag, 'bytes %d-%d/%d' % (start, end, len(data)))
+		return self.send(handler, headers, 200, data, etag)
+	
+	def send(self, handler, headers, status, body = b'', etag = None, content_range = None):
+		sent = len(body) if self.drop_after is None else min(len(body), self.drop_after)
+		self.requests.append((handler.path, headers, status, sent))
+		handler.send_response(status)
+		if etag: handler.send_header('ETag', etag)
+		if content_range: handler.send_header('Content-Range', content_range)
+		handler.send_header('Content-Length', str(len(body)))
+		handler.end_headers()
+		handler.wfile.write(body[:sent])
+		if sent < len(body) and self.after_drop: self.after_drop()
+	
+	def sent(self, path):
+		""" Returns the number of bytes of the given [path] that were sent. """
+		return sum(sent for p, _, _, sent in self.requests if p == path)
+
+
+def createArchive(folder, files, name = 'patches.zip'):
+	""" Creates a patches archive of the given [files], a dict of path -> data, with its manifest
+		in the given [folder] and returns a dict of the published files.
+	"""
+	zip_file = join(folder, name)
+	with ZipFile(zip_file, 'w', ZIP_STORED) as zip:
+		for path, data in files.items(): zip.writestr('Patches/%s' % path, data)
+	createManifest(zip_file)
+	published = dict()
+	for suffix in ['', MANIFEST_SUFFIX, '.sha256']:
+		with open(zip_file + suffix, 'rb') as file: published['/%s%s' % (name, suffix)] = file.read()
+	return published
+
+def readFile(file):
+	with open(file, 'rb') as f: return f.read()
+
+
+class PatchTestCase(unittest.TestCase):
+	
+	def setUp(self):
+		self.temp = TemporaryDirectory()
+		self.cwd = getcwd()
+		self.verbose = WorkspaceManager.VERBOSE
+		WorkspaceManager.VERBOSE = 0
+		self.workspace = join(self.temp.name, 'workspace')
+		self.release = join(self.temp.name, 'release')
+		for folder in [self.workspace, self.release]: makedirs(folder)
+		chdir(self.workspace)
+		random = Random(0)
+		self.files = {'Battle_EN/%02d.bin' % i: random.randbytes(300) for i in range(20)}
+		self.server = PatchServer()
+		Thread(target=self.server.serve_forever, daemon=True).start()
+		self.url = self.server.url + '/patches.zip'
+		self.cache = dict()
+	
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		chdir(self.cwd)
+		WorkspaceManager.VERBOSE = self.verbose
+		self.temp.cleanup()
+	
+	def publish(self, files = None, manifest = True):
+		published = createArchive(self.release, files or self.files)
+		if not manifest: del published['/patches.zip' + MANIFEST_SUFFIX]
+		self.server.files = published
+		self.server.requests.clear()
+		return published['/patches.zip']
+	
+	def assertWorkspace(self, files = None):
+		for path, data in (files or self.files).items():
+			self.assertEqual(readFile(join(*path.split('/'))), data)
+	
+	def archiveRequests(self):
+		return [(headers, status) for path, headers, status, _ in self.server.requests if path == '/patches.zip']
+
+
+class TestChangedPatches(PatchTestCase):
+	
+	def test_only_changed_members(self):
+		self.publish()
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.assertWorkspace()
+		
+		# a single changed patch is read from the remote archive
+		self.files['Battle_EN/07.bin'] = b'changed' * 40
+		archive = self.publish()
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.assertWorkspace()
+		self.assertEqual({status for _, status in self.archiveRequests()}, {206})
+		self.assertLess(self.server.sent('/patches.zip'), len(archive) // 2)
+		self.assertFalse([f for f in listdir('Battle_EN') if f.endswith('.temp')])
+	
+	def test_manifest(self):
+		self.publish()
+		manifest = json.loads(self.server.files['/patches.zip' + MANIFEST_SUFFIX])
+		self.assertEqual({entry['path']: (entry['size'], entry['md5']) for entry in manifest['files']},
+			{path: (len(data), md5(data).hexdigest()) for path, data in self.files.items()})
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.assertEqual(self.cache['digest'], manifest['sha256'])
+		
+		# the digest in the manifest shows that the archive did not change
+		self.server.requests.clear()
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.assertEqual([(path, status) for path, _, status, _ in self.server.requests], [('/patches.zip' + MANIFEST_SUFFIX, 200)])
+		
+		# an unchanged manifest is not transferred again
+		self.server.requests.clear()
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.assertEqual([(path, status) for path, _, status, _ in self.server.requests], [('/patches.zip' + MANIFEST_SUFFIX, 304)])
+	
+	def test_fallback_without_ranges(self):
+		self.publish()
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.files['Battle_EN/07.bin'] = b'changed' * 40
+		self.server.ranges = False
+		self.publish()
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.assertWorkspace()
+		self.assertIn(200, [status for _, status in self.archiveRequests()])
+	
+	def test_fallback_without_manifest(self):
+		self.publish(manifest=False)
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.assertWorkspace()
+		self.assertEqual([status for _, status in self.archiveRequests()], [200])
+		self.assertFalse(exists(WorkspaceManager.DOWNLOAD_FILE))
+
+
+
+class TestDownload(PatchTestCase):
+	
+	def test_resume(self):
+		""" A download is resumed after the server closed the connection. """
+		data = Random(1).randbytes(1000000)
+		self.server.files['/big.bin'] = data
+		self.server.drop_after = 400 * 1024
+		info = downloadFile(self.server.url + '/big.bin', 'big.bin')
+		self.assertEqual(readFile('big.bin'), data)
+		self.assertEqual(info['digest'], sha256(data).hexdigest())
+		self.assertEqual([status for _, _, status, _ in self.server.requests], [200, 206, 206])
+		self.assertEqual([headers.get('if-range') for _, headers, _, _ in self.server.requests[1:]], [self.server.etag(data)] * 2)
+		self.assertEqual(self.server.sent('/big.bin'), len(data))
+		self.assertFalse(exists('big.bin.part'))
+	
+	def test_restart_changed_file(self):
+		""" A download is restarted from the beginning if the file changed in between. """
+		old, new = Random(1).randbytes(1000000), Random(2).randbytes(900000)
+		self.server.files['/big.bin'] = old
+		self.server.drop_after = 400 * 1024
+		def replace():
+			self.server.files['/big.bin'] = new
+			self.server.drop_after = None
+		self.server.after_drop = replace
+		downloadFile(self.server.url + '/big.bin', 'big.bin')
+		self.assertEqual(readFile('big.bin'), new)
+		self.assertEqual([status for _, _, status, _ in self.server.requests], [200, 200])
+		self.assertEqual(self.server.requests[1][1].get('if-range'), self.server.etag(old))
+	
+	def test_checksum_mismatch(self):
+		""" An archive that does not match the published checksum keeps the old patches. """
+		self.publish(manifest=False)
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		random = Random(1)
+		self.publish({path: random.randbytes(300) for path in self.files}, manifest=False)
+		self.server.files['/patches.zip.sha256'] = b'0' * 64 + b'  patches.zip\n'
+		self.assertFalse(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.assertWorkspace()
+		self.assertFalse(exists(WorkspaceManager.DOWNLOAD_FILE))
+		self.assertFalse(exists(WorkspaceManager.DOWNLOAD_FILE + '.part'))
+	
+	def test_not_modified(self):
+		self.publish(manifest=False)
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		self.server.requests.clear()
+		self.assertTrue(downloadAndExtractPatches(self.url, cache=self.cache))
+		requests = self.archiveRequests()
+		self.assertEqual([status for _, status in requests], [304])
+		self.assertEqual(requests[0][0].get('if-none-match'), self.server.etag(self.server.files['/patches.zip']))
+
+
+if __name__ == '__main__':
+	unittest.main()
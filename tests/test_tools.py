@@ -0,0 +1,127 @@
+""" Author: Dominik Beese
+>>> Tool Cache Tests
+<<<
+"""
+
+from os import access, remove, X_OK
+from os.path import dirname, abspath, join, samefile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tempfile import TemporaryDirectory
+from contextlib import redirect_stdout
+from zipfile import ZipFile
+from threading import Thread, Lock
+from time import sleep
+import io
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from ToolManager import ToolCache, provideTools, checkTool
+from CacheManager import hashSHA256
+
+TOOLS = ['xdelta', '3dstool', 'ctrtool']
+
+def toolArchive(tool):
+	""" Returns a zip archive containing an executable that prints the version of the given [tool]. """
+	data = io.BytesIO()
+	with ZipFile(data, 'w') as zip: zip.writestr(tool, '#!/bin/sh\necho "%s 1.0.0"\n' % tool)
+	return data.getvalue()
+
+
+class ToolServer(ThreadingHTTPServer):
+	""" Serves the archives of the tools slowly and records the requests
+		and the highest number of requests handled at the same time.
+	"""
+	daemon_threads = True
+	
+	def __init__(self):
+		self.files = {'/%s.zip' % tool: toolArchive(tool) for tool in TOOLS}
+		self.requests = list()
+		self.active = 0
+		self.max_active = 0
+		self.lock = Lock()
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(handler): self.respond(handler)
+			def log_message(handler, *args): pass
+		super().__init__(('127.0.0.1', 0), Handler)
+		self.url = 'http://127.0.0.1:%d' % self.server_port
+	
+	def respond(self, handler):
+		with self.lock:
+			self.requests.append(handler.path)
+			self.active += 1
+			self.max_active = max(self.max_active, self.active)
+		try:
+			sleep(0.2)
+			data = self.files.get(handler.path)
+			handler.send_response(200 if data else 404)
+			handler.send_header('Content-Length', str(len(data or b'')))
+			handler.end_headers()
+			if data: handler.wfile.write(data)
+		finally:
+			with self.lock: self.active -= 1
+
+
+class TestToolCache(unittest.TestCase):
+	
+	def setUp(self):
+		self.temp = TemporaryDirectory()
+		self.directory = ToolCache.directory
+		ToolCache.directory, ToolCache.index = join(self.temp.name, 'cache'), None
+		self.server = ToolServer()
+		Thread(target=self.server.serve_forever, daemon=True).start()
+	
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		ToolCache.directory, ToolCache.index = self.directory, None
+		self.temp.cleanup()
+	
+	def provide(self, workspace):
+		""" Provides all tools to the given [workspace] and returns a dict of tool -> filename. """
+		filenames = {tool: join(self.temp.name, workspace, tool) for tool in TOOLS}
+		with redirect_stdout(io.StringIO()):
+			provideTools([(tool, '1.0.0', 'linux64', '%s/%s.zip' % (self.server.url, tool), filenames[tool]) for tool in TOOLS])
+		return filenames
+	
+	def assertTools(self, filenames):
+		for tool, filename in filenames.items():
+			self.assertTrue(access(filename, X_OK))
+			self.assertTrue(checkTool(filename, '1.0.0'))
+	
+	def test_parallel_fetch(self):
+		filenames = self.provide('a')
+		self.assertTools(filenames)
+		self.assertEqual(sorted(self.server.requests), sorted('/%s.zip' % tool for tool in TOOLS))
+		self.assertGreater(self.server.max_active, 1)
+		for tool, filename in filenames.items():
+			cached_file = ToolCache.get(tool, '1.0.0', 'linux64')
+			self.assertTrue(samefile(cached_file, filename))
+	
+	def test_offline_from_warm_cache(self):
+		self.provide('a')
+		self.server.shutdown()
+		self.server.server_close()
+		ToolCache.index = None # loaded from disk again
+		filenames = self.provide('b')
+		self.assertTools(filenames)
+		self.assertEqual(len(self.server.requests), len(TOOLS))
+		for tool in TOOLS: self.assertTrue(samefile(filenames[tool], join(self.temp.name, 'a', tool)))
+	
+	def test_tampered_cache(self):
+		""" A cached tool that does not match its checksum is downloaded again instead of being linked. """
+		self.provide('a')
+		cached_file = ToolCache.get('xdelta', '1.0.0', 'linux64')
+		checksum = hashSHA256(cached_file)
+		remove(cached_file)
+		with open(cached_file, 'w') as file: file.write('#!/bin/sh\necho "xdelta 6.6.6"\n')
+		filenames = self.provide('b')
+		self.assertTools(filenames)
+		self.assertEqual(self.server.requests.count('/xdelta.zip'), 2)
+		self.assertEqual(self.server.requests.count('/3dstool.zip'), 1)
+		self.assertEqual(hashSHA256(filenames['xdelta']), checksum)
+		self.assertEqual(hashSHA256(ToolCache.get('xdelta', '1.0.0', 'linux64')), checksum)
+
+
+if __name__ == '__main__':
+	unittest.main()
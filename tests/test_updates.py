@@ -0,0 +1,100 @@
+""" Author: Dominik Beese
+>>> Update Check Tests
+<<<
+"""
+
+from os.path import dirname, abspath, join
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import time
+import json
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+import TranslationToolkit
+from TranslationToolkit import Config, Updates
+
+RELEASE = {'tag_name': 'v9.9.9', 'html_url': 'https://example.com/releases/v9.9.9'}
+
+
+class ReleaseServer(HTTPServer):
+	""" A stand-in for the releases API that counts the requests and fails if [status] is not 200. """
+	
+	def __init__(self):
+		self.requests = 0
+		self.status = 200
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(handler):
+				self.requests += 1
+				body = json.dumps(RELEASE).encode() if self.status == 200 else b''
+				handler.send_response(self.status)
+				handler.send_header('Content-Length', str(len(body)))
+				handler.end_headers()
+				handler.wfile.write(body)
+			def log_message(handler, *args): pass
+		super().__init__(('127.0.0.1', 0), Handler)
+		self.url = 'http://127.0.0.1:%d/releases/latest' % self.server_port
+
+
+class TestUpdates(unittest.TestCase):
+	
+	def setUp(self):
+		self.temp = TemporaryDirectory()
+		self.config_file = TranslationToolkit.CONFIG_FILE
+		TranslationToolkit.CONFIG_FILE = join(self.temp.name, 'tt-config.json')
+		Config.cfg, Config.dirty = None, False
+		Updates.thread, Updates.result, Updates.shown = None, None, False
+		self.server = ReleaseServer()
+		Thread(target=self.server.serve_forever, daemon=True).start()
+	
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		TranslationToolkit.CONFIG_FILE = self.config_file
+		Config.cfg, Config.dirty = None, False
+		self.temp.cleanup()
+	
+	def check(self, url = None):
+		""" Runs a complete check as the menu does and returns the result. """
+		Updates.result = None
+		Updates.start(url or self.server.url)
+		if Updates.thread is not None: Updates.thread.join()
+		self.assertTrue(Updates.ready())
+		return Updates.result
+	
+	def test_successful_check_is_cached(self):
+		self.assertEqual(self.check(), [RELEASE['tag_name'], RELEASE['html_url']])
+		self.assertEqual(Config.get('update.result'), [RELEASE['tag_name'], RELEASE['html_url']])
+		self.assertEqual(self.check(), [RELEASE['tag_name'], RELEASE['html_url']])
+		self.assertEqual(self.server.requests, 1)
+	
+	def test_failed_check_is_retried_later(self):
+		self.server.status = 500
+		self.assertIsNone(self.check())
+		self.assertEqual(Config.get('update.lastCheck', 0), 0)
+		self.assertGreater(Config.get('update.lastAttempt', 0), 0)
+		# the next start within the retry interval does not query the server again
+		self.assertIsNone(self.check())
+		self.assertEqual(self.server.requests, 1)
+		# after the retry interval the server is queried again
+		self.server.status = 200
+		Config.set('update.lastAttempt', time() - Config.get('update.retryInterval') - 1)
+		self.assertEqual(self.check(), [RELEASE['tag_name'], RELEASE['html_url']])
+		self.assertEqual(self.server.requests, 2)
+	
+	def test_offline_check_is_recorded(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.assertIsNone(self.check())
+		self.assertGreater(Config.get('update.lastAttempt', 0), 0)
+		# the attempt is saved with the config, so the next session does not wait for the network either
+		Config.saveConfig()
+		Config.cfg = None
+		self.assertIsNone(self.check())
+		self.assertIsNone(Updates.thread)
+
+
+if __name__ == '__main__':
+	unittest.main()